@@ -18,12 +18,14 @@ setup(
     include_package_data=True,
     install_requires=[
         'aiofiles',
+        'aiohttp',
         'bitmath',
         'click',
         'inotipy',
         'kopf',
         'kubernetes',
         'kubernetes_asyncio',
+        'prometheus_client',
         'pyyaml',
     ],
     entry_points={
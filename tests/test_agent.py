@@ -0,0 +1,59 @@
+import time
+
+from zfs_provisioner import agent
+
+
+TOKEN = 'secret'
+PATH = '/v1/datasets/create'
+BODY = b'{"dataset": "tank/pvc-a"}'
+
+
+def _header(timestamp=None, nonce='nonce-a', token=TOKEN, body=BODY):
+    if timestamp is None:
+        timestamp = int(time.time())
+    return f'{timestamp}:{nonce}:{agent.sign(token, timestamp, nonce, "POST", PATH, body)}'
+
+
+def test_verify_accepts_signed_request():
+    assert agent.verify(TOKEN, _header(), 'POST', PATH, BODY)
+
+
+def test_verify_rejects_other_token_and_body():
+    assert not agent.verify(TOKEN, _header(token='other'), 'POST', PATH, BODY)
+    assert not agent.verify(TOKEN, _header(), 'POST', PATH, b'{"dataset": "tank/pvc-b"}')
+    assert not agent.verify(TOKEN, _header(), 'POST', '/v1/datasets/destroy', BODY)
+
+
+def test_verify_rejects_malformed_header():
+    for header in (None, '', 'no-colons', 'now:nonce:signature'):
+        assert not agent.verify(TOKEN, header, 'POST', PATH, BODY)
+
+
+def test_verify_rejects_expired_signature():
+    now = int(time.time())
+    assert agent.verify(TOKEN, _header(now - agent.MAX_CLOCK_SKEW + 5), 'POST', PATH, BODY)
+    assert not agent.verify(TOKEN, _header(now - agent.MAX_CLOCK_SKEW - 5), 'POST', PATH, BODY)
+    assert not agent.verify(TOKEN, _header(now + agent.MAX_CLOCK_SKEW + 5), 'POST', PATH, BODY)
+
+
+def test_verify_rejects_replayed_request():
+    nonces = agent.Nonces()
+    header = _header()
+    assert agent.verify(TOKEN, header, 'POST', PATH, BODY, nonces)
+    assert not agent.verify(TOKEN, header, 'POST', PATH, BODY, nonces)
+    assert agent.verify(TOKEN, _header(nonce='nonce-b'), 'POST', PATH, BODY, nonces)
+
+
+def test_nonces_are_forgotten_after_max_age(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(agent.time, 'monotonic', lambda: now[0])
+    nonces = agent.Nonces(max_age=10)
+    assert nonces.add('nonce-a')
+    now[0] += 5
+    assert nonces.add('nonce-b')
+    assert not nonces.add('nonce-a')
+    now[0] += 6
+    # nonce-a is older than max_age by now, nonce-b is not.
+    assert nonces.add('nonce-a')
+    assert not nonces.add('nonce-b')
+    assert list(nonces.seen) == ['nonce-b', 'nonce-a']
@@ -0,0 +1,66 @@
+import json
+import time
+
+from zfs_provisioner import capacity
+
+
+GiB = 1024 ** 3
+
+
+def _report(available, used, committed, timestamp=None):
+    """Return a report annotation of the parent dataset tank/p.
+    """
+    return json.dumps({
+        'timestamp': time.time() if timestamp is None else timestamp,
+        'datasets': {'tank/p': {'available': available, 'used': used, 'committed': committed}},
+    })
+
+
+def _cache():
+    cache = capacity.CapacityCache()
+    cache.update('node-a', _report(60 * GiB, 40 * GiB, 50 * GiB))
+    cache.update('node-b', _report(90 * GiB, 10 * GiB, 20 * GiB))
+    # Reported long ago.
+    cache.update('node-c', _report(1000 * GiB, 0, 0, time.time() - 3600))
+    return cache
+
+
+def test_fits():
+    parent = capacity.Capacity(available=60 * GiB, used=40 * GiB, committed=50 * GiB)
+    assert parent.fits(50 * GiB)
+    assert not parent.fits(51 * GiB)
+    assert parent.fits(150 * GiB, overcommit=2.0)
+    assert not parent.fits(151 * GiB, overcommit=2.0)
+
+
+def test_cache_fits():
+    cache = _cache()
+    assert cache.fits('node-a', 'tank/p', 50 * GiB, 60, 1.0) is True
+    assert cache.fits('node-a', 'tank/p', 51 * GiB, 60, 1.0) is False
+    # Unknown, too old or invalid reports are not checked.
+    assert cache.fits('node-a', 'tank/q', GiB, 60, 1.0) is None
+    assert cache.fits('node-c', 'tank/p', GiB, 60, 1.0) is None
+    cache.update('node-a', 'not json')
+    assert cache.fits('node-a', 'tank/p', GiB, 60, 1.0) is None
+
+
+def test_pick_prefers_most_room():
+    cache = _cache()
+    parents = {'node-a': 'tank/p', 'node-b': 'tank/p', 'node-c': 'tank/p'}
+    assert cache.pick(parents, 10 * GiB, 60, 1.0) == 'node-b'
+    assert cache.pick({'node-a': 'tank/p'}, 10 * GiB, 60, 1.0) == 'node-a'
+    assert cache.pick(parents, 90 * GiB, 60, 1.0) is None
+    assert cache.pick(parents, 90 * GiB, 60, 2.0) == 'node-b'
+
+
+def test_commit_until_next_report():
+    cache = _cache()
+    parents = {'node-a': 'tank/p', 'node-b': 'tank/p'}
+    cache.commit('node-b', 'tank/p', 40 * GiB)
+    assert cache.pick(parents, 10 * GiB, 60, 1.0) == 'node-a'
+    cache.commit('node-b', 'tank/p', -40 * GiB)
+    assert cache.pick(parents, 10 * GiB, 60, 1.0) == 'node-b'
+    # Parents without a report are ignored.
+    cache.commit('node-b', 'tank/q', 40 * GiB)
+    cache.commit('node-d', 'tank/p', 40 * GiB)
+    assert cache.get('node-d', 'tank/p', 60) is None
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from zfs_provisioner import datasets
+
+
+ITEMS = [
+    {'action': 'create', 'dataset': 'tank/pvc-a', 'mountpoint': '/mnt/pvc-a'},
+    {'action': 'resize', 'dataset': 'tank/pvc-b', 'refquota': '2G'},
+]
+
+
+def test_parse_pod_results_takes_last_complete_line():
+    text = '\n'.join([
+        'creating datasets',
+        '[null, null]',
+        '[null, "Failed to create dataset"]',
+        '[null]',
+        '[not json',
+    ])
+    assert datasets._parse_pod_results(text, ITEMS) == [None, 'Failed to create dataset']
+
+
+def test_parse_pod_results_without_results():
+    assert datasets._parse_pod_results('{"tank/pvc-a": null}\n[null]', ITEMS) is None
+
+
+def test_batcher_reports_results_per_item(monkeypatch):
+    monkeypatch.setattr(datasets.CONFIG, 'batch_window', 0.01)
+    monkeypatch.setattr(datasets.CONFIG, 'use_agent', False)
+    ran = []
+
+    async def run_pod_items(node_name, items, storage_class=None):
+        ran.append((items, storage_class))
+        return [None, 'No such dataset']
+    monkeypatch.setattr(datasets, '_run_pod_items', run_pod_items)
+
+    async def main():
+        batcher = datasets.Batcher()
+        return await asyncio.gather(*[batcher.submit('node-a', item, 'zfs') for item in ITEMS],
+            return_exceptions=True)
+
+    created, resized = asyncio.run(main())
+    assert ran == [(ITEMS, 'zfs')]
+    assert created == ITEMS[0]
+    assert isinstance(resized, datasets.DatasetError)
+    assert str(resized) == 'No such dataset'
+
+
+def test_batcher_rejects_queued_dataset(monkeypatch):
+    monkeypatch.setattr(datasets.CONFIG, 'batch_window', 0.01)
+    monkeypatch.setattr(datasets.CONFIG, 'use_agent', False)
+
+    async def run_pod_items(node_name, items, storage_class=None):
+        return [None] * len(items)
+    monkeypatch.setattr(datasets, '_run_pod_items', run_pod_items)
+
+    async def main():
+        batcher = datasets.Batcher()
+        queued = asyncio.create_task(batcher.submit('node-a', ITEMS[0]))
+        await asyncio.sleep(0)
+        with pytest.raises(datasets.DatasetError):
+            await batcher.submit('node-a', dict(ITEMS[0], action='destroy'))
+        # Other nodes have batches of their own.
+        await batcher.submit('node-b', ITEMS[0])
+        await queued
+
+    asyncio.run(main())
@@ -0,0 +1,17 @@
+import pkgutil
+import subprocess
+import sys
+
+import pytest
+
+import zfs_provisioner
+
+
+MODULES = sorted(module.name for module in pkgutil.iter_modules(zfs_provisioner.__path__))
+
+
+@pytest.mark.parametrize('name', MODULES)
+def test_import_on_its_own(name):
+    # In a fresh interpreter, so the modules other tests imported
+    # before do not hide circular imports.
+    subprocess.run([sys.executable, '-c', f'import zfs_provisioner.{name}'], check=True)
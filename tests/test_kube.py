@@ -0,0 +1,54 @@
+import asyncio
+
+from zfs_provisioner import kube
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+def test_unlimited_never_waits():
+    bucket = kube.TokenBucket(rate=0)
+    assert all(asyncio.run(bucket.acquire()) == 0.0 for _ in range(100))
+
+
+def test_burst_then_wait(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(kube.time, 'monotonic', clock.monotonic)
+    slept = []
+
+    async def sleep(delay):
+        slept.append(delay)
+    monkeypatch.setattr(kube.asyncio, 'sleep', sleep)
+
+    bucket = kube.TokenBucket(rate=10, burst=3)
+
+    async def main():
+        return [await bucket.acquire() for _ in range(5)]
+
+    assert asyncio.run(main()) == [0.0, 0.0, 0.0, 0.1, 0.2]
+    assert slept == [0.1, 0.2]
+
+
+def test_refill(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(kube.time, 'monotonic', clock.monotonic)
+    bucket = kube.TokenBucket(rate=2, burst=4)
+
+    async def drain():
+        for _ in range(4):
+            assert await bucket.acquire() == 0.0
+
+    asyncio.run(drain())
+    assert bucket.tokens == 0
+    clock.now += 1
+    bucket._refill()
+    assert bucket.tokens == 2
+    # Never refills above burst.
+    clock.now += 60
+    bucket._refill()
+    assert bucket.tokens == 4
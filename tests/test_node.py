@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from zfs_provisioner import aiozfs
+from zfs_provisioner import node
+from zfs_provisioner import zfs
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    inventory = zfs.Inventory()
+    monkeypatch.setattr(zfs, 'INVENTORY', inventory)
+    monkeypatch.setattr(aiozfs, 'INVENTORY', inventory)
+    backend = zfs.MemoryBackend()
+    monkeypatch.setattr(zfs, 'BACKEND', backend)
+    return backend
+
+
+def test_create_dataset_again(backend, tmp_path):
+    mountpoint = str(tmp_path / 'pvc-a')
+    asyncio.run(node.create_dataset('tank/p/pvc-a', mountpoint, refquota=1024 ** 3))
+    # A previous attempt that created the dataset counts as success.
+    asyncio.run(node.create_dataset('tank/p/pvc-a', mountpoint, refquota=1024 ** 3))
+    with pytest.raises(zfs.ZfsCommandError):
+        asyncio.run(node.create_dataset('tank/p/pvc-a', mountpoint, refquota=2 * 1024 ** 3))
+    assert backend.datasets['tank/p/pvc-a']['refquota'] == str(1024 ** 3)
+
+
+def test_destroy_dataset_again(backend, tmp_path):
+    mountpoint = tmp_path / 'pvc-a'
+    asyncio.run(node.create_dataset('tank/p/pvc-a', str(mountpoint)))
+    # A previous attempt that destroyed the dataset counts as success.
+    for attempt in range(2):
+        asyncio.run(node.destroy_dataset('tank/p/pvc-a', str(mountpoint)))
+    assert sorted(backend.datasets) == ['tank/p']
+    assert not mountpoint.exists()
+
+
+def test_clone_dataset_again(backend, tmp_path):
+    asyncio.run(node.create_dataset('tank/p/pvc-a', str(tmp_path / 'pvc-a')))
+    for attempt in range(2):
+        asyncio.run(node.create_dataset('tank/p/pvc-b', str(tmp_path / 'pvc-b'), origin='tank/p/pvc-a'))
+    assert backend.datasets['tank/p/pvc-b']['origin'] == 'tank/p/pvc-a@clone-pvc-b'
+    with pytest.raises(zfs.ZfsCommandError):
+        asyncio.run(node.create_dataset('tank/p/pvc-b', str(tmp_path / 'pvc-b'), origin='tank/p/pvc-c'))
+
+
+def test_destroy_keeps_dataset_until_its_snapshots_are_gone(backend, tmp_path):
+    mountpoint = tmp_path / 'pvc-a'
+    asyncio.run(node.create_dataset('tank/p/pvc-a', str(mountpoint)))
+    asyncio.run(node.create_snapshot('tank/p/pvc-a@snapshot-a'))
+
+    asyncio.run(node.destroy_dataset('tank/p/pvc-a', str(mountpoint)))
+    assert backend.datasets['tank/p/pvc-a'][node.DESTROYED_PROPERTY] == 'yes'
+    assert backend.datasets['tank/p/pvc-a']['mountpoint'] == 'none'
+    assert not mountpoint.exists()
+
+    # The last snapshot takes the dataset with it.
+    asyncio.run(node.destroy_snapshot('tank/p/pvc-a@snapshot-a'))
+    assert sorted(backend.datasets) == ['tank/p']
+
+
+def test_destroy_snapshot_with_clone_is_deferred(backend, tmp_path):
+    asyncio.run(node.create_dataset('tank/p/pvc-a', str(tmp_path / 'pvc-a')))
+    asyncio.run(node.create_snapshot('tank/p/pvc-a@snapshot-a'))
+    asyncio.run(node.create_dataset('tank/p/pvc-b', str(tmp_path / 'pvc-b'), origin='tank/p/pvc-a@snapshot-a'))
+
+    asyncio.run(node.destroy_snapshot('tank/p/pvc-a@snapshot-a'))
+    assert 'tank/p/pvc-a@snapshot-a' in backend.datasets
+    asyncio.run(node.destroy_dataset('tank/p/pvc-b', str(tmp_path / 'pvc-b')))
+    assert sorted(backend.datasets) == ['tank/p', 'tank/p/pvc-a']
@@ -0,0 +1,92 @@
+import pytest
+
+from zfs_provisioner import placement
+from zfs_provisioner.handlers import CONFIG
+from zfs_provisioner.placement import Candidate, ConfigError, Resolver
+
+
+CONFIG_DATA = {
+    'node_dataset_map': {
+        '__default__': 'tank/default',
+        'node-1': 'tank/exact',
+        'gpu-*': ['fast/a', {'dataset': 'fast/b', 'storage_classes': ['scratch']}],
+        'node-?': 'tank/pattern',
+    },
+    'node_selector_dataset_map': [
+        {
+            'selector': {'matchLabels': {'disk': 'ssd'}},
+            'datasets': 'ssd/data',
+        },
+        {
+            'selector': {'matchExpressions': [
+                {'key': 'zone', 'operator': 'In', 'values': ['a', 'b']},
+                {'key': 'legacy', 'operator': 'DoesNotExist'},
+            ]},
+            'datasets': 'zone/data',
+        },
+    ],
+}
+
+
+@pytest.fixture
+def resolver(monkeypatch):
+    resolver = Resolver.from_config(CONFIG_DATA)
+    monkeypatch.setattr(placement, 'RESOLVER', resolver)
+    monkeypatch.setattr(placement, 'NODE_LABELS', {})
+    return resolver
+
+
+def _datasets(resolver, node_name):
+    return [candidate.dataset for candidate in resolver.resolve(node_name)]
+
+
+def test_exact_before_pattern(resolver):
+    assert _datasets(resolver, 'node-1') == ['tank/exact']
+    assert _datasets(resolver, 'node-2') == ['tank/pattern']
+    assert _datasets(resolver, 'gpu-7') == ['fast/a', 'fast/b']
+
+
+def test_selectors(resolver):
+    placement.update_node_labels('ssd-1', {'disk': 'ssd', 'zone': 'a'})
+    placement.update_node_labels('zone-1', {'zone': 'b'})
+    placement.update_node_labels('legacy-1', {'zone': 'b', 'legacy': 'true'})
+    assert _datasets(resolver, 'ssd-1') == ['ssd/data']
+    assert _datasets(resolver, 'zone-1') == ['zone/data']
+    assert _datasets(resolver, 'legacy-1') == ['tank/default']
+
+
+def test_label_change_resolves_again(resolver):
+    placement.update_node_labels('host', {'disk': 'hdd'})
+    assert _datasets(resolver, 'host') == ['tank/default']
+    placement.update_node_labels('host', {'disk': 'ssd'})
+    assert _datasets(resolver, 'host') == ['ssd/data']
+
+
+def test_unknown_labels_are_not_cached(resolver):
+    assert _datasets(resolver, 'host') == ['tank/default']
+    placement.NODE_LABELS['host'] = {'disk': 'ssd'}
+    assert _datasets(resolver, 'host') == ['ssd/data']
+
+
+def test_storage_classes(resolver):
+    assert placement.get_candidates('gpu-1', 'standard') == ['fast/a']
+    assert placement.get_candidates('gpu-1', 'scratch') == ['fast/a', 'fast/b']
+
+
+def test_no_config_falls_back_to_parent_dataset():
+    assert Resolver().resolve('node-1') == (Candidate(CONFIG.parent_dataset),)
+
+
+@pytest.mark.parametrize('config', [
+    [],
+    {'placement': 'random'},
+    {'node_dataset_map': {'node-1': []}},
+    {'node_dataset_map': {'node-1': '/tank'}},
+    {'node_dataset_map': {'node-1': {'dataset': 'tank', 'storage_classes': 'fast'}}},
+    {'node_selector_dataset_map': [{'selector': {}, 'datasets': 'tank'}]},
+    {'node_selector_dataset_map': [{'selector': {'matchExpressions': [
+        {'key': 'zone', 'operator': 'Gt', 'values': ['1']}]}, 'datasets': 'tank'}]},
+])
+def test_invalid_config(config):
+    with pytest.raises(ConfigError):
+        Resolver.from_config(config)
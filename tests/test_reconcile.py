@@ -0,0 +1,105 @@
+import dataclasses
+import json
+
+import pytest
+
+from zfs_provisioner import datasets
+from zfs_provisioner import handlers
+from zfs_provisioner import reconcile
+from zfs_provisioner.handlers import CONFIG
+
+
+INVENTORIES = {
+    'node-a': {'tank/p': {'tank/p/pvc-bound', 'tank/p/pvc-pending', 'tank/p/pvc-found'}},
+}
+
+
+@pytest.fixture(autouse=True)
+def storage_classes(monkeypatch):
+    monkeypatch.setattr(CONFIG, 'storage_classes', {
+        'zfs': handlers.StorageClass(name='zfs', provisioner=CONFIG.provisioner_name,
+            allowVolumeExpansion=True),
+    })
+
+
+def _dataset(name, node_name='node-a'):
+    return datasets.Dataset(name=name, parent='tank/p', mount_point=f'/mnt/{name}',
+        selected_node=node_name)
+
+
+def _annotations(dataset=None, **annotations):
+    if dataset is not None:
+        annotations[CONFIG.dataset_annotation] = json.dumps(dataclasses.asdict(dataset))
+    return annotations
+
+
+def _pvc(name, phase, dataset=None, storage='1Gi', capacity='1Gi', handled=True):
+    annotations = _annotations(dataset)
+    if handled:
+        annotations[reconcile.LAST_HANDLED_ANNOTATION] = '{}'
+    return {
+        'metadata': {'namespace': 'default', 'name': name, 'annotations': annotations},
+        'spec': {'storageClassName': 'zfs', 'resources': {'requests': {'storage': storage}}},
+        'status': {'phase': phase, 'capacity': {'storage': capacity} if phase == 'Bound' else {}},
+    }
+
+
+def _pv(name, phase='Released', dataset=None, policy='Delete', provisioner=None):
+    annotations = _annotations(dataset, **{
+        reconcile.PROVISIONED_BY_ANNOTATION: provisioner or CONFIG.provisioner_name})
+    return {
+        'metadata': {'name': name, 'annotations': annotations},
+        'spec': {
+            'persistentVolumeReclaimPolicy': policy,
+            'local': {'path': f'/mnt/{name}'},
+            'nodeAffinity': {'required': {'nodeSelectorTerms': [{'matchExpressions': [
+                {'key': 'kubernetes.io/hostname', 'operator': 'In', 'values': ['node-a']}]}]}},
+        },
+        'status': {'phase': phase},
+    }
+
+
+def test_diff_claims():
+    pvcs = [
+        # The stored dataset is gone, create it again.
+        _pvc('lost', 'Pending', _dataset('pvc-lost')),
+        # Whether the dataset exists is not known, run the handler again.
+        _pvc('unknown', 'Pending', _dataset('pvc-unknown', 'node-b')),
+        _pvc('new', 'Pending'),
+        # Only the persistent volume is missing.
+        _pvc('pending', 'Pending', _dataset('pvc-pending')),
+        # Has its dataset and persistent volume.
+        _pvc('done', 'Pending', _dataset('pvc-found')),
+        _pvc('bound', 'Bound', _dataset('pvc-bound')),
+        _pvc('resize', 'Bound', _dataset('pvc-bound'), storage='2Gi'),
+        _pvc('missing', 'Bound', _dataset('pvc-missing')),
+        # kopf hands claims it never saw to the create handlers itself.
+        _pvc('unhandled', 'Pending', _dataset('pvc-unhandled'), handled=False),
+    ]
+    pvs = [_pv('pvc-found', 'Bound'), _pv('pvc-bound', 'Bound')]
+    plan = reconcile.diff(pvcs, pvs, INVENTORIES)
+    assert plan.lost == [('default', 'lost')]
+    assert plan.claims == [('default', 'unknown'), ('default', 'new'), ('default', 'pending'),
+        ('default', 'resize')]
+    assert plan.missing == [('default', 'missing')]
+    assert plan.released == []
+
+
+def test_diff_released_volumes():
+    pvs = [
+        _pv('pvc-stored', dataset=_dataset('pvc-stored')),
+        # Found in the inventory of its node.
+        _pv('pvc-found'),
+        # Neither stored nor found, not deleted.
+        _pv('pvc-unknown'),
+        _pv('pvc-retained', dataset=_dataset('pvc-retained'), policy='Retain'),
+        _pv('pvc-bound', 'Bound', dataset=_dataset('pvc-bound')),
+        _pv('pvc-other', dataset=_dataset('pvc-other'), provisioner='example.com/other'),
+    ]
+    plan = reconcile.diff([], pvs, INVENTORIES)
+    assert [(pv_name, dataset.full_name, dataset.selected_node, dataset.mount_point)
+            for pv_name, dataset in plan.released] == [
+        ('pvc-stored', 'tank/p/pvc-stored', 'node-a', '/mnt/pvc-stored'),
+        ('pvc-found', 'tank/p/pvc-found', 'node-a', '/mnt/pvc-found'),
+    ]
+    assert len(plan) == 2
@@ -0,0 +1,96 @@
+import asyncio
+
+from zfs_provisioner.scheduler import Scheduler
+
+
+async def _run_in_order(scheduler, operations):
+    """Queue operations of (node name, actions) behind one that holds
+    the only slot and return the order they got to run in.
+    """
+    order = []
+    release = asyncio.Event()
+
+    async def hold():
+        async with scheduler.slot('node-a', ['create']):
+            await release.wait()
+
+    async def run(index, node_name, actions):
+        async with scheduler.slot(node_name, actions):
+            order.append(index)
+
+    holder = asyncio.create_task(hold())
+    await asyncio.sleep(0)
+    tasks = []
+    for index, (node_name, actions) in enumerate(operations):
+        tasks.append(asyncio.create_task(run(index, node_name, actions)))
+        await asyncio.sleep(0)
+    release.set()
+    await asyncio.gather(holder, *tasks)
+    return order
+
+
+def test_deletes_run_first():
+    operations = [('node-a', ['create']), ('node-b', ['destroy']), ('node-a', ['create']), ('node-c', ['destroy'])]
+    assert asyncio.run(_run_in_order(Scheduler(max_concurrent=1, priority='delete'), operations)) == [1, 3, 0, 2]
+
+
+def test_creates_run_first():
+    operations = [('node-a', ['destroy']), ('node-b', ['create']), ('node-a', ['create', 'destroy'])]
+    assert asyncio.run(_run_in_order(Scheduler(max_concurrent=1, priority='create'), operations)) == [1, 2, 0]
+
+
+def test_no_priority_keeps_queue_order():
+    operations = [('node-a', ['create']), ('node-b', ['destroy']), ('node-a', ['destroy'])]
+    assert asyncio.run(_run_in_order(Scheduler(max_concurrent=1, priority='none'), operations)) == [0, 1, 2]
+
+
+def test_busy_node_does_not_block_others():
+    async def main():
+        scheduler = Scheduler(max_concurrent=2, max_concurrent_per_node=1, priority='none')
+        release = asyncio.Event()
+        started = []
+
+        async def run(node_name):
+            async with scheduler.slot(node_name, ['create']):
+                started.append(node_name)
+                await release.wait()
+
+        tasks = [asyncio.create_task(run(node_name)) for node_name in ('node-a', 'node-a', 'node-b')]
+        await asyncio.sleep(0.01)
+        assert started == ['node-a', 'node-b']
+        assert scheduler.running_per_node == {'node-a': 1, 'node-b': 1}
+        release.set()
+        await asyncio.gather(*tasks)
+        assert started == ['node-a', 'node-b', 'node-a']
+        assert scheduler.running == 0
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    async def main():
+        scheduler = Scheduler(max_concurrent=1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with scheduler.slot('node-a', ['create']):
+                await release.wait()
+
+        async def run():
+            async with scheduler.slot('node-a', ['create']):
+                pass
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(run())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert waiter.cancelled()
+        release.set()
+        await holder
+        assert scheduler.running == 0
+        # The slot is free for the next operation.
+        await asyncio.wait_for(run(), 1)
+
+    asyncio.run(main())
@@ -0,0 +1,62 @@
+from zfs_provisioner import handlers
+from zfs_provisioner import placement
+from zfs_provisioner.handlers import CONFIG
+from zfs_provisioner.shard import Shards, claim_key, node_key, rendezvous
+
+
+KEYS = [f'node-{i}' for i in range(500)]
+MEMBERS = ['replica-a', 'replica-b', 'replica-c']
+
+
+def _owners(members):
+    shards = Shards()
+    shards.identity = members[0]
+    shards.members = list(members)
+    return {key: shards.owner(key) for key in KEYS}
+
+
+def test_no_members():
+    assert rendezvous('node-1', []) is None
+    assert Shards().owns_node('node-1')
+
+
+def test_owner_does_not_depend_on_member_order():
+    assert _owners(MEMBERS) == _owners(list(reversed(MEMBERS)))
+
+
+def test_keys_are_spread():
+    owners = _owners(MEMBERS)
+    for member in MEMBERS:
+        assert len([key for key in KEYS if owners[key] == member]) > len(KEYS) / 6
+
+
+def test_join_only_moves_keys_to_new_member():
+    before = _owners(MEMBERS)
+    after = _owners(MEMBERS + ['replica-d'])
+    moved = [key for key in KEYS if before[key] != after[key]]
+    assert moved
+    assert all(after[key] == 'replica-d' for key in moved)
+
+
+def test_leave_only_moves_keys_of_member():
+    before = _owners(MEMBERS)
+    after = _owners([member for member in MEMBERS if member != 'replica-b'])
+    for key in KEYS:
+        if before[key] == 'replica-b':
+            assert after[key] in ('replica-a', 'replica-c')
+        else:
+            assert after[key] == before[key]
+
+
+def test_node_key_uses_label(monkeypatch):
+    monkeypatch.setattr(CONFIG, 'shard_node_label', 'topology.kubernetes.io/zone')
+    monkeypatch.setattr(placement, 'NODE_LABELS', {'node-1': {'topology.kubernetes.io/zone': 'zone-a'}})
+    assert node_key('node-1') == 'zone-a'
+    assert node_key('node-2') == 'node-2'
+
+
+def test_claim_key():
+    pvc = {'metadata': {'namespace': 'default', 'name': 'data', 'annotations': {}}}
+    assert claim_key(pvc) == 'default/data'
+    pvc['metadata']['annotations'][handlers.SELECTED_NODE_ANNOTATION] = 'node-1'
+    assert claim_key(pvc) == 'node-1'
@@ -0,0 +1,107 @@
+import asyncio
+import dataclasses
+import json
+
+import pytest
+
+from zfs_provisioner import datasets
+from zfs_provisioner import placement
+from zfs_provisioner import reconcile
+from zfs_provisioner import sweeper
+from zfs_provisioner.handlers import CONFIG
+
+
+class FakeV1:
+    """Stands in for the CoreV1Api, only the names of its list calls are used.
+    """
+    def list_persistent_volume(self, **_):
+        pass
+
+    def list_persistent_volume_claim_for_all_namespaces(self, **_):
+        pass
+
+    def list_node(self, **_):
+        pass
+
+
+def _obj(name, stored=None):
+    annotations = {}
+    if stored is not None:
+        dataset = datasets.Dataset(name=stored, parent='tank/p', mount_point=f'/mnt/{stored}',
+            selected_node='node-a')
+        annotations[CONFIG.dataset_annotation] = json.dumps(dataclasses.asdict(dataset))
+    return {'metadata': {'name': name, 'annotations': annotations}}
+
+
+@pytest.fixture
+def cluster(monkeypatch):
+    monkeypatch.setattr(CONFIG, 'use_agent', True)
+    objects = {
+        'list_persistent_volume': [_obj('pvc-bound')],
+        # The claim's persistent volume is not created yet.
+        'list_persistent_volume_claim_for_all_namespaces': [_obj('claim', stored='pvc-pending')],
+        'list_node': [_obj('node-a'), _obj('node-b')],
+    }
+    inventories = {
+        'node-a': {'tank/p': {'tank/p/pvc-bound', 'tank/p/pvc-pending', 'tank/p/pvc-orphan', 'tank/p/data'}},
+        # The agent of node-b can not tell.
+        'node-b': None,
+    }
+
+    async def list_all(func, **_):
+        return objects[func.__name__]
+
+    async def read_inventory(node_name, parents):
+        assert parents == {'tank/p'}
+        return inventories[node_name]
+
+    monkeypatch.setattr(reconcile, 'list_all', list_all)
+    monkeypatch.setattr(reconcile, 'read_inventory', read_inventory)
+    monkeypatch.setattr(placement.RESOLVER, 'resolve', lambda node_name: (placement.Candidate('tank/p'),))
+
+
+def test_find_orphans(cluster):
+    orphans = asyncio.run(sweeper.Sweeper().find_orphans(FakeV1()))
+    # Datasets that do not look like ours are left alone.
+    assert orphans == {('node-a', 'tank/p/pvc-orphan'): 'tank/p'}
+
+
+def test_find_orphans_needs_agents(cluster, monkeypatch):
+    monkeypatch.setattr(CONFIG, 'use_agent', False)
+    assert asyncio.run(sweeper.Sweeper().find_orphans(FakeV1())) is None
+
+
+def test_sweep_datasets_after_grace_period(monkeypatch):
+    monkeypatch.setattr(CONFIG, 'orphan_grace_period', 600)
+    monkeypatch.setattr(CONFIG, 'orphan_reclaim_policy', 'Delete')
+    now = [1000.0]
+    monkeypatch.setattr(sweeper.time, 'monotonic', lambda: now[0])
+    instance = sweeper.Sweeper()
+    orphans = {}
+    deleted = []
+
+    async def find_orphans(v1):
+        return dict(orphans)
+
+    async def delete(kind, name, delete):
+        deleted.append(name)
+
+    monkeypatch.setattr(instance, 'find_orphans', find_orphans)
+    monkeypatch.setattr(instance, '_delete', delete)
+
+    def sweep(at, *names):
+        now[0] = at
+        orphans.clear()
+        orphans.update({('node-a', f'tank/p/{name}'): 'tank/p' for name in names})
+        asyncio.run(instance.sweep_datasets(FakeV1()))
+
+    sweep(1000, 'pvc-a', 'pvc-b')
+    sweep(1300, 'pvc-a')
+    assert deleted == []
+    # pvc-b was in use in between, its grace period starts over.
+    sweep(1700, 'pvc-a', 'pvc-b')
+    assert deleted == ['node-a:tank/p/pvc-a']
+
+    monkeypatch.setattr(CONFIG, 'orphan_reclaim_policy', 'Retain')
+    sweep(2500, 'pvc-a', 'pvc-b')
+    assert deleted == ['node-a:tank/p/pvc-a']
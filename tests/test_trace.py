@@ -0,0 +1,60 @@
+import json
+
+import pytest
+
+from zfs_provisioner import trace
+
+
+def _span(span_id, name, start, end, parent_id=None, trace_id='t1', **attributes):
+    return trace.Span(trace_id=trace_id, span_id=span_id, parent_id=parent_id, name=name,
+        start=start, end=end, attributes=attributes)
+
+
+def test_context_round_trip():
+    context = trace.Context('0af7651916cd43dd8448eb211c80319c', 'b7ad6b7169203331')
+    assert trace.Context.parse(context.format()) == context
+    assert trace.Context.parse('not a context') is None
+    assert trace.Context.parse(None) is None
+
+
+@pytest.mark.parametrize('percent, expected', [(0, 1), (50, 5), (90, 9), (99, 10), (100, 10)])
+def test_percentile(percent, expected):
+    assert trace.percentile(list(range(10, 0, -1)), percent) == expected
+
+
+def test_percentile_of_nothing():
+    assert trace.percentile([], 50) is None
+
+
+def test_read_spans():
+    span = _span('s1', 'create', 0.0, 1.0)
+    lines = [
+        json.dumps(span.to_dict()),
+        f'2024-01-01T00:00:00Z {trace.LOG_PREFIX}{json.dumps(span.to_dict())}',
+        # Spans that have not ended and other lines are skipped.
+        json.dumps(_span('s2', 'create', 0.0, None).to_dict()),
+        'Created dataset',
+        '{broken',
+    ]
+    assert trace.read_spans(lines) == [span, span]
+
+
+def test_summarize():
+    spans = [
+        _span('a', 'create', 0.0, 4.0, claim='default/a'),
+        _span('a1', 'pod', 1.0, 3.0, parent_id='a'),
+        _span('a2', 'zfs', 1.5, 2.5, parent_id='a1'),
+        _span('b', 'create', 0.0, 2.0, trace_id='t2', claim='default/b'),
+        _span('b1', 'pod', 0.5, 1.0, parent_id='b', trace_id='t2'),
+        _span('c', 'delete', 0.0, 9.0, trace_id='t3'),
+    ]
+    spans[-2].error = 'Pod failed'
+    summary = trace.summarize(spans, name='create', slowest=1)
+    assert summary['traces'] == 2
+    assert list(summary['stages']) == ['create', 'create/pod', 'create/pod/zfs']
+    assert summary['stages']['create/pod'] == {
+        'count': 2, 'errors': 1, 'mean': 1.25, 'p50': 0.5, 'p90': 2.0, 'p99': 2.0, 'max': 2.0,
+    }
+    assert [root['trace_id'] for root in summary['slowest']] == ['t1']
+    assert summary['slowest'][0]['stages'] == {'create': 4.0, 'create/pod': 2.0, 'create/pod/zfs': 1.0}
+    assert trace.summarize(spans)['traces'] == 3
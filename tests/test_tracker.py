@@ -0,0 +1,112 @@
+import asyncio
+import types
+
+import pytest
+
+from zfs_provisioner.tracker import PodGoneError, PodTracker
+
+
+def _pod(uid, phase, name=None):
+    return {
+        'metadata': {
+            'uid': uid,
+            'name': name or f'pod-{uid}',
+            'namespace': 'kube-system',
+            'creationTimestamp': '2024-01-01T00:00:00Z',
+        },
+        'status': {
+            'phase': phase,
+            'conditions': [
+                {'type': 'PodScheduled', 'status': 'True', 'lastTransitionTime': '2024-01-01T00:00:01Z'},
+            ],
+            'containerStatuses': [
+                {'state': {'terminated': {
+                    'startedAt': '2024-01-01T00:00:03Z',
+                    'finishedAt': '2024-01-01T00:00:04Z',
+                }}},
+            ],
+        },
+    }
+
+
+class FakeCoreV1:
+    """Lists the given pods like CoreV1Api.
+    """
+    def __init__(self, pods):
+        self.pods = pods
+        self.api_client = types.SimpleNamespace(sanitize_for_serialization=lambda item: item)
+
+    async def list_namespaced_pod(self, namespace, label_selector):
+        return types.SimpleNamespace(items=self.pods)
+
+    async def list_pod_for_all_namespaces(self, label_selector):
+        return types.SimpleNamespace(items=self.pods)
+
+
+def test_wait_for_finished_pod():
+    async def main():
+        tracker = PodTracker('app=test')
+        waiting = asyncio.create_task(tracker.wait('a', timeout=1))
+        await asyncio.sleep(0)
+        tracker.update(_pod('a', 'Running'))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        tracker.update(_pod('a', 'Succeeded'))
+        result = await waiting
+        assert result.succeeded
+        assert result.timings == {'scheduled': 1.0, 'running': 2.0, 'finished': 1.0}
+        assert not tracker.waiters
+
+    asyncio.run(main())
+
+
+def test_pod_finished_before_wait():
+    async def main():
+        tracker = PodTracker('app=test')
+        tracker.update(_pod('a', 'Failed'))
+        result = await tracker.wait('a', timeout=1)
+        assert result.phase == 'Failed'
+        assert not tracker.finished
+
+    asyncio.run(main())
+
+
+def test_wait_times_out():
+    async def main():
+        tracker = PodTracker('app=test')
+        with pytest.raises(asyncio.TimeoutError):
+            await tracker.wait('a', timeout=0.01)
+        assert not tracker.waiters
+
+    asyncio.run(main())
+
+
+def test_deleted_pod():
+    async def main():
+        tracker = PodTracker('app=test')
+        waiting = asyncio.create_task(tracker.wait('a', timeout=1))
+        await asyncio.sleep(0)
+        tracker.update(_pod('a', 'Running'), deleted=True)
+        with pytest.raises(PodGoneError):
+            await waiting
+        # A result nobody waited for is dropped with the pod.
+        tracker.update(_pod('b', 'Succeeded'))
+        tracker.update(_pod('b', 'Succeeded'), deleted=True)
+        assert not tracker.finished
+
+    asyncio.run(main())
+
+
+def test_resync_finds_missed_pods():
+    async def main():
+        tracker = PodTracker('app=test')
+        v1 = FakeCoreV1([_pod('a', 'Succeeded'), _pod('b', 'Running'), _pod('c', 'Failed')])
+        waiting = asyncio.create_task(tracker.wait('a', timeout=1))
+        await asyncio.sleep(0)
+        await tracker.resync(v1, namespace='kube-system')
+        assert (await waiting).succeeded
+        assert list(tracker.finished) == ['c']
+        await tracker.resync(v1)
+        assert sorted(tracker.finished) == ['a', 'c']
+
+    asyncio.run(main())
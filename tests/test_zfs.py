@@ -0,0 +1,149 @@
+import asyncio
+import errno
+import os
+
+import pytest
+
+from zfs_provisioner import aiozfs
+from zfs_provisioner import zfs
+
+
+class ProgramBackend(zfs.MemoryBackend):
+    """Memory backend that runs the destroy channel program,
+    or fails to if `fail` is set.
+    """
+    channel_programs = True
+
+    def __init__(self, fail=False):
+        super().__init__()
+        self.fail = fail
+        self.programs = []
+
+    def run_program(self, pool, program, args):
+        self.programs.append(list(args))
+        if self.fail:
+            raise zfs.ZfsCommandError(f'Failed to run channel program on pool "{pool}"')
+        results = {}
+        for dataset in args:
+            try:
+                self.destroy(dataset, ())
+                results[dataset] = 0
+            except zfs.ZfsCommandError as e:
+                results[dataset] = errno.EBUSY if e.reason == 'busy' else errno.ENOENT
+        return results
+
+
+@pytest.fixture
+def inventory(monkeypatch):
+    inventory = zfs.Inventory()
+    monkeypatch.setattr(zfs, 'INVENTORY', inventory)
+    monkeypatch.setattr(aiozfs, 'INVENTORY', inventory)
+    return inventory
+
+
+def _use(monkeypatch, backend, datasets=()):
+    monkeypatch.setattr(zfs, 'BACKEND', backend)
+    for dataset in datasets:
+        backend.create(dataset, ['-p'], {})
+    return backend
+
+
+def test_inventory_tracks_changes():
+    inventory = zfs.Inventory(properties=('type', 'refquota'))
+    assert inventory.exists('tank/p/a') is None
+    inventory.update_rows('tank/p', [
+        ['tank/p', 'filesystem', '0'],
+        ['tank/p/a', 'filesystem', '1073741824'],
+    ])
+    assert inventory.is_fresh('tank/p', 60)
+    assert not inventory.is_fresh('other/p', 60)
+    assert inventory.exists('tank/p/a')
+    # Covered by a loaded root, so known not to exist.
+    assert inventory.exists('tank/p/b') is False
+    assert inventory.exists('other/p/a') is None
+    assert inventory.get('tank/p/a', 'refquota') == {'refquota': '1073741824'}
+    assert inventory.get('tank/p/a', 'refquota', 'mountpoint') is None
+
+    inventory.added('tank/p/b', type='filesystem')
+    assert inventory.exists('tank/p/b')
+    assert inventory.get('tank/p/b', 'refquota') is None
+    inventory.changed('tank/p/b', refquota=5)
+    assert inventory.get('tank/p/b', 'type', 'refquota') == {'type': 'filesystem', 'refquota': '5'}
+    inventory.added('other/p/a', type='filesystem')
+    assert inventory.exists('other/p/a') is None
+
+    inventory.removed('tank/p')
+    assert inventory.exists('tank/p/a') is False
+    assert inventory.exists('tank/p/b') is False
+
+
+def test_load_inventory(monkeypatch, inventory):
+    _use(monkeypatch, zfs.MemoryBackend(), ['tank/p/a'])
+    asyncio.run(aiozfs.load_inventory('tank/p'))
+    asyncio.run(aiozfs.load_inventory('tank/missing'))
+    assert inventory.exists('tank/p/a')
+    assert inventory.exists('tank/p/b') is False
+    assert inventory.exists('tank/missing/a') is False
+
+
+def test_destroy_many_one_by_one(monkeypatch, inventory):
+    backend = _use(monkeypatch, zfs.MemoryBackend(), ['tank/p/a', 'tank/p/b', 'tank/p/busy/child'])
+    results = asyncio.run(aiozfs.destroy_many(['tank/p/a', 'tank/p/b', 'tank/p/gone', 'tank/p/busy']))
+    assert results['tank/p/a'] is None
+    assert results['tank/p/b'] is None
+    # Datasets that are gone count as destroyed.
+    assert results['tank/p/gone'] is None
+    assert 'has children' in results['tank/p/busy']
+    assert sorted(backend.datasets) == ['tank/p', 'tank/p/busy', 'tank/p/busy/child']
+
+
+def test_destroy_many_runs_channel_program_per_pool(monkeypatch, inventory):
+    backend = _use(monkeypatch, ProgramBackend(), ['tank/p/a', 'tank/p/b', 'other/p/a', 'tank/p/busy/child'])
+    results = asyncio.run(aiozfs.destroy_many(['tank/p/a', 'tank/p/b', 'tank/p/gone', 'other/p/a',
+        'tank/p/busy']))
+    assert sorted(backend.programs) == [['other/p/a'], ['tank/p/a', 'tank/p/b', 'tank/p/busy']]
+    assert {k:v for k,v in results.items() if v is not None} == {
+        'tank/p/busy': f'Failed to destroy dataset "tank/p/busy": {os.strerror(errno.EBUSY)}',
+    }
+    assert sorted(backend.datasets) == ['other/p', 'tank/p', 'tank/p/busy', 'tank/p/busy/child']
+
+
+def test_destroy_many_falls_back_if_channel_program_fails(monkeypatch, inventory):
+    backend = _use(monkeypatch, ProgramBackend(fail=True), ['tank/p/a', 'tank/p/b'])
+    results = asyncio.run(aiozfs.destroy_many(['tank/p/a', 'tank/p/b']))
+    assert backend.programs == [['tank/p/a', 'tank/p/b']]
+    assert results == {'tank/p/a': None, 'tank/p/b': None}
+    assert sorted(backend.datasets) == ['tank/p']
+
+
+def test_parse_snapshots():
+    assert zfs._parse_snapshots([
+        ['tank/p/a@s1', '-', 'off'],
+        ['tank/p/a@s2', 'tank/p/b,tank/p/c', 'on'],
+    ]) == {
+        'tank/p/a@s1': {'clones': [], 'defer_destroy': False},
+        'tank/p/a@s2': {'clones': ['tank/p/b', 'tank/p/c'], 'defer_destroy': True},
+    }
+
+
+def test_parse_capacity():
+    result = zfs._parse_capacity('tank/p', [
+        ['tank/p', '1000', '200', '0', '-'],
+        ['tank/p/a', '10', '50', '100', '-'],
+        ['tank/p/b', '20', '80', '-', '300'],
+        # Grandchildren are part of their parent's refquota.
+        ['tank/p/b/c', '5', '5', '999', '-'],
+    ])
+    assert (result['available'], result['used'], result['committed']) == (1000, 200, 400)
+
+
+def test_parse_children():
+    assert zfs._parse_children('tank/p', ('type', 'refquota'), [
+        ['tank/p', 'filesystem', '0'],
+        ['tank/p/a', 'filesystem', '100'],
+        ['tank/p/b', 'volume', '-'],
+        ['tank/p/b/c', 'filesystem', '0'],
+    ]) == {
+        'tank/p/a': {'type': 'filesystem', 'refquota': '100'},
+        'tank/p/b': {'type': 'volume', 'refquota': '-'},
+    }
@@ -0,0 +1,232 @@
+import asyncio
+import collections
+import functools
+import hashlib
+import hmac
+import json
+import logging
+import secrets
+import time
+
+from typing import Dict
+
+import aiohttp
+import kubernetes_asyncio
+
+from aiohttp import web
+
+log = logging.getLogger('zfs-provisioner')
+
+from . import Error
+from . import kube
+from . import node
+from . import trace
+
+
+SIGNATURE_HEADER = 'X-Zfs-Provisioner-Signature'
+
+# Maximum age in seconds of a signed request.
+MAX_CLOCK_SKEW = 60
+
+ACTIONS = {
+    'create': node.create_dataset,
+    'destroy': node.destroy_dataset,
+    'resize': node.resize_dataset,
+    'snapshot': node.create_snapshot,
+    'destroy_snapshot': node.destroy_snapshot,
+    'batch': node.run_batch,
+    'list': node.list_datasets,
+}
+
+
+class AgentError(Error):
+    """Error reported by or while talking to a node agent.
+    """
+    pass
+
+
+class AgentUnavailableError(AgentError):
+    """The node agent could not be reached.
+    """
+    pass
+
+
+def sign(token, timestamp, nonce, method, path, body):
+    """Return the HMAC signature for the given request parts.
+    """
+    message = b'\n'.join([
+        str(timestamp).encode('utf-8'),
+        nonce.encode('utf-8'),
+        method.encode('utf-8'),
+        path.encode('utf-8'),
+        body,
+    ])
+    return hmac.new(token.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+class Nonces:
+    """Remember the nonces of signed requests for as long as their
+    timestamp is accepted so that requests can not be replayed.
+    """
+    def __init__(self, max_age=2 * MAX_CLOCK_SKEW):
+        self.max_age = max_age
+        # Maps nonces to when they were first seen, oldest first.
+        self.seen: collections.OrderedDict = collections.OrderedDict()
+
+    def add(self, nonce) -> bool:
+        """Remember nonce, return False if it has been seen before.
+        """
+        now = time.monotonic()
+        while self.seen and now - next(iter(self.seen.values())) > self.max_age:
+            self.seen.popitem(last=False)
+        if nonce in self.seen:
+            return False
+        self.seen[nonce] = now
+        return True
+
+
+def verify(token, header, method, path, body, nonces=None):
+    """Verify a `timestamp:nonce:signature` header against the given
+    request parts. With nonces, also reject nonces that have been used.
+    """
+    try:
+        timestamp, nonce, signature = header.split(':', 2)
+        timestamp = int(timestamp)
+    except (AttributeError, ValueError):
+        return False
+    if abs(time.time() - timestamp) > MAX_CLOCK_SKEW:
+        return False
+    expected = sign(token, timestamp, nonce, method, path, body)
+    if not hmac.compare_digest(expected, signature):
+        return False
+    return nonces is None or nonces.add(nonce)
+
+
+# Server side, runs on the nodes.
+
+@web.middleware
+async def authenticate(request, handler):
+    body = await request.read()
+    header = request.headers.get(SIGNATURE_HEADER)
+    if not verify(request.app['token'], header, request.method, request.path, body,
+            request.app['nonces']):
+        log.warning('agent: rejecting unauthenticated request from %s', request.remote)
+        return web.json_response({'error': 'Unauthorized'}, status=401)
+    return await handler(request)
+
+
+async def handle_action(request):
+    action = request.match_info['action']
+    try:
+        func = ACTIONS[action]
+    except KeyError:
+        return web.json_response({'error': f'Unknown action: {action}'}, status=404)
+
+    try:
+        payload = json.loads(await request.read())
+        call = functools.partial(func, **payload)
+    except (ValueError, TypeError) as e:
+        return web.json_response({'error': f'Invalid request: {e}'}, status=400)
+
+    log.info('agent: %s: %s', action, payload)
+    # Return the spans of traced requests to the controller.
+    with trace.collect(request.headers.get(trace.TRACE_HEADER)) as spans:
+        try:
+            with trace.span('agent', action=action):
+                result = await call()
+        except (Error, OSError, TypeError, KeyError) as e:
+            log.error('agent: %s failed: %s', action, e)
+            return web.json_response({'error': str(e), 'spans': spans}, status=500)
+    return web.json_response({'action': action, 'result': result, 'spans': spans})
+
+
+def create_app(token):
+    app = web.Application(middlewares=[authenticate])
+    app['token'] = token
+    app['nonces'] = Nonces()
+    app.router.add_post('/v1/datasets/{action}', handle_action)
+    return app
+
+
+async def serve(host, port, token):
+    """Serve the agent until cancelled.
+    """
+    runner = web.AppRunner(create_app(token))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    log.info('agent: listening on %s:%s', host, port)
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await runner.cleanup()
+
+
+# Client side, used by the controller.
+
+_session = None
+_node_addresses: Dict[str, str] = {}
+
+
+async def _get_node_address(node_name):
+    """Return the internal IP address of the given node.
+    """
+    try:
+        return _node_addresses[node_name]
+    except KeyError:
+        pass
+    v1 = kubernetes_asyncio.client.CoreV1Api(kube.get_api_client())
+    obj = await v1.read_node(node_name)
+    for address in obj.status.addresses or []:
+        if address.type == 'InternalIP':
+            _node_addresses[node_name] = address.address
+            return address.address
+    raise AgentUnavailableError(f'Node "{node_name}" has no InternalIP address')
+
+
+async def call(node_name, action, port, token, timeout, **payload):
+    """Ask the agent on the given node to perform action.
+
+    Raise AgentUnavailableError if the agent can not be reached, in
+    which case the caller is free to fall back to another mechanism.
+    """
+    global _session
+    if _session is None:
+        _session = aiohttp.ClientSession()
+
+    address = await _get_node_address(node_name)
+    path = f'/v1/datasets/{action}'
+    body = json.dumps(payload).encode('utf-8')
+    timestamp = int(time.time())
+    nonce = secrets.token_hex(16)
+    headers = {
+        'Content-Type': 'application/json',
+        SIGNATURE_HEADER: f'{timestamp}:{nonce}:{sign(token, timestamp, nonce, "POST", path, body)}',
+    }
+    if trace.current():
+        headers[trace.TRACE_HEADER] = trace.format_contexts()
+    url = f'http://{address}:{port}{path}'
+    log.debug('agent.call: %s %s', url, payload)
+    try:
+        async with _session.post(url, data=body, headers=headers,
+                timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            result = await response.json()
+    except aiohttp.ClientConnectorError as e:
+        # Forget the address in case the node got a new one.
+        _node_addresses.pop(node_name, None)
+        raise AgentUnavailableError(f'Agent on node "{node_name}" is not reachable: {e}') from e
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise AgentError(f'Agent on node "{node_name}" failed to {action}: {e}') from e
+
+    trace.import_spans(result.get('spans') or [])
+    if response.status != 200:
+        raise AgentError(f'Agent on node "{node_name}" failed to {action}: {result.get("error")}')
+    return result
+
+
+async def close():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
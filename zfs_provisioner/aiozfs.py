@@ -0,0 +1,361 @@
+import asyncio
+import json
+import logging
+
+from typing import Dict, List, Optional
+
+log = logging.getLogger('zfs-provisioner')
+
+from . import metrics
+from . import trace
+from . import zfs
+from .zfs import INVENTORY, ZfsCommandError
+
+
+# Maximum number of zfs commands running at once.
+CONCURRENCY = 4
+# Seconds after which a zfs command is killed.
+TIMEOUT = 60
+
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def configure(concurrency=None, timeout=None):
+    global CONCURRENCY, TIMEOUT, _semaphore
+    if concurrency is not None:
+        CONCURRENCY = concurrency
+        _semaphore = None
+    if timeout is not None:
+        TIMEOUT = timeout
+
+
+def _get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(CONCURRENCY)
+    return _semaphore
+
+
+async def run(cmd, message, timeout=None):
+    """Run the given zfs command and return its output.
+
+    Raise ZfsCommandError with message if the command fails
+    or does not finish within timeout seconds.
+    """
+    timeout = timeout or TIMEOUT
+    async with _get_semaphore():
+        log.debug('aiozfs.run: %s', cmd)
+        with metrics.ZFS_COMMAND_DURATION.labels(cmd[1]).time(), trace.span(f'zfs_{cmd[1]}'):
+            try:
+                process = await asyncio.create_subprocess_exec(*cmd,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                )
+            except OSError as e:
+                raise ZfsCommandError(f'{message} running command: {cmd}: {e}', cmd=cmd) from e
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                raise ZfsCommandError(f'{message} running command: {cmd}: timed out after {timeout}s',
+                    cmd=cmd, reason='timeout') from None
+            except asyncio.CancelledError:
+                process.kill()
+                raise
+    if process.returncode:
+        stderr = stderr.decode('utf-8', 'replace').strip()
+        raise ZfsCommandError(f'{message} running command: {cmd}: {stderr}',
+            cmd=cmd, returncode=process.returncode, stderr=stderr)
+    return stdout.decode('utf-8')
+
+
+class CommandBackend:
+    """Runs the commands of zfs.CliBackend without blocking the event loop.
+    """
+    name = zfs.CliBackend.name
+    channel_programs = True
+
+    async def list(self, root, properties):
+        return zfs._parse_rows(await run(*zfs._list_cmd(root, properties)))
+
+    async def exists(self, dataset):
+        try:
+            await run(*zfs._exists_cmd(dataset))
+        except ZfsCommandError as e:
+            if e.reason == 'not_found':
+                return False
+            raise
+        return True
+
+    async def create(self, dataset, args, properties):
+        await run(*zfs._create_cmd(dataset, args, properties))
+
+    async def destroy(self, dataset, args):
+        await run(*zfs._destroy_cmd(dataset, args))
+
+    async def set_properties(self, dataset, properties):
+        await run(*zfs._set_cmd(dataset, properties))
+
+    async def get_properties(self, dataset, keys):
+        return zfs._parse_properties(await run(*zfs._get_cmd(dataset, keys)))
+
+    async def unmount(self, dataset):
+        try:
+            await run(*zfs._unmount_cmd(dataset))
+        except ZfsCommandError as e:
+            if e.reason != 'not_mounted':
+                raise
+
+    async def snapshot(self, snapshot):
+        await run(*zfs._snapshot_cmd(snapshot))
+
+    async def clone(self, snapshot, dataset, properties):
+        await run(*zfs._clone_cmd(snapshot, dataset, properties))
+
+    async def list_snapshots(self, root):
+        return zfs._parse_rows(await run(*zfs._list_snapshots_cmd(root)))
+
+    async def run_program(self, pool, program, args):
+        with zfs._program_file(program) as path:
+            output = await run(*zfs._program_cmd(pool, path, args))
+        return json.loads(output)['return']
+
+
+class ThreadBackend:
+    """Runs the methods of a zfs.Backend that does not use the command
+    line tool in worker threads, at most CONCURRENCY of them at once.
+    """
+    def __init__(self, backend: zfs.Backend):
+        self.backend = backend
+        self.name = backend.name
+        self.channel_programs = backend.channel_programs
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+
+        async def call(*args):
+            async with _get_semaphore():
+                return await asyncio.to_thread(method, *args)
+        return call
+
+
+def get_backend():
+    """Return the awaitable counterpart of zfs.BACKEND.
+    """
+    if zfs.BACKEND.name == zfs.CliBackend.name:
+        return CommandBackend()
+    return ThreadBackend(zfs.BACKEND)
+
+
+async def load_inventory(root, max_age=0):
+    """Load root and all its descendants into zfs.INVENTORY
+    unless that has been done less than max_age seconds ago.
+    """
+    if INVENTORY.is_fresh(root, max_age):
+        return
+    try:
+        rows = await get_backend().list(root, INVENTORY.properties)
+    except ZfsCommandError as e:
+        if e.reason != 'not_found':
+            raise
+        rows = []
+    INVENTORY.update_rows(root, rows)
+
+
+async def matches(dataset, **properties):
+    """Return whether the existing dataset has the given properties.
+    """
+    return zfs._same_properties(properties, await get_backend().get_properties(dataset, tuple(properties)))
+
+
+async def create(dataset, *args, **properties):
+    """Create the given dataset with the given properties.
+
+    A dataset that exists already with these properties, e.g. created
+    by an earlier attempt that timed out, counts as created.
+    """
+    properties = {k:v for k,v in properties.items() if v is not None}
+    try:
+        await get_backend().create(dataset, args, properties)
+    except ZfsCommandError as e:
+        if e.reason != 'exists' or not await matches(dataset, **zfs._created_properties(args, properties)):
+            log.error(e)
+            raise
+        log.info('aiozfs.create: %s exists already', dataset)
+    INVENTORY.added(dataset, type='volume' if '-V' in args else 'filesystem', origin='-', **properties)
+
+
+async def ensure(dataset, *args, **properties):
+    """Ensure the given dataset exists
+    with the given properties.
+    """
+    exists = INVENTORY.exists(dataset)
+    if exists is None:
+        exists = await get_backend().exists(dataset)
+    elif exists:
+        current = INVENTORY.get(dataset, *properties.keys())
+        if current is not None:
+            properties = {k:v for k,v in properties.items() if current[k] != str(v)}
+
+    if not exists:
+        await create(dataset, *args, **properties)
+    elif properties:
+        await set_properties(dataset, **properties)
+
+
+async def destroy(dataset, *args):
+    """Destroy the given dataset.
+    """
+    try:
+        await get_backend().destroy(dataset, args)
+    except ZfsCommandError as e:
+        log.error(e)
+        raise
+    INVENTORY.removed(dataset)
+
+
+async def unmount(dataset):
+    """Unmount the given dataset.
+    """
+    await get_backend().unmount(dataset)
+
+
+async def set_properties(dataset, **properties):
+    """Set the given properties on the given dataset.
+    """
+    await get_backend().set_properties(dataset, properties)
+    INVENTORY.changed(dataset, **properties)
+
+
+async def get_properties(dataset, *keys):
+    """Get the current properties of the given dataset.
+    """
+    properties = INVENTORY.get(dataset, *keys)
+    if properties is not None:
+        return properties
+    properties = await get_backend().get_properties(dataset, keys)
+    INVENTORY.changed(dataset, **properties)
+    return properties
+
+
+async def snapshot(snapshot):
+    """Create the given snapshot, e.g. pool/dataset@name.
+    """
+    await get_backend().snapshot(snapshot)
+
+
+async def clone(snapshot, dataset, **properties):
+    """Create dataset as a clone of snapshot with the given properties.
+
+    Like for create, an existing clone of snapshot with these properties counts as created.
+    """
+    properties = {k:v for k,v in properties.items() if v is not None}
+    try:
+        await get_backend().clone(snapshot, dataset, properties)
+    except ZfsCommandError as e:
+        if e.reason != 'exists' or not await matches(dataset, origin=snapshot, **properties):
+            raise
+        log.info('aiozfs.clone: %s exists already', dataset)
+    # Clones have the type of their origin, leave it unknown if that is.
+    origin = INVENTORY.get(snapshot.split('@', 1)[0], 'type') or {}
+    INVENTORY.added(dataset, origin=snapshot, **origin, **properties)
+
+
+async def snapshots(root):
+    """Return a dict that maps the names of all snapshots of root and
+    its descendants to dicts with their `clones` and whether they
+    are marked for deferred destruction (`defer_destroy`).
+    """
+    return zfs._parse_snapshots(await get_backend().list_snapshots(root))
+
+
+async def capacity(root):
+    """Return the `available` and `used` bytes of root, the bytes
+    `committed` to its children, the sum of their refquotas and volsizes,
+    and the number of its children as `datasets`.
+    """
+    return zfs._parse_capacity(root, await get_backend().list(root, zfs.CAPACITY_PROPERTIES))
+
+
+async def children(root, *keys):
+    """Return a dict that maps the names of the filesystems and
+    volumes directly below root to dicts of the given properties.
+    """
+    return zfs._parse_children(root, keys, await get_backend().list(root, keys))
+
+
+async def run_program(pool, program, *args):
+    """Run the given lua channel program against pool
+    and return what it returned.
+    """
+    return await get_backend().run_program(pool, program, args)
+
+
+async def _error(coro):
+    try:
+        await coro
+        return None
+    except ZfsCommandError as e:
+        return e
+
+
+async def _result(coro):
+    error = await _error(coro)
+    return None if error is None else str(error)
+
+
+async def create_many(datasets, *args):
+    """Create the given datasets in parallel.
+
+    `datasets` maps dataset names to dicts of properties.
+    Return a dict that maps each dataset name to None on success
+    or to an error message.
+
+    There is no channel program equivalent of `zfs create`,
+    so datasets are created individually.
+    """
+    names = list(datasets)
+    errors = await asyncio.gather(*[
+        _result(create(dataset, *args, **datasets[dataset])) for dataset in names])
+    return dict(zip(names, errors))
+
+
+async def destroy_many(datasets: List[str]) -> Dict[str, Optional[str]]:
+    """Destroy the given datasets.
+
+    Datasets are unmounted in parallel and then destroyed in one transaction
+    group per pool using a channel program. Falls back to destroying them in
+    parallel if channel programs fail or the backend does not support them.
+    Datasets the backend reports as not existing count as destroyed, the
+    inventory is not trusted for that as it may be outdated.
+    Return a dict that maps each dataset name to None on success
+    or to an error message.
+    """
+    backend = get_backend()
+    results = {}
+    for pool, pool_datasets in zfs._group_by_pool(datasets).items():
+        errors = await asyncio.gather(*[_error(unmount(d)) for d in pool_datasets])
+        remaining = []
+        for dataset, error in zip(pool_datasets, errors):
+            if error is None:
+                remaining.append(dataset)
+            else:
+                results[dataset] = zfs._destroy_result(dataset, error)
+        if not remaining:
+            continue
+
+        returned = None
+        if backend.channel_programs:
+            try:
+                returned = await run_program(pool, zfs.DESTROY_PROGRAM, *remaining)
+            except (ZfsCommandError, ValueError, KeyError) as e:
+                log.warning('aiozfs.destroy_many: channel program failed, destroying one by one: %s', e)
+        if returned is None:
+            errors = await asyncio.gather(*[_error(destroy(d)) for d in remaining])
+            for dataset, error in zip(remaining, errors):
+                results[dataset] = None if error is None else zfs._destroy_result(dataset, error)
+        else:
+            for dataset in remaining:
+                results[dataset] = zfs._destroy_result(dataset, returned.get(dataset))
+    return results
@@ -0,0 +1,711 @@
+import asyncio
+import collections
+import dataclasses
+import datetime
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+log = logging.getLogger('zfs-provisioner')
+
+from . import node
+from . import zfs
+from .trace import percentile
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+
+
+@dataclasses.dataclass(frozen=True)
+class Resource:
+    group: str
+    version: str
+    plural: str
+    kind: str
+    namespaced: bool
+
+    @property
+    def api_version(self):
+        return f'{self.group}/{self.version}' if self.group else self.version
+
+
+RESOURCES = [
+    Resource('', 'v1', 'pods', 'Pod', True),
+    Resource('', 'v1', 'persistentvolumeclaims', 'PersistentVolumeClaim', True),
+    Resource('', 'v1', 'persistentvolumes', 'PersistentVolume', False),
+    Resource('', 'v1', 'nodes', 'Node', False),
+    Resource('', 'v1', 'namespaces', 'Namespace', False),
+    Resource('', 'v1', 'events', 'Event', True),
+    Resource('storage.k8s.io', 'v1', 'storageclasses', 'StorageClass', False),
+    Resource('events.k8s.io', 'v1', 'events', 'Event', True),
+    # kopf watches these to discover resources.
+    Resource('apiextensions.k8s.io', 'v1', 'customresourcedefinitions', 'CustomResourceDefinition', False),
+]
+
+
+class ApiError(Exception):
+    def __init__(self, status, reason, message):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+        self.message = message
+
+    def response(self):
+        return web.json_response({
+            'kind': 'Status',
+            'apiVersion': 'v1',
+            'status': 'Failure',
+            'reason': self.reason,
+            'message': self.message,
+            'code': self.status,
+        }, status=self.status)
+
+
+def _parse_selector(selector):
+    """Parse a label or field selector into (key, operator, value) tuples.
+    """
+    requirements = []
+    for part in (selector or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '!=' in part:
+            key, value = part.split('!=', 1)
+            requirements.append((key, '!=', value))
+        elif '==' in part:
+            key, value = part.split('==', 1)
+            requirements.append((key, '=', value))
+        elif '=' in part:
+            key, value = part.split('=', 1)
+            requirements.append((key, '=', value))
+        elif part.startswith('!'):
+            requirements.append((part[1:], '!', None))
+        else:
+            requirements.append((part, 'exists', None))
+    return requirements
+
+
+def _matches(values, requirements):
+    for key, operator, value in requirements:
+        if operator == 'exists' and key not in values:
+            return False
+        if operator == '!' and key in values:
+            return False
+        if operator == '=' and values.get(key) != value:
+            return False
+        if operator == '!=' and values.get(key) == value:
+            return False
+    return True
+
+
+def _field(obj, path):
+    for key in path.split('.'):
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(key)
+    return obj
+
+
+def _matches_fields(obj, requirements):
+    values = {key: _field(obj, key) for key, operator, value in requirements}
+    return _matches({k:v for k,v in values.items() if v is not None}, requirements)
+
+
+def _merge_patch(target, patch):
+    """Apply a json merge patch (RFC 7386).
+    """
+    if not isinstance(patch, dict):
+        return patch
+    if not isinstance(target, dict):
+        target = {}
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = _merge_patch(target.get(key), value)
+    return target
+
+
+def _json_patch(target, operations):
+    """Apply a json patch (RFC 6902), supports add, remove, replace and test.
+    """
+    for operation in operations:
+        keys = [k.replace('~1', '/').replace('~0', '~') for k in operation['path'].split('/')[1:]]
+        parent = target
+        for key in keys[:-1]:
+            parent = parent[int(key)] if isinstance(parent, list) else parent.setdefault(key, {})
+        key = keys[-1]
+        op = operation['op']
+        if isinstance(parent, list):
+            index = len(parent) if key == '-' else int(key)
+            if op == 'add':
+                parent.insert(index, operation['value'])
+            elif op == 'remove':
+                del parent[index]
+            elif op == 'replace':
+                parent[index] = operation['value']
+            elif op == 'test' and parent[index] != operation['value']:
+                raise ApiError(422, 'Invalid', f'test failed for {operation["path"]}')
+        else:
+            if op in ('add', 'replace'):
+                parent[key] = operation['value']
+            elif op == 'remove':
+                parent.pop(key, None)
+            elif op == 'test' and parent.get(key) != operation['value']:
+                raise ApiError(422, 'Invalid', f'test failed for {operation["path"]}')
+    return target
+
+
+class FakeZfs:
+    """Executes the arguments of dataset pods with the node
+    functions against the in memory zfs backend.
+    """
+    def __init__(self):
+        self.backend = zfs.use_backend('memory')
+
+    async def run(self, args, env):
+        """Run the given `dataset` command arguments.
+        Return whether it succeeded and the termination message.
+        """
+        action = args[1]
+        if action == 'batch':
+            items = json.loads(env['ZFS_PROVISIONER_MANIFEST'])
+            results = await node.run_batch(items)
+            return all(error is None for error in results), json.dumps(results)
+
+        item = {'action': action.replace('-', '_')}
+        positional = []
+        rest = iter(args[2:])
+        for arg in rest:
+            if arg == '--property':
+                k, v = next(rest).split('=', 1)
+                item.setdefault('properties', {})[k] = v
+            elif arg == '--sparse':
+                item['sparse'] = True
+            elif arg.startswith('--'):
+                item[arg[2:]] = next(rest)
+            else:
+                positional.append(arg)
+        item.update(zip(('dataset', 'mountpoint'), positional))
+        error = (await node.run_batch([item]))[0]
+        return error is None, error or ''
+
+    def count(self, parent):
+        """Return the number of datasets below parent.
+        """
+        return len([name for name in self.backend.datasets if name.startswith(parent + '/')])
+
+
+class FakeCluster:
+    """A minimal in memory kubernetes api server.
+
+    Supports discovery, list, watch, get, create, patch and delete
+    for the resources in RESOURCES. Dataset pods go through their
+    lifecycle with configurable delays and are executed against a
+    FakeZfs. Persistent volumes are bound to their claims like the
+    kubernetes persistent volume controller would do.
+    """
+    def __init__(self, scheduling_delay=0.05, start_delay=0.1, run_delay=0.05):
+        self.scheduling_delay = scheduling_delay
+        self.start_delay = start_delay
+        self.run_delay = run_delay
+        self.zfs = FakeZfs()
+        self.objects: Dict[Resource, Dict] = {resource: {} for resource in RESOURCES}
+        self.resource_version = 0
+        self.history: List = []
+        self.watchers: List = []
+        self.api_calls = collections.Counter()
+        # Maps (namespace, name) of claims to the time they got bound/removed.
+        self.bound: Dict = {}
+        self.removed: Dict = {}
+        self.tasks = set()
+
+    def get_resource(self, group, version, plural):
+        for resource in RESOURCES:
+            if (resource.group, resource.version, resource.plural) == (group, version, plural):
+                return resource
+        raise ApiError(404, 'NotFound', f'the server could not find the requested resource {plural}')
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def _notify(self, resource, event_type, obj):
+        self.resource_version += 1
+        obj['metadata']['resourceVersion'] = str(self.resource_version)
+        event = (self.resource_version, resource, event_type, json.loads(json.dumps(obj)))
+        self.history.append(event)
+        for watcher in self.watchers:
+            watcher.put(event)
+        self._on_change(resource, event_type, obj)
+
+    # Storage
+
+    def create(self, resource, namespace, body):
+        body = json.loads(json.dumps(body))
+        metadata = body.setdefault('metadata', {})
+        if 'generateName' in metadata and not metadata.get('name'):
+            metadata['name'] = metadata['generateName'] + uuid.uuid4().hex[:5]
+        name = metadata.get('name')
+        if not name:
+            raise ApiError(422, 'Invalid', 'metadata.name is required')
+        key = (namespace if resource.namespaced else None, name)
+        if key in self.objects[resource]:
+            raise ApiError(409, 'AlreadyExists', f'{resource.plural} "{name}" already exists')
+        body['kind'] = resource.kind
+        body['apiVersion'] = resource.api_version
+        if resource.namespaced:
+            metadata['namespace'] = namespace
+        metadata['uid'] = str(uuid.uuid4())
+        metadata['creationTimestamp'] = _now()
+        self.objects[resource][key] = body
+        self._notify(resource, 'ADDED', body)
+        return body
+
+    def get(self, resource, namespace, name):
+        try:
+            return self.objects[resource][(namespace if resource.namespaced else None, name)]
+        except KeyError:
+            raise ApiError(404, 'NotFound', f'{resource.plural} "{name}" not found') from None
+
+    def list(self, resource, namespace=None, label_selector=None, field_selector=None):
+        labels = _parse_selector(label_selector)
+        fields = _parse_selector(field_selector)
+        items = []
+        for (obj_namespace, name), obj in self.objects[resource].items():
+            if namespace and obj_namespace != namespace:
+                continue
+            if not _matches(obj['metadata'].get('labels') or {}, labels):
+                continue
+            if not _matches_fields(obj, fields):
+                continue
+            items.append(obj)
+        return items
+
+    def patch(self, resource, namespace, name, patch, content_type='application/merge-patch+json'):
+        obj = self.get(resource, namespace, name)
+        if 'json-patch' in content_type:
+            _json_patch(obj, patch)
+        else:
+            _merge_patch(obj, patch)
+        if obj['metadata'].get('deletionTimestamp') and not obj['metadata'].get('finalizers'):
+            return self._remove(resource, namespace, name)
+        self._notify(resource, 'MODIFIED', obj)
+        return obj
+
+    def update(self, resource, namespace, name, mutate):
+        obj = self.get(resource, namespace, name)
+        mutate(obj)
+        self._notify(resource, 'MODIFIED', obj)
+        return obj
+
+    def delete(self, resource, namespace, name, uid=None):
+        obj = self.get(resource, namespace, name)
+        if uid and obj['metadata']['uid'] != uid:
+            raise ApiError(409, 'Conflict', f'Precondition failed: UID in precondition: {uid}')
+        if obj['metadata'].get('finalizers'):
+            if not obj['metadata'].get('deletionTimestamp'):
+                obj['metadata']['deletionTimestamp'] = _now()
+                self._notify(resource, 'MODIFIED', obj)
+            return obj
+        return self._remove(resource, namespace, name)
+
+    def _remove(self, resource, namespace, name):
+        obj = self.objects[resource].pop((namespace if resource.namespaced else None, name))
+        self._notify(resource, 'DELETED', obj)
+        return obj
+
+    # Simulation of the rest of the cluster.
+
+    def _on_change(self, resource, event_type, obj):
+        if resource.plural == 'pods' and event_type == 'ADDED':
+            self._spawn(self._run_pod(obj['metadata']['namespace'], obj['metadata']['name'],
+                obj['metadata']['uid']))
+        elif resource.plural == 'persistentvolumes' and event_type == 'ADDED':
+            self._bind(obj)
+        elif resource.plural == 'persistentvolumeclaims' and event_type == 'DELETED':
+            self.removed[(obj['metadata']['namespace'], obj['metadata']['name'])] = time.monotonic()
+
+    def _bind(self, pv):
+        claim_ref = pv['spec'].get('claimRef') or {}
+        pvcs = self.get_resource('', 'v1', 'persistentvolumeclaims')
+        key = (claim_ref.get('namespace'), claim_ref.get('name'))
+        if key not in self.objects[pvcs]:
+            return
+
+        def bind(pvc):
+            pvc['spec']['volumeName'] = pv['metadata']['name']
+            pvc.setdefault('status', {})['phase'] = 'Bound'
+            pvc['status']['capacity'] = dict(pv['spec'].get('capacity') or {})
+        self.update(pvcs, key[0], key[1], bind)
+        self.bound[key] = time.monotonic()
+
+    async def _run_pod(self, namespace, name, uid):
+        pods = self.get_resource('', 'v1', 'pods')
+
+        def alive():
+            obj = self.objects[pods].get((namespace, name))
+            return obj is not None and obj['metadata']['uid'] == uid
+
+        await asyncio.sleep(self.scheduling_delay)
+        if not alive():
+            return
+        scheduled = _now()
+
+        def schedule(pod):
+            pod['status'] = {
+                'phase': 'Pending',
+                'conditions': [{'type': 'PodScheduled', 'status': 'True', 'lastTransitionTime': scheduled}],
+            }
+        self.update(pods, namespace, name, schedule)
+
+        await asyncio.sleep(self.start_delay)
+        if not alive():
+            return
+        started = _now()
+
+        container = self.objects[pods][(namespace, name)]['spec']['containers'][0]
+        container_status = {
+            'name': container['name'],
+            'image': container['image'],
+            'imageID': '',
+            'ready': True,
+            'restartCount': 0,
+        }
+
+        def start(pod):
+            pod['status']['phase'] = 'Running'
+            pod['status']['containerStatuses'] = [dict(container_status, state={
+                'running': {'startedAt': started},
+            })]
+        self.update(pods, namespace, name, start)
+
+        await asyncio.sleep(self.run_delay)
+        if not alive():
+            return
+        env = {e['name']: e.get('value') for e in container.get('env') or []}
+        succeeded, message = await self.zfs.run(container.get('args') or [], env)
+
+        def finish(pod):
+            pod['status']['phase'] = 'Succeeded' if succeeded else 'Failed'
+            pod['status']['containerStatuses'] = [dict(container_status, ready=False, state={
+                'terminated': {
+                    'exitCode': 0 if succeeded else 1,
+                    'startedAt': started,
+                    'finishedAt': _now(),
+                    'message': message,
+                },
+            })]
+        self.update(pods, namespace, name, finish)
+
+    # HTTP api
+
+    def _discovery(self, group, version):
+        resources = [{
+            'name': r.plural,
+            'singularName': r.kind.lower(),
+            'namespaced': r.namespaced,
+            'kind': r.kind,
+            'verbs': ['create', 'delete', 'get', 'list', 'patch', 'watch'],
+        } for r in RESOURCES if (r.group, r.version) == (group, version)]
+        return {'kind': 'APIResourceList', 'groupVersion': f'{group}/{version}' if group else version,
+            'resources': resources}
+
+    async def handle(self, request):
+        try:
+            return await self._handle(request)
+        except ApiError as e:
+            return e.response()
+
+    async def _handle(self, request):
+        parts = [p for p in request.path.split('/') if p]
+        if parts == ['version']:
+            return web.json_response({'major': '1', 'minor': '30', 'gitVersion': 'v1.30.0-fake'})
+        if parts == ['api']:
+            return web.json_response({'kind': 'APIVersions', 'versions': ['v1']})
+        if parts == ['apis']:
+            groups = sorted({r.group for r in RESOURCES if r.group})
+            return web.json_response({'kind': 'APIGroupList', 'apiVersion': 'v1', 'groups': [{
+                'name': group,
+                'versions': [{'groupVersion': f'{group}/v1', 'version': 'v1'}],
+                'preferredVersion': {'groupVersion': f'{group}/v1', 'version': 'v1'},
+            } for group in groups]})
+
+        if parts[:1] == ['api'] and len(parts) >= 2:
+            group, version, rest = '', parts[1], parts[2:]
+        elif parts[:1] == ['apis'] and len(parts) >= 3:
+            group, version, rest = parts[1], parts[2], parts[3:]
+        else:
+            raise ApiError(404, 'NotFound', f'Not found: {request.path}')
+
+        if not rest:
+            return web.json_response(self._discovery(group, version))
+
+        namespace = None
+        if rest[0] == 'namespaces' and len(rest) >= 3:
+            namespace, rest = rest[1], rest[2:]
+        resource = self.get_resource(group, version, rest[0])
+        name = rest[1] if len(rest) > 1 else None
+        subresource = rest[2] if len(rest) > 2 else None
+        query = request.query
+
+        if request.method == 'GET' and name is None:
+            if query.get('watch', '').lower() in ('true', '1'):
+                self.api_calls[f'watch {resource.plural}'] += 1
+                return await self._watch(request, resource, namespace)
+            self.api_calls[f'list {resource.plural}'] += 1
+            items = self.list(resource, namespace, query.get('labelSelector'), query.get('fieldSelector'))
+            return web.json_response({
+                'kind': f'{resource.kind}List',
+                'apiVersion': resource.api_version,
+                'metadata': {'resourceVersion': str(self.resource_version)},
+                'items': items,
+            })
+
+        if request.method == 'GET' and subresource == 'log':
+            self.api_calls[f'get {resource.plural}/log'] += 1
+            obj = self.get(resource, namespace, name)
+            return web.Response(text=json.dumps(obj.get('status', {})))
+
+        verb = {'GET': 'get', 'POST': 'create', 'PATCH': 'patch', 'DELETE': 'delete'}.get(request.method)
+        self.api_calls[f'{verb} {resource.plural}'] += 1
+        if verb == 'get':
+            return web.json_response(self.get(resource, namespace, name))
+        elif verb == 'create':
+            return web.json_response(self.create(resource, namespace, await request.json()), status=201)
+        elif verb == 'patch':
+            return web.json_response(self.patch(resource, namespace, name, await request.json(),
+                request.headers.get('Content-Type', '')))
+        elif verb == 'delete':
+            uid = None
+            if request.can_read_body:
+                body = await request.json()
+                uid = ((body or {}).get('preconditions') or {}).get('uid')
+            return web.json_response(self.delete(resource, namespace, name, uid))
+        raise ApiError(405, 'MethodNotAllowed', f'{request.method} is not supported')
+
+    async def _watch(self, request, resource, namespace):
+        labels = _parse_selector(request.query.get('labelSelector'))
+        fields = _parse_selector(request.query.get('fieldSelector'))
+        since = int(request.query.get('resourceVersion') or 0)
+        timeout = float(request.query.get('timeoutSeconds') or 3600)
+        queue = asyncio.Queue()
+
+        def put(event):
+            resource_version, event_resource, event_type, obj = event
+            if event_resource != resource:
+                return
+            if namespace and obj['metadata'].get('namespace') != namespace:
+                return
+            if not _matches(obj['metadata'].get('labels') or {}, labels):
+                return
+            if not _matches_fields(obj, fields):
+                return
+            queue.put_nowait({'type': event_type, 'object': obj})
+
+        watcher = collections.namedtuple('Watcher', 'put')(put)
+        response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+        await response.prepare(request)
+        for event in self.history:
+            if event[0] > since:
+                put(event)
+        self.watchers.append(watcher)
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                await response.write(json.dumps(event).encode('utf-8') + b'\n')
+        except (ConnectionResetError, asyncio.CancelledError):
+            pass
+        finally:
+            self.watchers.remove(watcher)
+        return response
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application(client_max_size=2**24)
+        app.router.add_route('*', '/{tail:.*}', self.handle)
+        self.runner = web.AppRunner(app, handle_signals=False)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f'http://{host}:{port}'
+        return self.url
+
+    async def stop(self):
+        for task in list(self.tasks):
+            task.cancel()
+        await self.runner.cleanup()
+
+
+def _write_kubeconfig(url):
+    config = {
+        'apiVersion': 'v1',
+        'kind': 'Config',
+        'clusters': [{'name': 'bench', 'cluster': {'server': url}}],
+        'users': [{'name': 'bench', 'user': {'token': 'bench'}}],
+        'contexts': [{'name': 'bench', 'context': {'cluster': 'bench', 'user': 'bench'}}],
+        'current-context': 'bench',
+    }
+    f = tempfile.NamedTemporaryFile(mode='w', suffix='.kubeconfig', delete=False)
+    with f:
+        json.dump(config, f)
+    return f.name
+
+
+def _summarize(started, finished, wall):
+    latencies = [finished[k] - started[k] for k in finished if k in started]
+    return {
+        'completed': len(latencies),
+        'seconds': round(wall, 3),
+        'throughput': round(len(latencies) / wall, 3) if wall else None,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'max': max(latencies) if latencies else None,
+    }
+
+
+async def _wait_for(condition, timeout, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(interval)
+    return True
+
+
+async def run(nodes=4, pvcs_per_node=10, scheduling_delay=0.05, start_delay=0.1,
+        run_delay=0.05, timeout=300, **controller_options):
+    """Run the kopf handlers against a FakeCluster, create and then
+    delete nodes * pvcs_per_node claims and return the results as a dict.
+    """
+    import kopf
+    from . import handlers
+
+    cluster = FakeCluster(scheduling_delay, start_delay, run_delay)
+    url = await cluster.start()
+    kubeconfig = _write_kubeconfig(url)
+    os.environ['KUBECONFIG'] = kubeconfig
+
+    provisioner_name = 'bench/zfs-provisioner'
+    parent_dataset = 'bench/zfs-provisioner'
+    mount_dir = tempfile.TemporaryDirectory(prefix='zfs-provisioner-bench-')
+    handlers.configure(
+        provisioner_name=provisioner_name,
+        parent_dataset=parent_dataset,
+        dataset_mount_dir=mount_dir.name,
+        container_image='zfs-provisioner:bench',
+        **controller_options,
+    )
+
+    node_names = [f'node-{i}' for i in range(nodes)]
+    for node_name in node_names:
+        cluster.create(cluster.get_resource('', 'v1', 'nodes'), None, {
+            'metadata': {'name': node_name, 'labels': {'kubernetes.io/hostname': node_name}},
+            'status': {'addresses': [{'type': 'InternalIP', 'address': '127.0.0.1'}]},
+        })
+    storage_class_name = 'bench-zfs'
+    cluster.create(cluster.get_resource('storage.k8s.io', 'v1', 'storageclasses'), None, {
+        'metadata': {'name': storage_class_name},
+        'provisioner': provisioner_name,
+        'volumeBindingMode': 'WaitForFirstConsumer',
+        'reclaimPolicy': 'Delete',
+        'parameters': {'mode': 'local'},
+    })
+
+    # Only the benchmark process sees this, the controller itself
+    # relies on kopf's default login.
+    @kopf.on.login()
+    def login(**_):
+        return kopf.ConnectionInfo(server=url, token='bench')
+
+    stop_flag = asyncio.Event()
+    ready_flag = asyncio.Event()
+    operator = asyncio.create_task(kopf.operator(
+        standalone=True,
+        clusterwide=True,
+        stop_flag=stop_flag,
+        ready_flag=ready_flag,
+    ))
+    results = {
+        'nodes': nodes,
+        'pvcs_per_node': pvcs_per_node,
+        'pvcs': nodes * pvcs_per_node,
+        'scheduling_delay': scheduling_delay,
+        'start_delay': start_delay,
+        'run_delay': run_delay,
+    }
+    try:
+        ready = asyncio.create_task(ready_flag.wait())
+        await asyncio.wait([ready, operator], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if not ready.done():
+            ready.cancel()
+            raise RuntimeError('The controller did not start')
+        await _wait_for(lambda: storage_class_name in handlers.CONFIG.storage_classes, timeout)
+
+        pvcs = cluster.get_resource('', 'v1', 'persistentvolumeclaims')
+        keys = [('bench', f'{node_name}-pvc-{i}') for node_name in node_names for i in range(pvcs_per_node)]
+
+        # Create phase.
+        calls_before = collections.Counter(cluster.api_calls)
+        started = {}
+        begin = time.monotonic()
+        for namespace, name in keys:
+            node_name = name.rsplit('-pvc-', 1)[0]
+            started[(namespace, name)] = time.monotonic()
+            cluster.create(pvcs, namespace, {
+                'metadata': {
+                    'name': name,
+                    'annotations': {'volume.kubernetes.io/selected-node': node_name},
+                },
+                'spec': {
+                    'storageClassName': storage_class_name,
+                    'accessModes': ['ReadWriteOnce'],
+                    'volumeMode': 'Filesystem',
+                    'resources': {'requests': {'storage': '1Gi'}},
+                },
+                'status': {'phase': 'Pending'},
+            })
+        await _wait_for(lambda: len(cluster.bound) >= len(keys), timeout)
+        results['create'] = _summarize(started, cluster.bound, time.monotonic() - begin)
+        results['create']['api_calls'] = dict(cluster.api_calls - calls_before)
+
+        # Delete phase.
+        calls_before = collections.Counter(cluster.api_calls)
+        started = {}
+        begin = time.monotonic()
+        for namespace, name in keys:
+            started[(namespace, name)] = time.monotonic()
+            cluster.delete(pvcs, namespace, name)
+        await _wait_for(lambda: len(cluster.removed) >= len(keys), timeout)
+        results['delete'] = _summarize(started, cluster.removed, time.monotonic() - begin)
+        results['delete']['api_calls'] = dict(cluster.api_calls - calls_before)
+
+        results['datasets_left'] = cluster.zfs.count(parent_dataset)
+        results['persistent_volumes_left'] = len(cluster.objects[
+            cluster.get_resource('', 'v1', 'persistentvolumes')])
+    finally:
+        stop_flag.set()
+        try:
+            await asyncio.wait_for(operator, 30)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            operator.cancel()
+        await cluster.stop()
+        os.unlink(kubeconfig)
+        mount_dir.cleanup()
+    return results
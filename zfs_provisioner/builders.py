@@ -0,0 +1,142 @@
+import logging
+
+from typing import Dict
+
+import yaml
+
+log = logging.getLogger('zfs-provisioner')
+
+from . import Error
+from . import get_template
+
+
+class TemplateError(Error):
+    """Error that happened while loading an object template.
+    """
+    pass
+
+
+def _copy(data):
+    """Copy a structure of dicts and lists as loaded from yaml.
+    Much cheaper than copy.deepcopy.
+    """
+    if isinstance(data, dict):
+        return {k:_copy(v) for k,v in data.items()}
+    elif isinstance(data, list):
+        return [_copy(v) for v in data]
+    return data
+
+
+def _find_named(items, name):
+    for item in items:
+        if item.get('name') == name:
+            return item
+    item = {'name': name}
+    items.append(item)
+    return item
+
+
+class Builder:
+    """Builds kubernetes objects from a template that is parsed only once.
+    """
+    kind: str = None
+
+    def __init__(self, text: str):
+        try:
+            template = yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise TemplateError(f'Invalid {self.kind} template: {e}') from e
+        if not isinstance(template, dict) or template.get('kind') != self.kind:
+            raise TemplateError(f'Template is not a {self.kind}')
+        self.validate(template)
+        self.template: Dict = template
+
+    def validate(self, template):
+        pass
+
+    def new(self):
+        return _copy(self.template)
+
+
+class PodBuilder(Builder):
+    """Builds the pods that manage datasets on the nodes.
+    """
+    kind = 'Pod'
+
+    def validate(self, template):
+        try:
+            template['spec']['containers'][0]
+        except (KeyError, IndexError, TypeError) as e:
+            raise TemplateError('Pod template needs at least one container') from e
+
+    def build(self, pod_name, node_name, image, dataset_mount_dir, pod_args, log_level):
+        data = self.new()
+        data.setdefault('metadata', {})['name'] = pod_name
+        spec = data['spec']
+        spec['nodeName'] = node_name
+
+        container = spec['containers'][0]
+        container['name'] = pod_name
+        container['image'] = image
+        container['args'] = pod_args
+        env = _find_named(container.setdefault('env', []), 'ZFS_PROVISIONER_LOG_LEVEL')
+        env['value'] = log_level
+
+        mount = _find_named(container.setdefault('volumeMounts', []), 'dataset-mount-dir')
+        mount['mountPath'] = dataset_mount_dir
+        volume = _find_named(spec.setdefault('volumes', []), 'dataset-mount-dir')
+        volume.setdefault('hostPath', {})['path'] = dataset_mount_dir
+        return data
+
+
+class PersistentVolumeBuilder(Builder):
+    """Builds the persistent volumes for the provisioned datasets.
+    """
+    kind = 'PersistentVolume'
+
+    def build(self, provisioner_name, pv_name, access_mode, storage, pvc_name,
+            pvc_namespace, local_path, selected_node_name, storage_class_name,
+            volume_mode, reclaim_policy):
+        data = self.new()
+        metadata = data.setdefault('metadata', {})
+        metadata['name'] = pv_name
+        metadata.setdefault('annotations', {})['pv.kubernetes.io/provisioned-by'] = provisioner_name
+
+        spec = data.setdefault('spec', {})
+        spec['accessModes'] = [access_mode]
+        spec['capacity'] = {'storage': storage}
+        claim_ref = spec.setdefault('claimRef', {})
+        claim_ref.update({
+            'apiVersion': 'v1',
+            'kind': 'PersistentVolumeClaim',
+            'name': pvc_name,
+            'namespace': pvc_namespace,
+        })
+        spec['local'] = {'path': local_path}
+        spec['nodeAffinity'] = {'required': {'nodeSelectorTerms': [{'matchExpressions': [{
+            'key': 'kubernetes.io/hostname',
+            'operator': 'In',
+            'values': [selected_node_name],
+        }]}]}}
+        spec['persistentVolumeReclaimPolicy'] = reclaim_policy
+        spec['storageClassName'] = storage_class_name
+        spec['volumeMode'] = volume_mode
+        return data
+
+
+POD_BUILDER = PodBuilder(get_template('dataset-pod.yaml'))
+PV_BUILDER = PersistentVolumeBuilder(get_template('pvc.yaml'))
+
+
+def load_pod_template(text):
+    """Replace the pod template, keep the current one if text is invalid.
+    """
+    global POD_BUILDER
+    POD_BUILDER = PodBuilder(text)
+
+
+def load_pv_template(text):
+    """Replace the persistent volume template, keep the current one if text is invalid.
+    """
+    global PV_BUILDER
+    PV_BUILDER = PersistentVolumeBuilder(text)
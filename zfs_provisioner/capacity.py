@@ -0,0 +1,157 @@
+import asyncio
+import dataclasses
+import json
+import logging
+import time
+
+from typing import Dict, Optional
+
+import kubernetes_asyncio
+
+log = logging.getLogger('zfs-provisioner')
+
+from . import aiozfs
+from . import kube
+from . import zfs
+
+
+# Node annotation the agents publish the capacity of their parent datasets in.
+ANNOTATION = 'zfs-provisioner/capacity'
+
+
+@dataclasses.dataclass
+class Capacity:
+    """Space of a parent dataset as reported by the agent on its node.
+    """
+    available: int
+    used: int
+    # Sum of the refquotas and volsizes of the datasets below it.
+    committed: int
+    # Number of datasets below it.
+    datasets: int = 0
+
+    @property
+    def size(self):
+        return self.available + self.used
+
+    def room(self, overcommit=1.0):
+        """Return the bytes that can still be committed when overcommit
+        times the size of the parent dataset may be committed.
+        """
+        return self.size * overcommit - self.committed
+
+    def fits(self, size, overcommit=1.0):
+        """Return whether a dataset of size bytes fits without committing
+        more than overcommit times the size of the parent dataset.
+        """
+        return size <= self.room(overcommit)
+
+
+# Node side, runs in the agent.
+
+async def read(datasets):
+    """Return a dict that maps the given parent datasets to their Capacity.
+    Datasets that do not exist (yet) are left out.
+    """
+    result = {}
+    for dataset in datasets:
+        try:
+            result[dataset] = Capacity(**await aiozfs.capacity(dataset))
+        except zfs.ZfsCommandError as e:
+            if e.reason != 'not_found':
+                raise
+    return result
+
+
+async def publish(node_name, datasets, interval):
+    """Publish the capacity of the given parent datasets in the
+    ANNOTATION of the given node every interval seconds until cancelled.
+    """
+    await kube.load_config()
+    await kube.open_api_client()
+    v1 = kubernetes_asyncio.client.CoreV1Api(kube.get_api_client())
+    log.info('capacity: publishing %s every %ss', ', '.join(datasets), interval)
+    try:
+        while True:
+            try:
+                report = {
+                    'timestamp': int(time.time()),
+                    'datasets': {k:dataclasses.asdict(v) for k,v in (await read(datasets)).items()},
+                }
+                log.debug('capacity.publish: %s', report)
+                await v1.patch_node(node_name,
+                    {'metadata': {'annotations': {ANNOTATION: json.dumps(report)}}})
+            except (zfs.ZfsCommandError, kubernetes_asyncio.client.rest.ApiException) as e:
+                log.warning('capacity: failed to publish: %s', e)
+            await asyncio.sleep(interval)
+    finally:
+        await kube.close_api_client()
+
+
+# Controller side.
+
+class CapacityCache:
+    """The capacity reports of all nodes, kept up to date from their
+    annotations and from the datasets created since the last report.
+    """
+    def __init__(self):
+        # Maps node names to the time of their report and their parent datasets' Capacity.
+        self.reports: Dict[str, tuple] = {}
+
+    def update(self, node_name, annotation):
+        try:
+            report = json.loads(annotation)
+            self.reports[node_name] = (report['timestamp'],
+                {k:Capacity(**v) for k,v in report['datasets'].items()})
+        except (TypeError, ValueError, KeyError) as e:
+            log.warning('capacity: ignoring invalid report of node %s: %s', node_name, e)
+            self.reports.pop(node_name, None)
+
+    def remove(self, node_name):
+        self.reports.pop(node_name, None)
+
+    def get(self, node_name, dataset, max_age) -> Optional[Capacity]:
+        """Return the Capacity of dataset on the given node or
+        None if it has not been reported within max_age seconds.
+        """
+        timestamp, capacities = self.reports.get(node_name, (0, {}))
+        if time.time() - timestamp > max_age:
+            return None
+        return capacities.get(dataset)
+
+    def fits(self, node_name, dataset, size, max_age, overcommit) -> Optional[bool]:
+        """Return whether a dataset of size bytes fits below dataset
+        on the given node or None if that is not known.
+        """
+        capacity = self.get(node_name, dataset, max_age)
+        if capacity is None:
+            return None
+        return capacity.fits(size, overcommit)
+
+    def commit(self, node_name, dataset, size, datasets=1):
+        """Account for a dataset of size bytes created below dataset
+        until the node reports again. Negative values undo that.
+        """
+        timestamp, capacities = self.reports.get(node_name, (0, {}))
+        if dataset in capacities:
+            capacities[dataset].committed += size
+            capacities[dataset].datasets += datasets
+
+    def pick(self, parents, size, max_age, overcommit) -> Optional[str]:
+        """Return the node with the most uncommitted space left after adding
+        a dataset of size bytes, or None if it fits on no node.
+
+        parents maps the node names to consider to their parent dataset.
+        """
+        best, best_room = None, None
+        for node_name, dataset in parents.items():
+            capacity = self.get(node_name, dataset, max_age)
+            if capacity is None or not capacity.fits(size, overcommit):
+                continue
+            room = capacity.room(overcommit)
+            if best is None or room > best_room:
+                best, best_room = node_name, room
+        return best
+
+
+CACHE = CapacityCache()
@@ -1,17 +1,24 @@
+import asyncio
+import io
+import json
 import logging
-import os
 import sys
 
 import click
 
+from . import node
+from . import trace
 from . import zfs
 
 
 @click.group(name='zfs-provisioner')
 @click.option('--verbose', '-v', 'log_level', flag_value='info', help='set log level to info', envvar='ZFS_PROVISIONER_LOG_LEVEL')
 @click.option('--debug', '-d', 'log_level', flag_value='debug', help='set log level to debug', envvar='ZFS_PROVISIONER_LOG_LEVEL')
+@click.option('--zfs-backend', type=click.Choice(sorted(zfs.BACKENDS)),
+    help='How to talk to zfs, defaults to the zfs command line tool.',
+    envvar='ZFS_PROVISIONER_ZFS_BACKEND')
 @click.pass_context
-def main(ctx, log_level):
+def main(ctx, log_level, zfs_backend):
     """ZFS volume provisoner for kubernetes.
     """
     setattr(ctx, 'obj', {})
@@ -24,13 +31,25 @@ def main(ctx, log_level):
     ctx.obj['log_level'] = log_level
     ctx.obj['log'] = log
 
+    if zfs_backend:
+        zfs.use_backend(zfs_backend)
+
 
 @main.command(name='controller', short_help='start controller')
 @click.option('--provisioner', 'provisioner_name', help='Specify Provisioner name.',
     envvar='PROVISIONER_NAME')
-@click.option('--namespace', help='The namespace the Provisioner is running in.',
+@click.option('--namespace', help='The namespace the Provisioner is running in, dataset pods are run in it too.',
     envvar='NAMESPACE')
+@click.option('--pod-name', help='Name of the Provisioner\'s own pod, its controller owns the dataset pods.',
+    envvar='POD_NAME')
 @click.option('--config', help='Provisioner configuration file.', envvar='CONFIG')
+@click.option('--config-reload-debounce', type=float,
+    help='Seconds to collect changes of the config and template files before reloading them.',
+    envvar='CONFIG_RELOAD_DEBOUNCE')
+@click.option('--pod-template', help='File with a pod template that overrides the default.',
+    envvar='POD_TEMPLATE')
+@click.option('--pv-template', help='File with a persistent volume template that overrides the default.',
+    envvar='PV_TEMPLATE')
 @click.option('--parent-dataset', help='Name of the parent dataset under which to create the datasets.',
     envvar='PARENT_DATASET')
 @click.option('--dataset-mount-dir', help='Directory under which to mount the created persistent volumes.',
@@ -39,34 +58,219 @@ def main(ctx, log_level):
     envvar='CONTAINER_IMAGE')
 @click.option('--node-name', help='The name of the node on which the provisioner is running.',
     envvar='NODE_NAME')
+@click.option('--agent/--no-agent', 'use_agent', default=None,
+    help='Use the node agents to manage datasets, falling back to pods.',
+    envvar='USE_AGENT')
+@click.option('--agent-port', type=int, help='Port the node agents listen on.',
+    envvar='AGENT_PORT')
+@click.option('--agent-token', help='Shared secret used to sign agent requests.',
+    envvar='AGENT_TOKEN')
+@click.option('--api-connection-limit', type=int,
+    help='Maximum number of connections of the provisioner\'s own kubernetes api client.',
+    envvar='API_CONNECTION_LIMIT')
+@click.option('--api-keepalive-timeout', type=float,
+    help='Seconds to keep idle api server connections open.',
+    envvar='API_KEEPALIVE_TIMEOUT')
+@click.option('--api-qps', type=float,
+    help='Maximum requests per second of the provisioner\'s own kubernetes api client, '
+        'kopf\'s watches and patches are not limited, 0 to disable.',
+    envvar='API_QPS')
+@click.option('--api-burst', type=int,
+    help='Maximum burst of kubernetes api requests above --api-qps.',
+    envvar='API_BURST')
+@click.option('--batch-window', type=float,
+    help='Seconds to collect dataset operations per node before running them.',
+    envvar='BATCH_WINDOW')
+@click.option('--batch-max-size', type=int,
+    help='Maximum number of dataset operations to run at once per node.',
+    envvar='BATCH_MAX_SIZE')
+@click.option('--max-concurrent', type=int,
+    help='Maximum number of dataset operations running at once.',
+    envvar='MAX_CONCURRENT')
+@click.option('--max-concurrent-per-node', type=int,
+    help='Maximum number of dataset operations running at once per node.',
+    envvar='MAX_CONCURRENT_PER_NODE')
+@click.option('--priority', 'scheduler_priority', type=click.Choice(['delete', 'create', 'none']),
+    help='Which dataset operations to start first when limited.',
+    envvar='SCHEDULER_PRIORITY')
+@click.option('--pod-timeout', 'pod_timeouts', multiple=True, metavar='ACTION=SECONDS',
+    help='Seconds a dataset pod for ACTION (create, delete, resize, batch) may run '
+        'before it is retried. Can be given multiple times.')
+@click.option('--pod-retries', type=int,
+    help='How often to retry dataset pods that did not finish in time.',
+    envvar='POD_RETRIES')
+@click.option('--pod-poll-interval', type=float,
+    help='Seconds without pod events after which dataset pods are listed instead.',
+    envvar='POD_POLL_INTERVAL')
+@click.option('--metrics-port', type=int,
+    help='Port to serve prometheus metrics on.', envvar='METRICS_PORT')
+@click.option('--pvc-zfs-properties/--no-pvc-zfs-properties', default=None,
+    help='Allow PVC annotations to set zfs properties.',
+    envvar='PVC_ZFS_PROPERTIES')
+@click.option('--pvc-label-selector',
+    help='Only watch the PVCs matching this label selector.',
+    envvar='PVC_LABEL_SELECTOR')
+@click.option('--capacity-overcommit', type=float,
+    help='How many times the size of a parent dataset may be committed to claims.',
+    envvar='CAPACITY_OVERCOMMIT')
+@click.option('--capacity-max-age', type=float,
+    help='Seconds after which capacity reports of nodes are ignored.',
+    envvar='CAPACITY_MAX_AGE')
+@click.option('--sweep-interval', type=float,
+    help='Seconds between sweeps for left over pods and datasets, 0 to disable.',
+    envvar='SWEEP_INTERVAL')
+@click.option('--sweep-rate', type=float,
+    help='Maximum number of deletions per second when sweeping, 0 for no limit.',
+    envvar='SWEEP_RATE')
+@click.option('--sweep-dry-run/--no-sweep-dry-run', default=None,
+    help='Only log what sweeping would delete.',
+    envvar='SWEEP_DRY_RUN')
+@click.option('--failed-pod-ttl', type=float,
+    help='Seconds after which failed dataset pods are deleted.',
+    envvar='FAILED_POD_TTL')
+@click.option('--orphan-grace-period', type=float,
+    help='Seconds datasets must have been unused to count as orphans.',
+    envvar='ORPHAN_GRACE_PERIOD')
+@click.option('--orphan-reclaim-policy', type=click.Choice(['Retain', 'Delete']),
+    help='Whether to keep or delete orphaned datasets.',
+    envvar='ORPHAN_RECLAIM_POLICY')
+@click.option('--shard-identity',
+    help='Name of this replica among the controller replicas that split the claims between them, '
+        'enables sharding.',
+    envvar='SHARD_IDENTITY')
+@click.option('--shard-node-label',
+    help='Node label whose value to split the claims by instead of the node name.',
+    envvar='SHARD_NODE_LABEL')
+@click.option('--shard-lease-duration', type=int,
+    help='Seconds after which replicas that stopped renewing their lease are gone.',
+    envvar='SHARD_LEASE_DURATION')
+@click.option('--trace-file',
+    help='File to append the spans of provisioning and deleting claims to as json lines, - for stdout.',
+    envvar='TRACE_FILE')
+@click.option('--trace-otel/--no-trace-otel', default=None,
+    help='Export the spans to OpenTelemetry as configured by the OTEL_EXPORTER_OTLP_* variables.',
+    envvar='TRACE_OTEL')
 @click.option('--kl', 'set_kopf_log_level', help='also set kopf\'s log level',
     is_flag=True, default=False)
 @click.pass_context
-def controller(ctx, provisioner_name, namespace, config, container_image,
-        node_name, parent_dataset, dataset_mount_dir, set_kopf_log_level):
+def controller(ctx, provisioner_name, namespace, pod_name, config, config_reload_debounce, pod_template,
+        pv_template, container_image, node_name, parent_dataset, dataset_mount_dir, use_agent, agent_port,
+        agent_token, api_connection_limit, api_keepalive_timeout, api_qps, api_burst,
+        batch_window, batch_max_size, max_concurrent, max_concurrent_per_node,
+        scheduler_priority, pod_timeouts, pod_retries, pod_poll_interval, metrics_port,
+        pvc_zfs_properties, pvc_label_selector, capacity_overcommit, capacity_max_age,
+        sweep_interval, sweep_rate, sweep_dry_run, failed_pod_ttl, orphan_grace_period,
+        orphan_reclaim_policy, shard_identity, shard_node_label, shard_lease_duration,
+        trace_file, trace_otel, set_kopf_log_level):
     log = ctx.obj['log']
     log.debug('controller: provisioner_name: %s', provisioner_name)
     log.debug('controller: namespace: %s', namespace)
+    log.debug('controller: pod_name: %s', pod_name)
     log.debug('controller: config: %s', config)
+    log.debug('controller: config_reload_debounce: %s', config_reload_debounce)
+    log.debug('controller: pod_template: %s', pod_template)
+    log.debug('controller: pv_template: %s', pv_template)
     log.debug('controller: container_image: %s', container_image)
     log.debug('controller: node_name: %s', node_name)
     log.debug('controller: parent_dataset: %s', parent_dataset)
     log.debug('controller: dataset_mount_dir: %s', dataset_mount_dir)
+    log.debug('controller: use_agent: %s', use_agent)
+    log.debug('controller: agent_port: %s', agent_port)
+    log.debug('controller: api_connection_limit: %s', api_connection_limit)
+    log.debug('controller: api_keepalive_timeout: %s', api_keepalive_timeout)
+    log.debug('controller: api_qps: %s', api_qps)
+    log.debug('controller: api_burst: %s', api_burst)
+    log.debug('controller: batch_window: %s', batch_window)
+    log.debug('controller: batch_max_size: %s', batch_max_size)
+    log.debug('controller: max_concurrent: %s', max_concurrent)
+    log.debug('controller: max_concurrent_per_node: %s', max_concurrent_per_node)
+    log.debug('controller: scheduler_priority: %s', scheduler_priority)
+    log.debug('controller: pod_timeouts: %s', pod_timeouts)
+    log.debug('controller: pod_retries: %s', pod_retries)
+    log.debug('controller: pod_poll_interval: %s', pod_poll_interval)
+    log.debug('controller: metrics_port: %s', metrics_port)
+    log.debug('controller: pvc_zfs_properties: %s', pvc_zfs_properties)
+    log.debug('controller: pvc_label_selector: %s', pvc_label_selector)
+    log.debug('controller: capacity_overcommit: %s', capacity_overcommit)
+    log.debug('controller: capacity_max_age: %s', capacity_max_age)
+    log.debug('controller: sweep_interval: %s', sweep_interval)
+    log.debug('controller: sweep_rate: %s', sweep_rate)
+    log.debug('controller: sweep_dry_run: %s', sweep_dry_run)
+    log.debug('controller: failed_pod_ttl: %s', failed_pod_ttl)
+    log.debug('controller: orphan_grace_period: %s', orphan_grace_period)
+    log.debug('controller: orphan_reclaim_policy: %s', orphan_reclaim_policy)
+    log.debug('controller: shard_identity: %s', shard_identity)
+    log.debug('controller: shard_node_label: %s', shard_node_label)
+    log.debug('controller: shard_lease_duration: %s', shard_lease_duration)
+    log.debug('controller: trace_file: %s', trace_file)
+    log.debug('controller: trace_otel: %s', trace_otel)
+
+    if use_agent and not agent_token:
+        raise click.UsageError('Using the node agents requires --agent-token.')
 
     if set_kopf_log_level:
         logging.getLogger('kopf').setLevel(log.getEffectiveLevel())
 
     # Import handlers module so they are registered with kopf.
     from . import handlers
+
+    if pod_timeouts:
+        timeouts = dict(handlers.CONFIG.pod_timeouts)
+        for pod_timeout in pod_timeouts:
+            try:
+                action, seconds = pod_timeout.split('=', 1)
+                timeouts[action] = float(seconds)
+            except ValueError:
+                raise click.BadParameter(f'expected ACTION=SECONDS, got: {pod_timeout}',
+                    param_hint='--pod-timeout')
+        pod_timeouts = timeouts
+    else:
+        pod_timeouts = None
+
     # Pass cli options to handlers.
     handlers.configure(
         provisioner_name=provisioner_name,
         namespace=namespace,
+        pod_name=pod_name,
         parent_dataset=parent_dataset,
         config=config,
+        config_reload_debounce=config_reload_debounce,
+        pod_template=pod_template,
+        pv_template=pv_template,
         container_image=container_image,
         node_name=node_name,
         dataset_mount_dir=dataset_mount_dir,
+        use_agent=use_agent,
+        agent_port=agent_port,
+        agent_token=agent_token,
+        api_connection_limit=api_connection_limit,
+        api_keepalive_timeout=api_keepalive_timeout,
+        api_qps=api_qps,
+        api_burst=api_burst,
+        batch_window=batch_window,
+        batch_max_size=batch_max_size,
+        max_concurrent=max_concurrent,
+        max_concurrent_per_node=max_concurrent_per_node,
+        scheduler_priority=scheduler_priority,
+        pod_timeouts=pod_timeouts,
+        pod_retries=pod_retries,
+        pod_poll_interval=pod_poll_interval,
+        metrics_port=metrics_port,
+        pvc_zfs_properties=pvc_zfs_properties,
+        pvc_label_selector=pvc_label_selector,
+        capacity_overcommit=capacity_overcommit,
+        capacity_max_age=capacity_max_age,
+        sweep_interval=sweep_interval,
+        sweep_rate=sweep_rate,
+        sweep_dry_run=sweep_dry_run,
+        failed_pod_ttl=failed_pod_ttl,
+        orphan_grace_period=orphan_grace_period,
+        orphan_reclaim_policy=orphan_reclaim_policy,
+        shard_identity=shard_identity,
+        shard_node_label=shard_node_label,
+        shard_lease_duration=shard_lease_duration,
+        trace_file=trace_file,
+        trace_otel=trace_otel,
     )
 
     log.info('Starting controller ...')
@@ -74,57 +278,354 @@ def controller(ctx, provisioner_name, namespace, config, container_image,
     running.run()
 
 
+@main.command(name='agent', short_help='start node agent')
+@click.option('--host', default='0.0.0.0', help='Address to listen on.',
+    envvar='AGENT_HOST')
+@click.option('--port', type=int, default=8471, help='Port to listen on.',
+    envvar='AGENT_PORT')
+@click.option('--token', help='Shared secret used to verify requests.',
+    envvar='AGENT_TOKEN')
+@click.option('--zfs-concurrency', type=int, default=4,
+    help='Maximum number of zfs commands running at once.', envvar='ZFS_CONCURRENCY')
+@click.option('--zfs-timeout', type=float, default=60,
+    help='Seconds after which a zfs command is killed.', envvar='ZFS_TIMEOUT')
+@click.option('--metrics-port', type=int, default=0,
+    help='Port to serve prometheus metrics on.', envvar='METRICS_PORT')
+@click.option('--node-name', help='Name of the node the agent runs on.',
+    envvar='NODE_NAME')
+@click.option('--capacity-dataset', 'capacity_datasets', multiple=True,
+    help='Parent dataset whose capacity to publish in a node annotation, can be given multiple times.',
+    envvar='CAPACITY_DATASETS')
+@click.option('--capacity-interval', type=float, default=60,
+    help='Seconds between capacity reports.', envvar='CAPACITY_INTERVAL')
+@click.pass_context
+def agent(ctx, host, port, token, zfs_concurrency, zfs_timeout, metrics_port,
+        node_name, capacity_datasets, capacity_interval):
+    """Run a long lived agent that manages datasets on this node
+    on behalf of the controller.
+
+    With --capacity-dataset the agent also reports the capacity of
+    the given parent datasets so that the controller only creates
+    datasets where they fit.
+    """
+    log = ctx.obj['log']
+    log.debug('%s: host: %s, port: %s', ctx.info_name, host, port)
+    log.debug('%s: node_name: %s', ctx.info_name, node_name)
+    log.debug('%s: capacity_datasets: %s', ctx.info_name, capacity_datasets)
+
+    if not token:
+        raise click.UsageError('An agent token is required, see --token.')
+    if capacity_datasets and not node_name:
+        raise click.UsageError('Publishing the capacity requires --node-name.')
+
+    from . import aiozfs
+    from . import capacity
+    from .agent import serve
+    from .metrics import serve as serve_metrics
+    aiozfs.configure(concurrency=zfs_concurrency, timeout=zfs_timeout)
+    serve_metrics(metrics_port)
+
+    async def run():
+        tasks = [serve(host, port, token)]
+        if capacity_datasets:
+            tasks.append(capacity.publish(node_name, capacity_datasets, capacity_interval))
+        await asyncio.gather(*tasks)
+
+    log.info('Starting agent ...')
+    asyncio.run(run())
+
+
+@main.command(name='bench', short_help='benchmark the controller')
+@click.option('--nodes', type=int, default=4, help='Number of simulated nodes.')
+@click.option('--pvcs-per-node', type=int, default=10,
+    help='Number of persistent volume claims to create per node.')
+@click.option('--scheduling-delay', type=float, default=0.05,
+    help='Seconds until a dataset pod is scheduled.')
+@click.option('--start-delay', type=float, default=0.1,
+    help='Seconds from scheduling until a dataset pod is running, e.g. image pull.')
+@click.option('--run-delay', type=float, default=0.05,
+    help='Seconds a dataset pod runs.')
+@click.option('--timeout', type=float, default=300,
+    help='Seconds to wait for all claims to be bound or deleted.')
+@click.option('--batch-window', type=float,
+    help='Seconds to collect dataset operations per node before running them.')
+@click.option('--batch-max-size', type=int,
+    help='Maximum number of dataset operations to run at once per node.')
+@click.option('--max-concurrent-per-node', type=int,
+    help='Maximum number of dataset operations running at once per node.')
+@click.option('--api-qps', type=float,
+    help='Maximum kubernetes api requests per second, 0 to disable.')
+@click.option('--output', '-o', type=click.File('w'), default='-',
+    help='File to write the json results to.')
+@click.option('--trace-file',
+    help='File to append the spans of the claims to as json lines.')
+@click.option('--kl', 'set_kopf_log_level', help='also set kopf\'s log level',
+    is_flag=True, default=False)
+@click.pass_context
+def bench(ctx, nodes, pvcs_per_node, scheduling_delay, start_delay, run_delay, timeout,
+        batch_window, batch_max_size, max_concurrent_per_node, api_qps, output,
+        trace_file, set_kopf_log_level):
+    """Run the controller against an in memory fake kubernetes api
+    with simulated nodes and dataset pods, create and delete
+    NODES * PVCS_PER_NODE claims and report throughput, latency
+    percentiles and the number of api calls as json.
+    """
+    log = ctx.obj['log']
+    log.debug('%s: %s', ctx.info_name, ctx.params)
+
+    logging.getLogger('kopf').setLevel(
+        log.getEffectiveLevel() if set_kopf_log_level else logging.WARNING)
+
+    from . import bench
+    results = asyncio.run(bench.run(
+        nodes=nodes,
+        pvcs_per_node=pvcs_per_node,
+        scheduling_delay=scheduling_delay,
+        start_delay=start_delay,
+        run_delay=run_delay,
+        timeout=timeout,
+        batch_window=batch_window,
+        batch_max_size=batch_max_size,
+        max_concurrent_per_node=max_concurrent_per_node,
+        api_qps=api_qps,
+        trace_file=trace_file,
+    ))
+    json.dump(results, output, indent=2)
+    output.write('\n')
+
+
+@main.command(name='trace', short_help='analyze provisioning traces')
+@click.argument('files', nargs=-1, type=click.File('r'))
+@click.option('--name', type=click.Choice(['create', 'delete']),
+    help='Only analyze the traces of creating or deleting claims.')
+@click.option('--slowest', type=int, default=5,
+    help='Number of the slowest traces to break down.')
+@click.option('--json', 'as_json', is_flag=True, default=False,
+    help='Print the results as json.')
+@click.pass_context
+def trace_command(ctx, files, name, slowest, as_json):
+    """Break the latency of provisioning and deleting claims down into
+    stages from the spans in FILES, or stdin.
+
+    FILES are json lines as written by the controller's --trace-file
+    or logs with spans of dataset pods. Each stage, the path of span
+    names from the root of its trace, is reported with its count and
+    latency percentiles in seconds.
+    """
+    log = ctx.obj['log']
+    log.debug('%s: %s', ctx.info_name, ctx.params)
+
+    spans = []
+    for f in files or [click.get_text_stream('stdin')]:
+        spans.extend(trace.read_spans(f))
+    summary = trace.summarize(spans, name=name, slowest=slowest)
+    if as_json:
+        click.echo(json.dumps(summary, indent=2))
+    else:
+        click.echo(trace.format_summary(summary))
+
+
 @main.group(name='dataset', short_help='manage datasets')
 @click.pass_context
 def dataset(ctx):
-    pass
+    # Continue the traces of the controller in dataset pods.
+    trace.resume_from_env(ctx)
+
+
+def _load_manifest(manifest):
+    try:
+        items = json.load(manifest)
+    except ValueError as e:
+        raise click.BadParameter(f'not valid json: {e}', param_hint='--manifest')
+    if not isinstance(items, list):
+        raise click.BadParameter('must be a json list', param_hint='--manifest')
+    return items
+
+
+def _report_results(results, result_file=None):
+    """Print results, a dict or list of errors, as json and
+    exit with 1 if any of them is not None.
+    """
+    output = json.dumps(results)
+    click.echo(output)
+    if isinstance(results, dict):
+        errors = list(results.values())
+        short = {k:v and v[:200] for k,v in results.items()}
+    else:
+        errors = results
+        short = [v and v[:200] for v in results]
+    if result_file:
+        # Keep errors short, the result file may be a size limited
+        # container termination message.
+        with open(result_file, 'w') as f:
+            json.dump(short, f)
+    if any(error is not None for error in errors):
+        sys.exit(1)
+
+
+def _parse_properties(ctx, param, values):
+    properties = {}
+    for value in values:
+        k, sep, v = value.partition('=')
+        if not sep:
+            raise click.BadParameter(f'expected PROPERTY=VALUE, got: {value}')
+        properties[k] = v
+    return properties
 
 
 @dataset.command(name='create', short_help='create dataset')
-@click.argument('dataset')
-@click.argument('mountpoint')
+@click.argument('dataset', required=False)
+@click.argument('mountpoint', required=False)
 @click.option('--quota', help='Quota of the dataset.')
 @click.option('--refquota', help='Refquota of the dataset.')
+@click.option('--origin', help='Dataset or snapshot to clone the dataset from.')
+@click.option('--volsize', type=int, help='Create a volume of this many bytes instead of a filesystem.')
+@click.option('--sparse', is_flag=True, help='Do not reserve space for the volume.')
+@click.option('-o', '--property', 'properties', multiple=True, callback=_parse_properties,
+    metavar='PROPERTY=VALUE', help='Additional zfs property to set, can be given multiple times.')
+@click.option('--manifest', type=click.File('r'),
+    help='Json list of datasets to create, use - for stdin.')
 @click.pass_context
-def dataset_create(ctx, dataset, mountpoint, quota, refquota):
+def dataset_create(ctx, dataset, mountpoint, quota, refquota, origin, volsize, sparse, properties,
+        manifest):
     """Create the given DATASET and mount it to MOUNTPOINT
     while optionally setting a quota and/or refquota.
 
+    With --origin the DATASET is created as a clone of the
+    given snapshot, or of a new snapshot of the given dataset.
+
+    With --volsize the DATASET is created as a volume, a block
+    device under /dev/zvol, which takes no MOUNTPOINT.
+
+    Only the zfs properties listed in zfs.TUNABLE_PROPERTIES,
+    e.g. recordsize or compression, can be set with --property.
+
     Ensure that the parent dataset, determined from DATASET,
     exists and ensure it has safe permissions.
+
+    Instead of a single DATASET a --manifest can be given that
+    lists many datasets as objects with the keys: dataset, mountpoint
+    and optionally quota, refquota, origin, volsize, sparse and properties.
+    The results are printed as json.
     """
     log = ctx.obj['log']
     log.debug('%s: %s', ctx.info_name, ctx.params)
 
-    # Ensure we have parent dataset whith mountpoint set to legacy.
-    parent = os.path.split(dataset)[0]
-    zfs.ensure(parent, mountpoint='legacy')
+    if manifest:
+        _report_results(asyncio.run(node.create_datasets(_load_manifest(manifest))))
+    elif dataset and (mountpoint or volsize):
+        try:
+            asyncio.run(node.create_dataset(dataset, mountpoint, quota=quota, refquota=refquota,
+                origin=origin, properties=properties, volsize=volsize, sparse=sparse))
+        except zfs.ZfsPropertyError as e:
+            raise click.BadParameter(str(e), param_hint='--property')
+    else:
+        raise click.UsageError('Either DATASET and MOUNTPOINT or --volsize, or --manifest are required.')
 
-    # Ensure the mountpoints parent folder exists and has safe permissions.
-    mountpoint_dir = os.path.split(mountpoint)[0]
-    os.makedirs(mountpoint_dir, mode=0o700, exist_ok=True)
-    os.chmod(mountpoint_dir, 0o700)
 
-    # Create our dataset and ensure it is writable by the pod.
-    zfs.create(dataset, mountpoint=mountpoint, quota=quota, refquota=refquota)
-    os.chmod(mountpoint, 0o777)
+@dataset.command(name='destroy', short_help='destroy dataset')
+@click.argument('dataset', required=False)
+@click.argument('mountpoint', required=False)
+@click.option('--manifest', type=click.File('r'),
+    help='Json list of datasets to destroy, use - for stdin.')
+@click.pass_context
+def dataset_destroy(ctx, dataset, mountpoint, manifest):
+    """Destroy the given DATASET and delete it's former MOUNTPOINT.
+    Volumes have no MOUNTPOINT.
 
+    Instead of a single DATASET a --manifest can be given that
+    lists many datasets as objects with the keys: dataset and mountpoint.
+    The datasets are destroyed in a single transaction group per pool
+    if possible. The results are printed as json.
 
-@dataset.command(name='destroy', short_help='destroy dataset')
+    Datasets that still have snapshots are only unmounted and destroyed
+    together with their last snapshot.
+    """
+    log = ctx.obj['log']
+    log.debug('%s: %s', ctx.info_name, ctx.params)
+
+    if manifest:
+        _report_results(asyncio.run(node.destroy_datasets(_load_manifest(manifest))))
+    elif dataset:
+        asyncio.run(node.destroy_dataset(dataset, mountpoint))
+    else:
+        raise click.UsageError('Either DATASET or --manifest is required.')
+
+
+@dataset.command(name='resize', short_help='resize dataset')
 @click.argument('dataset')
-@click.argument('mountpoint')
+@click.option('--quota', help='New quota of the dataset.')
+@click.option('--refquota', help='New refquota of the dataset.')
+@click.option('--volsize', type=int, help='New size in bytes of the volume.')
 @click.pass_context
-def dataset_destroy(ctx, dataset, mountpoint):
-    """Destroy the given DATASET and delete it's former MOUNTPOINT.
+def dataset_resize(ctx, dataset, quota, refquota, volsize):
+    """Change the quota and/or refquota of the given DATASET
+    or the size of the given volume in place.
     """
     log = ctx.obj['log']
     log.debug('%s: %s', ctx.info_name, ctx.params)
 
-    # Destroy the dataset.
-    zfs.destroy(dataset)
+    if not (quota or refquota or volsize):
+        raise click.UsageError('At least one of --quota, --refquota or --volsize is required.')
+    asyncio.run(node.resize_dataset(dataset, quota=quota, refquota=refquota, volsize=volsize))
+
+
+@dataset.command(name='snapshot', short_help='create snapshot')
+@click.argument('snapshot')
+@click.pass_context
+def dataset_snapshot(ctx, snapshot):
+    """Create the given SNAPSHOT, e.g. pool/dataset@name.
+    """
+    log = ctx.obj['log']
+    log.debug('%s: %s', ctx.info_name, ctx.params)
+
+    asyncio.run(node.create_snapshot(snapshot))
+
+
+@dataset.command(name='destroy-snapshot', short_help='destroy snapshot')
+@click.argument('snapshot')
+@click.pass_context
+def dataset_destroy_snapshot(ctx, snapshot):
+    """Destroy the given SNAPSHOT.
+
+    Snapshots that still have clones are destroyed
+    together with their last clone.
+    """
+    log = ctx.obj['log']
+    log.debug('%s: %s', ctx.info_name, ctx.params)
+
+    asyncio.run(node.destroy_snapshot(snapshot))
+
+
+@dataset.command(name='batch', short_help='create and destroy datasets')
+@click.option('--manifest', type=click.File('r'),
+    help='Json list of datasets to create or destroy, use - for stdin.')
+@click.option('--manifest-json', envvar='ZFS_PROVISIONER_MANIFEST',
+    help='The manifest as a json string.')
+@click.option('--result-file', type=click.Path(dir_okay=False),
+    help='Also write the json results to this file.')
+@click.pass_context
+def dataset_batch(ctx, manifest, manifest_json, result_file):
+    """Create and destroy many datasets at once.
+
+    The manifest lists datasets as objects like for the create and destroy
+    commands with an additional key `action` that is either create or destroy.
+    Objects with the action resize have the keys: dataset, quota and
+    refquota. Objects with the action snapshot or destroy_snapshot only
+    have the key `dataset` which is the name of the snapshot.
+    The results are printed as a json list with null or an error
+    message for each object, in the order of the manifest.
+    """
+    log = ctx.obj['log']
+    log.debug('%s: %s', ctx.info_name, ctx.params)
 
-    # Delete the mountpint.
-    os.rmdir(mountpoint)
+    if manifest:
+        items = _load_manifest(manifest)
+    elif manifest_json:
+        items = _load_manifest(io.StringIO(manifest_json))
+    else:
+        raise click.UsageError('Either --manifest or --manifest-json is required.')
+    _report_results(asyncio.run(node.run_batch(items)), result_file)
 
 
 if __name__ == '__main__':
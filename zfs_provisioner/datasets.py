@@ -1,29 +1,61 @@
 import asyncio
 import dataclasses
+import json
 import logging
+import time
+import uuid
 
 from typing import Optional, Dict, List
 
 import bitmath
 import kopf
 import kubernetes_asyncio
-import yaml
 
-from . import get_template
+from . import Error
+from . import agent
+from . import builders
+from . import kube
+from . import metrics
+from . import scheduler
+from . import trace
+from . import tracker
 from .handlers import CONFIG
 
 log = logging.getLogger('zfs-provisioner')
 
 
-EVENTS: Dict = {
-    'create': {},
-    'delete': {},
+# Maps the actions of items to the action label of single item pods.
+POD_ACTIONS = {
+    'create': 'create',
+    'destroy': 'delete',
+    'resize': 'resize',
+    'snapshot': 'create',
+    'destroy_snapshot': 'delete',
 }
 
-POD_TEMPLATE: str = get_template('dataset-pod.yaml')
+TERMINATION_MESSAGE_PATH = '/dev/termination-log'
 
 ACTION_ANNOTATION = 'zfs-provisioner/action-test'
 
+TRACKER = tracker.PodTracker(label=ACTION_ANNOTATION)
+
+# The api server only sends us dataset pods once they finished. Pods
+# deleted before that are caught by the pod timeouts.
+FINISHED_POD_FIELD_SELECTOR = 'status.phase!=Pending,status.phase!=Running'
+
+# Kinds of the controllers of our own pod that dataset pods may be owned by.
+OWNER_KINDS = {
+    'ReplicaSet': 'read_namespaced_replica_set',
+    'Deployment': 'read_namespaced_deployment',
+    'StatefulSet': 'read_namespaced_stateful_set',
+}
+
+
+class DatasetError(Error):
+    """Error that happened while managing a dataset on a node.
+    """
+    pass
+
 
 @dataclasses.dataclass
 class Dataset():
@@ -32,16 +64,38 @@ class Dataset():
     mount_point: str
     selected_node: str
     size: str = None
+    # Dataset or snapshot this dataset is cloned from.
+    origin: str = None
+    # The zfs properties set on the dataset, all others are inherited
+    # from the parent dataset.
+    properties: Dict[str, str] = dataclasses.field(default_factory=dict)
+    # Block volumes are zvols without a mount point.
+    volume_mode: str = 'Filesystem'
+    # Whether to skip the refreservation of zvols.
+    sparse: bool = False
+    # Name of the storage class of the claim, only used for metrics.
+    storage_class: str = None
 
     @property
     def full_name(self):
         return f'{self.parent}/{self.name}'
 
-    async def create(self, namespace):
-        return await create(self, namespace)
+    @property
+    def is_block(self):
+        return self.volume_mode == 'Block'
+
+    @property
+    def device(self):
+        return f'/dev/zvol/{self.full_name}'
+
+    async def create(self):
+        return await create(self)
+
+    async def delete(self):
+        return await delete(self)
 
-    async def delete(self, namespace):
-        return await delete(self, namespace)
+    async def resize(self):
+        return await resize(self)
 
 
 def size_in_bytes(size):
@@ -51,122 +105,474 @@ def size_in_bytes(size):
     return int(bitmath.parse_string(size).bytes)
 
 
+def get_pod_field_selector():
+    """Return the field selector for the watch of dataset pods.
+    """
+    return f'metadata.namespace={CONFIG.namespace},{FINISHED_POD_FIELD_SELECTOR}'
+
+
+async def find_owner(pod_name, namespace):
+    """Return an owner reference to the top most controller of the given pod,
+    e.g. its Deployment, or to the pod itself if it has no known controller.
+    """
+    api = kube.get_api_client()
+    obj = await kubernetes_asyncio.client.CoreV1Api(api).read_namespaced_pod(pod_name, namespace)
+    owner = {'apiVersion': 'v1', 'kind': 'Pod'}
+    apps = kubernetes_asyncio.client.AppsV1Api(api)
+    while True:
+        owner.update(name=obj.metadata.name, uid=obj.metadata.uid)
+        controller = next((ref for ref in obj.metadata.owner_references or []
+            if ref.controller and ref.kind in OWNER_KINDS), None)
+        if controller is None:
+            return owner
+        obj = await getattr(apps, OWNER_KINDS[controller.kind])(controller.name, namespace)
+        owner = {'apiVersion': controller.api_version, 'kind': controller.kind}
+
+
 def _get_pod(pod_name, node_name, image, dataset_mount_dir, pod_args):
-    text = POD_TEMPLATE.format(
+    body = builders.POD_BUILDER.build(
         pod_name=pod_name,
         node_name=node_name,
         image=image,
         dataset_mount_dir=dataset_mount_dir,
+        pod_args=pod_args,
         log_level=logging.getLevelName(log.getEffectiveLevel()),
     )
-    data = yaml.safe_load(text)
-    data['spec']['containers'][0]['args'] = pod_args
-    return data
+    if CONFIG.pod_owner:
+        # Have kubernetes delete left over pods together with the controller.
+        body['metadata']['ownerReferences'] = [dict(CONFIG.pod_owner, blockOwnerDeletion=False)]
+    return body
 
 
-async def _run_pod(action, pod_name, body, namespace):
+async def delete_pod(v1, pod_name, namespace, uid):
+    """Delete the pod with the given name, but only if it still has the given UID.
+    """
+    log.debug('deleting dataset handling pod: %s', pod_name)
+    body = kubernetes_asyncio.client.V1DeleteOptions(
+        preconditions=kubernetes_asyncio.client.V1Preconditions(uid=uid))
+    try:
+        await v1.delete_namespaced_pod(pod_name, namespace, body=body)
+    except kubernetes_asyncio.client.rest.ApiException as e:
+        if e.status not in (404, 409):
+            raise
+
+
+async def _start_pod(v1, pod_name, body, namespace):
+    """Create the given pod and return its UID.
+
+    If a pod with the same name already exists, e.g. started before the
+    controller restarted, attach to it instead. A failed pod from a previous
+    attempt is replaced.
+    """
+    for _ in range(30):
+        try:
+            obj = await v1.create_namespaced_pod(
+                body=body,
+                namespace=namespace,
+            )
+            return obj.metadata.uid
+        except kubernetes_asyncio.client.rest.ApiException as e:
+            if e.status != 409:
+                raise
+
+        obj = await v1.read_namespaced_pod(pod_name, namespace)
+        if obj.metadata.deletion_timestamp is None:
+            if obj.status.phase != 'Failed':
+                log.info('attaching to existing pod: %s', pod_name)
+                TRACKER.update(v1.api_client.sanitize_for_serialization(obj))
+                return obj.metadata.uid
+            log.info('replacing failed pod: %s', pod_name)
+            await delete_pod(v1, pod_name, namespace, obj.metadata.uid)
+        # Wait for the old pod to go away.
+        await asyncio.sleep(1)
+    raise DatasetError(f'Pod {pod_name} already exists and does not go away')
+
+
+async def _run_pod(action, pod_name, body, storage_class=None):
+    """Run the given pod in our namespace and wait for it to finish.
+
+    Pods that do not finish within the deadline for action are deleted
+    and started again with exponential backoff. A pod that timed out may
+    have done its work already, so this relies on the node operations
+    being idempotent: creating a dataset that exists with the requested
+    properties and destroying one that is gone succeed.
+    Return the tracker.PodResult of the finished pod.
+    """
     # Label the pod for filtering in the on.event handler.
     kopf.label(body, {ACTION_ANNOTATION: action})
-    event = asyncio.Event()
-
-    obj = None
-    async with kubernetes_asyncio.client.ApiClient() as api:
-        v1 = kubernetes_asyncio.client.CoreV1Api(api)
-        obj = await v1.create_namespaced_pod(
-            body=body,
-            namespace=namespace,
-        )
-        EVENTS[action][obj.metadata.uid] = event
+    if trace.current():
+        # Have the pod continue the traces and log its spans.
+        body['spec']['containers'][0]['env'].append(
+            {'name': trace.TRACE_ENV, 'value': trace.format_contexts()})
+
+    v1 = kubernetes_asyncio.client.CoreV1Api(kube.get_api_client())
+    namespace = CONFIG.namespace
+    timeout = CONFIG.pod_timeouts.get(action)
+    attempts = CONFIG.pod_retries + 1
+    for attempt in range(attempts):
+        if attempt:
+            delay = CONFIG.pod_retry_backoff * 2 ** (attempt - 1)
+            log.warning('retrying pod %s in %ss', pod_name, delay)
+            await asyncio.sleep(delay)
+
+        node_name = body['spec']['nodeName']
+        with metrics.STAGE_DURATION.labels(action, 'pod_create').time(), \
+                metrics.count_api_errors(node_name, storage_class, action), \
+                trace.span('pod_create', pod=pod_name, attempt=attempt):
+            uid = await _start_pod(v1, pod_name, body, namespace)
+        log.debug('waiting for pod: %s', pod_name)
+        try:
+            with metrics.STAGE_DURATION.labels(action, 'pod_completion').time():
+                result = await TRACKER.wait(uid, timeout)
+        except asyncio.TimeoutError:
+            log.warning('pod %s did not finish within %ss', pod_name, timeout)
+            await delete_pod(v1, pod_name, namespace, uid)
+            continue
+        except tracker.PodGoneError as e:
+            log.warning('%s', e)
+            continue
+
+        log.info('pod %s: %s, timings: %s', pod_name, result.phase, result.timings)
+        metrics.observe_pod_timings(action, result.timings)
+        await _trace_pod(v1, result)
+        if result.succeeded:
+            # All done. Delete the pod.
+            # For now keep failed pods around for inspection.
+            await delete_pod(v1, pod_name, namespace, uid)
+        return result
 
-    # TODO: handle timeout and error
-    log.debug('waiting for pod_event: %s', pod_name)
-    await event.wait()
-    log.debug('pod_event has been set: %s', pod_name)
-    return obj
+    raise DatasetError(f'Pod {pod_name} did not finish after {attempts} attempts')
 
 
+async def _trace_pod(v1, result):
+    """Record the phases of the given finished pod and
+    the spans it logged in the current traces.
+    """
+    if not trace.current():
+        return
+    times = {k:v.timestamp() if v else None for k,v in result.times.items()}
+    trace.record('pod_scheduling', times.get('created'), times.get('scheduled'), pod=result.name)
+    # Mostly pulling the image.
+    trace.record('pod_start', times.get('scheduled'), times.get('started'), pod=result.name)
+    trace.record('pod_run', times.get('started'), times.get('finished'), pod=result.name)
+    try:
+        logs = await v1.read_namespaced_pod_log(result.name, result.namespace)
+    except kubernetes_asyncio.client.rest.ApiException as e:
+        log.debug('pod %s: no spans: %s', result.name, e.reason)
+        return
+    trace.import_log(logs)
+
+
+# The api server only sends us finished dataset pods from our own
+# namespace, see get_pod_field_selector and handlers.startup.
 @kopf.on.event('', 'v1', 'pods', labels={ACTION_ANNOTATION: kopf.PRESENT})
-async def on_event(event, name, namespace, meta, status, **_):
-    log.debug('datasets.on_event: %s: %s', name, event)
+async def on_event(event, name, body, **_):
+    log.debug('datasets.on_event: %s: %s', name, event['type'])
+    TRACKER.update(body, deleted=event['type'] == 'DELETED')
 
-    # Only care about changes to existing pods.
-    if event['type'] == 'MODIFIED':
 
-        phase = status['phase']
+def get_termination_message(status):
+    try:
+        return status['containerStatuses'][0]['state']['terminated']['message']
+    except (KeyError, IndexError, TypeError):
+        return None
 
-        if phase in ('Succeeded', 'Failed'):
-            action = meta.labels[ACTION_ANNOTATION]
-            log.debug('dataset %s: %s -> %s', name, action, phase)
 
-            # Mark this event as done.
-            pod_event = EVENTS[action].pop(meta.uid)
-            pod_event.set()
-
-            # All done. Delete the pod.
-            # TODO: in case of failure get errors and store them somewhere?
-            if phase == 'Succeeded':
-                # For now keep failed pods around for inspection.
-                async with kubernetes_asyncio.client.ApiClient() as api:
-                    v1 = kubernetes_asyncio.client.CoreV1Api(api)
-                    log.debug('deleting dataset handling pod: %s', name)
-                    await v1.delete_namespaced_pod(name, namespace)
-
-
-async def create(dataset: Dataset, namespace: str):
+def _get_item_args(item):
+    """Return the `dataset` command arguments for the given item.
     """
-    - run pod that creates the dataset
-    - wait for it to complete
-    - return success or error message
+    pod_args = ['dataset', item['action'].replace('_', '-')]
+    for key in ('quota', 'refquota', 'origin', 'volsize'):
+        if item.get(key):
+            pod_args.extend([f'--{key}', str(item[key])])
+    if item.get('sparse'):
+        pod_args.append('--sparse')
+    for k,v in (item.get('properties') or {}).items():
+        pod_args.extend(['--property', f'{k}={v}'])
+    pod_args.append(item['dataset'])
+    if item.get('mountpoint'):
+        pod_args.append(item['mountpoint'])
+    return pod_args
+
+
+async def _run_pod_items(node_name, items, storage_class=None):
+    """Run a pod on the given node that handles all items.
+    Return a list with None or an error message for each item.
     """
-    log.debug('dataset.create: %s in namespace: %s', dataset, namespace)
-
-    action = 'create'
-    pod_name = f'{dataset.name}-{action}'
+    if len(items) == 1:
+        item = items[0]
+        action = POD_ACTIONS[item['action']]
+        # The name of the snapshot for snapshot items.
+        dataset_name = item['dataset'].rsplit('/', 1)[-1].rsplit('@', 1)[-1]
+        pod_name = f'{dataset_name}-{action}'
+        pod_args = _get_item_args(item)
+    else:
+        action = 'batch'
+        pod_name = f'zfs-provisioner-batch-{uuid.uuid4().hex[:12]}'
+        pod_args = ['dataset', 'batch', '--result-file', TERMINATION_MESSAGE_PATH]
+
+    log.debug('dataset.%s: pod_args: %s', action, pod_args)
+    body = _get_pod(pod_name, node_name,
+        CONFIG.container_image, CONFIG.dataset_mount_dir,
+        pod_args)
+    if action == 'batch':
+        body['spec']['containers'][0]['env'].append(
+            {'name': 'ZFS_PROVISIONER_MANIFEST', 'value': json.dumps(items)})
+
+    result = await _run_pod(action, pod_name, body, storage_class)
+
+    message = get_termination_message(result.status)
+    if action == 'batch':
+        try:
+            results = json.loads(message)
+        except (TypeError, ValueError):
+            results = None
+        if _is_results(results, items):
+            return results
+        # The termination message is cut off after 4096 bytes, failed
+        # pods are kept around, so read the results from their log.
+        if not result.succeeded:
+            results = await _read_pod_results(result, items)
+            if results is not None:
+                return results
+        log.warning('dataset.batch: %s: no results reported, using pod phase', pod_name)
+
+    if result.succeeded:
+        error = None
+    else:
+        error = message or f'Pod {pod_name} failed, see its logs for details'
+    return [error] * len(items)
+
+
+def _is_results(results, items):
+    """Return whether results holds one result for each of items.
+    """
+    return isinstance(results, list) and len(results) == len(items)
 
-    pod_args = ['dataset', 'create']
-    if dataset.size:
-        size = size_in_bytes(dataset.size)
-        pod_args.extend(['--refquota', str(size)])
-    pod_args.append(dataset.full_name)
-    pod_args.append(dataset.mount_point)
 
-    log.debug('dataset.create: pod_args: %s', pod_args)
+def _parse_pod_results(text, items):
+    """Return the results of items that a batch pod printed to
+    its log as a json line or None if there are none.
+    """
+    for line in reversed(text.splitlines()):
+        if not line.startswith('['):
+            continue
+        try:
+            results = json.loads(line)
+        except ValueError:
+            continue
+        if _is_results(results, items):
+            return results
+    return None
+
+
+async def _read_pod_results(result, items):
+    v1 = kubernetes_asyncio.client.CoreV1Api(kube.get_api_client())
+    try:
+        logs = await v1.read_namespaced_pod_log(result.name, result.namespace)
+    except kubernetes_asyncio.client.rest.ApiException as e:
+        log.warning('dataset.batch: %s: failed to read log: %s', result.name, e.reason)
+        return None
+    return _parse_pod_results(logs, items)
+
+
+async def _run_agent_items(node_name, items):
+    """Ask the agent on the given node to handle all items.
+    Return a list with None or an error message for each item
+    or None if the agent is not reachable.
+    """
+    try:
+        if len(items) == 1:
+            item = dict(items[0])
+            action = item.pop('action')
+            await agent.call(node_name, action,
+                CONFIG.agent_port, CONFIG.agent_token, CONFIG.agent_timeout,
+                **item)
+            return [None]
+        response = await agent.call(node_name, 'batch',
+            CONFIG.agent_port, CONFIG.agent_token, CONFIG.agent_timeout,
+            items=items)
+        return response['result']
+    except agent.AgentUnavailableError as e:
+        log.warning('dataset.batch: %s, falling back to pod', e)
+        return None
+    except agent.AgentError as e:
+        return [str(e)] * len(items)
+
+
+class Batcher:
+    """Collect dataset operations per node for a short window
+    and run them in a single worker invocation.
+    """
+    def __init__(self):
+        self.pending: Dict = {}
+        self.tasks = set()
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def submit(self, node_name, item, storage_class=None):
+        """Queue item for the given node and wait for its result.
+        storage_class is the name of the storage class of the item's
+        dataset, if any, to label metrics with.
+        Raise DatasetError if the item failed or another item
+        for its dataset is queued already.
+        """
+        batch = self.pending.get(node_name)
+        if batch and any(queued['dataset'] == item['dataset'] for queued, *_ in batch):
+            raise DatasetError(f'An operation on dataset {item["dataset"]} is queued already')
+        future = asyncio.get_running_loop().create_future()
+        if batch is None:
+            batch = self.pending[node_name] = []
+            self._spawn(self._flush_later(node_name, batch))
+        with trace.span(f'dataset_{item["action"]}', node=node_name, dataset=item['dataset']) as spans:
+            batch.append((item, storage_class, future, spans))
+            if len(batch) >= CONFIG.batch_max_size:
+                self._flush(node_name, batch)
+            with metrics.IN_FLIGHT.labels(item['action']).track_inprogress():
+                return await future
+
+    async def _flush_later(self, node_name, batch):
+        await asyncio.sleep(CONFIG.batch_window)
+        self._flush(node_name, batch)
+
+    def _flush(self, node_name, batch):
+        if self.pending.get(node_name) is batch:
+            del self.pending[node_name]
+            self._spawn(self._run(node_name, batch))
+
+    async def _run(self, node_name, batch):
+        items = [item for item, storage_class, future, spans in batch]
+        # Label metrics of batches that mix storage classes with none.
+        storage_classes = {storage_class for item, storage_class, future, spans in batch}
+        storage_class = storage_classes.pop() if len(storage_classes) == 1 else None
+        # The spans of all traced items, the batch is part of each of their traces.
+        parents = [span for item, storage_class, future, spans in batch for span in spans]
+        for span in parents:
+            trace.record('queue', span.start, time.time(), parents=[span])
+        results = None
+        try:
+            waiting = time.time()
+            async with scheduler.SCHEDULER.slot(node_name, [item['action'] for item in items]):
+                trace.record('slot', waiting, time.time(), parents=parents)
+                with trace.span('batch', parents=parents, node=node_name, size=len(items)):
+                    log.debug('dataset.batch: running %s items on node %s', len(items), node_name)
+                    if CONFIG.use_agent:
+                        results = await _run_agent_items(node_name, items)
+                    if results is None:
+                        results = await _run_pod_items(node_name, items, storage_class)
+        except Exception as e:
+            log.exception('dataset.batch: failed on node %s', node_name)
+            results = [str(e)] * len(items)
+        if not _is_results(results, items):
+            results = ['No result reported'] * len(items)
+
+        for (item, _, future, spans), error in zip(batch, results):
+            if future.done():
+                # The waiting handler has been cancelled.
+                continue
+            if error is None:
+                future.set_result(item)
+            else:
+                future.set_exception(DatasetError(error))
+
+
+BATCHER = Batcher()
+
+
+async def create(dataset: Dataset):
+    """
+    - queue the dataset for creation on its node
+    - wait for the node agent or pod to complete
+    - return the handled item or raise DatasetError
+    """
+    log.debug('dataset.create: %s', dataset)
+
+    item = {
+        'action': 'create',
+        'dataset': dataset.full_name,
+    }
+    if dataset.is_block:
+        item['volsize'] = size_in_bytes(dataset.size)
+        if dataset.sparse:
+            item['sparse'] = True
+    else:
+        item['mountpoint'] = dataset.mount_point
+        if dataset.size:
+            item['refquota'] = size_in_bytes(dataset.size)
+    if dataset.origin:
+        item['origin'] = dataset.origin
+    if dataset.properties:
+        item['properties'] = dataset.properties
+
+    return await BATCHER.submit(dataset.selected_node, item, dataset.storage_class)
+
+
+async def delete(dataset):
+    """
+    - queue the dataset for destruction on its node
+    - wait for the node agent or pod to complete
+    - return the handled item or raise DatasetError
+    """
+    log.debug('dataset.delete: %s', dataset)
 
-    body = _get_pod(pod_name, dataset.selected_node,
-        CONFIG.container_image, CONFIG.dataset_mount_dir,
-        pod_args)
+    item = {
+        'action': 'destroy',
+        'dataset': dataset.full_name,
+    }
+    if not dataset.is_block:
+        item['mountpoint'] = dataset.mount_point
 
-    return await _run_pod(action, pod_name, body, namespace)
+    return await BATCHER.submit(dataset.selected_node, item, dataset.storage_class)
 
 
-async def delete(dataset, namespace):
+async def snapshot(dataset, snapshot_name):
     """
-    - run pod that destroys the dataset
-    - wait for it to complete
-    - return success or error message
+    - queue the snapshot dataset@snapshot_name for creation on the node of dataset
+    - wait for the node agent or pod to complete
+    - return the handled item or raise DatasetError
     """
-    log.debug('dataset.delete: %s in namespace: %s', dataset, namespace)
+    log.debug('dataset.snapshot: %s@%s', dataset, snapshot_name)
 
-    action = 'delete'
-    pod_name = f'{dataset.name}-{action}'
+    item = {
+        'action': 'snapshot',
+        'dataset': f'{dataset.full_name}@{snapshot_name}',
+    }
 
-    pod_args = ['dataset', 'destroy']
-    pod_args.append(dataset.full_name)
-    pod_args.append(dataset.mount_point)
+    return await BATCHER.submit(dataset.selected_node, item, dataset.storage_class)
 
-    log.debug('dataset.delete: pod_args: %s', pod_args)
 
-    body = _get_pod(pod_name, dataset.selected_node,
-        CONFIG.container_image, CONFIG.dataset_mount_dir,
-        pod_args)
+async def delete_snapshot(snapshot, node_name):
+    """
+    - queue the given snapshot for destruction on node_name
+    - wait for the node agent or pod to complete
+    - return the handled item or raise DatasetError
+    """
+    log.debug('dataset.delete_snapshot: %s on node %s', snapshot, node_name)
 
-    return await _run_pod(action, pod_name, body, namespace)
+    item = {
+        'action': 'destroy_snapshot',
+        'dataset': snapshot,
+    }
 
+    return await BATCHER.submit(node_name, item)
 
-async def resize(dataset, namespace):
+
+async def resize(dataset):
     """
-    - run pod that resizes the dataset
-    - wait for it to complete
-    - return success or error message
+    - queue the dataset for setting its refquota, or volsize of zvols,
+      to its size on its node
+    - wait for the node agent or pod to complete
+    - return the handled item or raise DatasetError
     """
-    raise NotImplementedError()
+    log.debug('dataset.resize: %s', dataset)
+
+    item = {
+        'action': 'resize',
+        'dataset': dataset.full_name,
+        'volsize' if dataset.is_block else 'refquota': size_in_bytes(dataset.size),
+    }
+
+    return await BATCHER.submit(dataset.selected_node, item, dataset.storage_class)
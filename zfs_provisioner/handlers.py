@@ -1,5 +1,7 @@
 import asyncio
 import dataclasses
+import datetime
+import functools
 import itertools
 import json
 import logging
@@ -13,10 +15,6 @@ import click
 import inotipy
 import kopf
 import kubernetes_asyncio
-import yaml
-
-
-from . import get_template
 
 
 log = logging.getLogger('zfs-provisioner')
@@ -30,13 +28,91 @@ class Config:
     dataset_mount_dir: str = '/var/lib/zfs-provisioner'
     container_image: str = 'asteven/zfs-provisioner'
     node_name: Optional[str] = None
+    # Name of the controller's own pod and the owner reference of the
+    # dataset pods derived from it, see datasets.find_owner.
+    pod_name: Optional[str] = None
+    pod_owner: Optional[Dict] = None
     # Path to a config file.
     config: Optional[str] = None
+    # Paths to files that override the pod and persistent volume templates.
+    pod_template: Optional[str] = None
+    pv_template: Optional[str] = None
     # The config loaded from `config` as a dict.
     dataset_config: Optional[Dict] = dataclasses.field(default_factory=dict)
+    # Seconds to collect changes of watched files before reloading them.
+    config_reload_debounce: float = 1.0
     dataset_phase_annotations: Dict[str, str] = dataclasses.field(default_factory=dict)
     storage_classes: Dict[str, Dict] = dataclasses.field(default_factory=dict)
+    # Maps the names of our volume snapshot classes to their deletionPolicy.
+    snapshot_classes: Dict[str, str] = dataclasses.field(default_factory=dict)
     dataset_annotation: str = 'zfs-provisioner/dataset'
+    # Storage class parameters and PVC annotations with these prefixes
+    # set the zfs property named by the rest of the key.
+    zfs_property_parameter_prefix: str = 'zfs.'
+    zfs_property_annotation_prefix: str = 'zfs-provisioner/zfs.'
+    # Whether PVC annotations may set zfs properties.
+    pvc_zfs_properties: bool = False
+    # Label selector that limits which PVCs the api server sends us.
+    pvc_label_selector: Optional[str] = None
+    # How many times the size of a parent dataset may be committed to
+    # claims and after how many seconds capacity reports are ignored.
+    capacity_overcommit: float = 1.0
+    capacity_max_age: float = 300
+    snapshot_annotation: str = 'zfs-provisioner/snapshot'
+    # Node agent settings.
+    use_agent: bool = False
+    agent_port: int = 8471
+    agent_token: Optional[str] = None
+    agent_timeout: float = 300
+    # Kubernetes api client settings, kopf uses a client of its own.
+    api_connection_limit: int = 20
+    api_keepalive_timeout: float = 60
+    # Client side rate limit of kubernetes api requests, 0 to disable.
+    api_qps: float = 20
+    api_burst: int = 40
+    # Per node batching of dataset operations.
+    batch_window: float = 0.2
+    batch_max_size: int = 32
+    # Limits of concurrently running dataset operations.
+    max_concurrent: int = 50
+    max_concurrent_per_node: int = 4
+    # Which operations to start first when limited: delete, create or none.
+    scheduler_priority: str = 'delete'
+    # Seconds dataset pods may run per action before they are retried.
+    pod_timeouts: Dict[str, float] = dataclasses.field(default_factory=lambda: {
+        'create': 300,
+        'delete': 300,
+        'resize': 300,
+        'batch': 600,
+    })
+    pod_retries: int = 2
+    pod_retry_backoff: float = 10
+    # Seconds without pod events after which pods are listed instead.
+    pod_poll_interval: float = 30
+    # Sweeping of left over pods and datasets every sweep_interval
+    # seconds, 0 to disable, with at most sweep_rate deletions per second.
+    sweep_interval: float = 600
+    sweep_rate: float = 1
+    sweep_dry_run: bool = False
+    # Seconds after which failed dataset pods are deleted.
+    failed_pod_ttl: float = 86400
+    # Seconds datasets must have been unused before they count as
+    # orphans and what to do with them then: Retain or Delete.
+    orphan_grace_period: float = 3600
+    orphan_reclaim_policy: str = 'Retain'
+    # Name of this replica when several controller replicas split the
+    # claims between them, see shard.Shards, and the node label whose
+    # value to split them by instead of the node name.
+    shard_identity: Optional[str] = None
+    shard_node_label: Optional[str] = None
+    # Seconds after which replicas that stopped renewing their lease are gone.
+    shard_lease_duration: int = 15
+    # Port to serve prometheus metrics on, 0 to disable.
+    metrics_port: int = 0
+    # File to append the spans of traced claims to as json lines, - for
+    # stdout, and whether to export them to OpenTelemetry, see trace.
+    trace_file: Optional[str] = None
+    trace_otel: bool = False
 
 
 CONFIG = Config(
@@ -54,7 +130,23 @@ def configure(**kwargs):
 
 
 # Has to be below CONFIG to prevent circular import problems.
+from . import agent
+from . import builders
+from . import capacity
 from . import datasets
+from . import kube
+from . import metrics
+from . import placement
+from . import reconcile
+from . import scheduler
+from . import shard
+from . import sweeper
+from . import trace
+from . import zfs
+
+
+# Set by the scheduler on claims of WaitForFirstConsumer storage classes.
+SELECTED_NODE_ANNOTATION = 'volume.kubernetes.io/selected-node'
 
 
 @dataclasses.dataclass
@@ -82,75 +174,276 @@ class StorageClass:
 
 
 async def load_config(config_file, reload=False):
+    """Load the dataset config and swap it in once it has been validated.
+    Return whether that worked, the current config is kept otherwise.
+    """
     if reload:
         prefix = 'Reloading'
     else:
         prefix = 'Loading'
     log.info('%s dataset config from: %s', prefix, config_file)
-    async with aiofiles.open(config_file, mode='r') as f:
-        config_string = await f.read()
-        CONFIG.dataset_config = json.loads(config_string)
+    try:
+        async with aiofiles.open(config_file, mode='r') as f:
+            config_string = await f.read()
+        dataset_config = json.loads(config_string)
+        resolver = placement.Resolver.from_config(dataset_config)
+    except (OSError, ValueError, placement.ConfigError) as e:
+        log.error('Keeping the current dataset config: %s: %s', config_file, e)
+        return False
+    CONFIG.dataset_config = dataset_config
+    placement.RESOLVER = resolver
+    return True
 
 
-async def watch_config_file(config_file):
-    """Monitor the config file and reload it on change.
+async def load_template(template_file, reload=False, load=None):
+    """Load the template and swap it in if it is valid.
+    Return whether that worked, the current template is kept otherwise.
     """
-    # Load initial config.
-    await load_config(config_file)
+    if reload:
+        prefix = 'Reloading'
+    else:
+        prefix = 'Loading'
+    log.info('%s template from: %s', prefix, template_file)
+    try:
+        async with aiofiles.open(template_file, mode='r') as f:
+            text = await f.read()
+        load(text)
+    except (OSError, builders.TemplateError) as e:
+        log.error('Keeping the current template: %s: %s', template_file, e)
+        return False
+    return True
+
+
+async def _load_file(path, load, reload=False, started=None):
+    loaded = await load(path, reload=reload)
+    name = os.path.basename(path)
+    metrics.CONFIG_RELOADS.labels(name, 'success' if loaded else 'failure').inc()
+    if started is not None:
+        metrics.CONFIG_RELOAD_DURATION.labels(name).observe(asyncio.get_running_loop().time() - started)
+
+
+async def watch_file(path, load):
+    """Monitor the given file and (re)load it on change.
+
+    Changes are collected for CONFIG.config_reload_debounce seconds
+    so that bursts of events, e.g. from editors saving a file or the
+    symlink swap of a ConfigMap update, cause a single reload.
+    """
+    # Initial load.
+    await _load_file(path, load)
 
     watcher = inotipy.Watcher.create()
-    watcher.watch(config_file, inotipy.IN.MODIFY)
+    watcher.watch(path, inotipy.IN.MODIFY)
 
+    loop = asyncio.get_running_loop()
     while True:
         event = await watcher.get()
-        log.debug(event)
-        await load_config(config_file, reload=True)
-        if event.mask & inotipy.EVENT_BIT.IGNORED.mask != 0:
-            # Re-create the watch if the file was removed/re-created.
-            event.watch.remove()
-            watcher.watch(config_file, inotipy.IN.MODIFY)
+        started = loop.time()
+        while event is not None:
+            log.debug(event)
+            if event.mask & inotipy.EVENT_BIT.IGNORED.mask != 0:
+                # Re-create the watch if the file was removed/re-created.
+                event.watch.remove()
+                watcher.watch(path, inotipy.IN.MODIFY)
+            remaining = started + CONFIG.config_reload_debounce - loop.time()
+            event = await watcher.get(timeout=remaining)
+        await _load_file(path, load, reload=True, started=started)
 
 
-config_watcher_task = None
+background_tasks = []
 
 @kopf.on.startup()
-async def startup(**_):
+async def startup(settings: kopf.OperatorSettings, **_):
+    # Have the api server only send us our finished dataset pods and,
+    # if configured, the PVCs with the given labels.
+    settings.watching.label_selectors['', 'v1', 'pods'] = datasets.ACTION_ANNOTATION
+    settings.watching.field_selectors['', 'v1', 'pods'] = datasets.get_pod_field_selector()
+    if CONFIG.pvc_label_selector:
+        settings.watching.label_selectors['', 'v1', 'persistentvolumeclaims'] = CONFIG.pvc_label_selector
+    # With sharding, only the claims and volume snapshots this replica owns.
+    if CONFIG.shard_identity:
+        settings.watching.label_selectors['', 'v1', 'persistentvolumeclaims'] = shard.join_selectors(
+            CONFIG.pvc_label_selector, f'{shard.SHARD_LABEL}={CONFIG.shard_identity}')
+        settings.watching.label_selectors[SNAPSHOT_GROUP, SNAPSHOT_VERSION, 'volumesnapshots'] = \
+            f'{shard.SHARD_LABEL}={CONFIG.shard_identity}'
+        # The replicas do not compete for the same objects.
+        settings.peering.standalone = True
+
     # Load kubernetes_asyncio config as kopf does not do that automatically for us.
-    try:
-        # Try incluster config first.
-        kubernetes_asyncio.config.load_incluster_config()
-    except kubernetes_asyncio.config.ConfigException:
-        # Fall back to regular config.
-        await kubernetes_asyncio.config.load_kube_config()
+    await kube.load_config()
+
+    metrics.serve(CONFIG.metrics_port)
+    trace.configure(CONFIG.trace_file, CONFIG.trace_otel)
+    scheduler.configure(
+        max_concurrent=CONFIG.max_concurrent,
+        max_concurrent_per_node=CONFIG.max_concurrent_per_node,
+        priority=CONFIG.scheduler_priority,
+    )
 
-    # Monitor config file for changes.
+    await kube.open_api_client(
+        connection_limit=CONFIG.api_connection_limit,
+        keepalive_timeout=CONFIG.api_keepalive_timeout,
+        qps=CONFIG.api_qps,
+        burst=CONFIG.api_burst,
+    )
+
+    if CONFIG.pod_name:
+        try:
+            CONFIG.pod_owner = await datasets.find_owner(CONFIG.pod_name, CONFIG.namespace)
+            log.info('Dataset pods are owned by %s %s', CONFIG.pod_owner['kind'], CONFIG.pod_owner['name'])
+        except kubernetes_asyncio.client.rest.ApiException as e:
+            log.warning('Not setting owner of dataset pods: %s', e)
+
+    # Pick up dataset pods that finished while we were not running
+    # and keep looking for them in case watch events get lost.
+    v1 = kubernetes_asyncio.client.CoreV1Api(kube.get_api_client())
+    await datasets.TRACKER.resync(v1, CONFIG.namespace)
+    background_tasks.append(asyncio.create_task(
+        datasets.TRACKER.poll(v1, CONFIG.pod_poll_interval, CONFIG.namespace)))
+
+    if CONFIG.shard_identity:
+        await shard.SHARDS.join(CONFIG.shard_identity)
+        background_tasks.append(asyncio.create_task(shard.SHARDS.run()))
+
+    # Find the claims that need work in bulk instead of resuming each one.
+    background_tasks.append(asyncio.create_task(reconcile.run_until_done()))
+
+    if CONFIG.sweep_interval:
+        background_tasks.append(asyncio.create_task(
+            sweeper.SWEEPER.run(CONFIG.sweep_interval)))
+
+    # Monitor config and template files for changes.
     if CONFIG.config:
-        global config_watcher_task
-        config_watcher_task = asyncio.create_task(watch_config_file(CONFIG.config))
+        background_tasks.append(asyncio.create_task(
+            watch_file(CONFIG.config, load_config)))
+    if CONFIG.pod_template:
+        background_tasks.append(asyncio.create_task(
+            watch_file(CONFIG.pod_template, functools.partial(
+                load_template, load=builders.load_pod_template))))
+    if CONFIG.pv_template:
+        background_tasks.append(asyncio.create_task(
+            watch_file(CONFIG.pv_template, functools.partial(
+                load_template, load=builders.load_pv_template))))
 
 
 @kopf.on.cleanup()
 async def cleanup(**_):
-    global config_watcher_task
-    if config_watcher_task:
-        config_watcher_task.cancel()
+    for task in background_tasks:
+        task.cancel()
+    await shard.SHARDS.leave()
+    await agent.close()
+    await kube.close_api_client()
 
 
 def filter_provisioner(body, **_):
     return body.get('provisioner', None) == CONFIG.provisioner_name
 
 
-@kopf.on.resume('storage.k8s.io', 'v1', 'storageclasses',
-    when=filter_provisioner)
-@kopf.on.create('storage.k8s.io', 'v1', 'storageclasses',
-    when=filter_provisioner)
-def cache_storage_class(name, body, meta, logger, **kwargs):
-    """Load storage class properties and parameters from API server.
+@kopf.on.event('storage.k8s.io', 'v1', 'storageclasses')
+def cache_storage_class(event, name, body, meta, pvcs_by_storage_class: kopf.Index, **_):
+    """Keep CONFIG.storage_classes in sync with the storage classes
+    of our provisioner as they are added, changed and deleted.
     """
-    log.info('Watching for PVCs with storage class: %s', name)
-    storage_class = StorageClass.from_dicts(meta, body)
-    CONFIG.storage_classes[name] = storage_class
-    log.debug('Caching storage class %s as: %s', name, storage_class)
+    if event['type'] != 'DELETED' and filter_provisioner(body):
+        storage_class = StorageClass.from_dicts(meta, body)
+        if name not in CONFIG.storage_classes:
+            log.info('Watching for PVCs with storage class: %s', name)
+        CONFIG.storage_classes[name] = storage_class
+        log.debug('Caching storage class %s as: %s', name, storage_class)
+    elif CONFIG.storage_classes.pop(name, None) is not None:
+        claims = len(pvcs_by_storage_class.get(name, []))
+        log.info('No longer watching for PVCs with storage class: %s, still used by %s PVCs',
+            name, claims)
+
+
+def get_storage_class(spec) -> Optional[StorageClass]:
+    """Return our storage class of the PVC with the given spec, if it has one.
+    """
+    return CONFIG.storage_classes.get(spec.get('storageClassName'))
+
+
+@kopf.index('', 'v1', 'persistentvolumeclaims')
+def pvcs_by_storage_class(namespace, name, spec, **_):
+    """Index all PVCs by storage class.
+
+    Whether a storage class is ours changes as storage classes are
+    cached, so readers only look up the storage classes they care about.
+    """
+    storage_class_name = spec.get('storageClassName')
+    if storage_class_name is None:
+        return {}
+    return {storage_class_name: (namespace, name)}
+
+
+@kopf.on.event('', 'v1', 'nodes')
+def cache_node(event, name, meta, **_):
+    """Cache the labels of nodes for placement and the
+    capacity the agents publish for their node.
+    """
+    if event['type'] == 'DELETED':
+        placement.update_node_labels(name, None)
+        capacity.CACHE.remove(name)
+        return
+    placement.update_node_labels(name, meta.labels)
+    annotation = meta.annotations.get(capacity.ANNOTATION)
+    if annotation:
+        capacity.CACHE.update(name, annotation)
+    else:
+        capacity.CACHE.remove(name)
+
+
+def _strip_prefix(items, prefix):
+    return {k[len(prefix):]:v for k,v in items.items() if k.startswith(prefix)}
+
+
+def get_zfs_properties(storage_class, annotations, volume=False):
+    """Return the zfs properties to set on the dataset of a PVC from the
+    parameters of its storage class, optionally overridden by its annotations.
+
+    Storage classes serve both filesystems and volumes, so their
+    properties that do not apply to the type of dataset are dropped.
+
+    Raise zfs.ZfsPropertyError for properties that are not allowed.
+    """
+    properties = zfs.applicable_properties(
+        _strip_prefix(storage_class.parameters, CONFIG.zfs_property_parameter_prefix), volume=volume)
+    if CONFIG.pvc_zfs_properties:
+        properties.update(_strip_prefix(annotations, CONFIG.zfs_property_annotation_prefix))
+    zfs.check_properties(properties, volume=volume)
+    return properties
+
+
+async def get_data_source(namespace, spec):
+    """Return the name of the dataset or snapshot the PVC with the given
+    spec is cloned from and the node it lives on, or None and None.
+    """
+    data_source = spec.get('dataSource')
+    if not data_source:
+        return None, None
+    kind = (data_source.get('apiGroup') or '', data_source.get('kind'))
+    name = data_source['name']
+    try:
+        if kind == ('', 'PersistentVolumeClaim'):
+            v1 = kubernetes_asyncio.client.CoreV1Api(kube.get_api_client())
+            obj = await v1.read_namespaced_persistent_volume_claim(name, namespace)
+            annotation = (obj.metadata.annotations or {}).get(CONFIG.dataset_annotation)
+            if annotation:
+                source = datasets.Dataset(**json.loads(annotation))
+                return source.full_name, source.selected_node
+        elif kind == (SNAPSHOT_GROUP, 'VolumeSnapshot'):
+            api = kubernetes_asyncio.client.CustomObjectsApi(kube.get_api_client())
+            obj = await api.get_namespaced_custom_object(SNAPSHOT_GROUP, SNAPSHOT_VERSION,
+                namespace, 'volumesnapshots', name)
+            annotation = obj['metadata'].get('annotations', {}).get(CONFIG.snapshot_annotation)
+            if annotation and obj.get('status', {}).get('readyToUse'):
+                snapshot = json.loads(annotation)
+                return snapshot['snapshot'], snapshot['selected_node']
+        else:
+            raise kopf.PermanentError(f'Unsupported data source: {"/".join(kind)}')
+    except kubernetes_asyncio.client.rest.ApiException as e:
+        if e.status != 404:
+            raise
+    raise kopf.TemporaryError(f'Data source {kind[1]} {name} is not ready', delay=30)
 
 
 def filter_create_dataset(body, meta, spec, status, **_):
@@ -166,27 +459,22 @@ def filter_create_dataset(body, meta, spec, status, **_):
     if CONFIG.dataset_phase_annotations['create'] in meta.annotations:
         return False
 
-    handle_it = False
-    try:
-        # Only care about PVCs that have a storage class that we are responsible for.
-        storage_class_name = spec['storageClassName']
-        storage_class = CONFIG.storage_classes[storage_class_name]
-        handle_it = True
+    # Only care about PVCs that have a storage class that we are responsible for.
+    storage_class = get_storage_class(spec)
+    if storage_class is None:
+        return False
 
-        # Check storage class specific settings.
-        if storage_class.volumeBindingMode == 'WaitForFirstConsumer':
-            handle_it = 'volume.kubernetes.io/selected-node' in meta.annotations
-    except KeyError:
-        handle_it = False
-    return handle_it
+    # Check storage class specific settings.
+    if storage_class.volumeBindingMode == 'WaitForFirstConsumer':
+        return SELECTED_NODE_ANNOTATION in meta.annotations
+    return True
 
 
-@kopf.on.resume('', 'v1', 'persistentvolumeclaims',
-    when=filter_create_dataset)
 @kopf.on.create('', 'v1', 'persistentvolumeclaims',
     when=filter_create_dataset)
 @kopf.on.update('', 'v1', 'persistentvolumeclaims',
     when=filter_create_dataset)
+@trace.traced('create', since='creationTimestamp')
 async def create_dataset(name, namespace, body, meta, spec, patch, logger, **_):
     """Schedule a pod that creates the zfs dataset.
     Create the persistent volume to fullfill this claim.
@@ -197,25 +485,73 @@ async def create_dataset(name, namespace, body, meta, spec, patch, logger, **_):
     pv_name = f'pvc-{meta.uid}'
 
     storage_class_mode = storage_class.parameters.get('mode', 'local')
-    if storage_class_mode == storage_class.MODE_LOCAL:
-        selected_node = meta.annotations['volume.kubernetes.io/selected-node']
-        if CONFIG.dataset_config:
-            dataset_config = CONFIG.dataset_config['node_dataset_map']
-            # Optionally check for node specific parent dataset name.
-            parent_dataset = dataset_config.get(selected_node,
-                dataset_config.get('__default__', CONFIG.parent_dataset)
-            )
-            log.info(parent_dataset)
-        else:
-            parent_dataset = CONFIG.parent_dataset
-        dataset_name = pv_name
-        mount_point = os.path.join(CONFIG.dataset_mount_dir, pv_name)
+    if CONFIG.dataset_annotation in meta.annotations:
+        # The dataset exists already, e.g. creating the persistent volume failed.
+        dataset = datasets.Dataset(**json.loads(meta.annotations[CONFIG.dataset_annotation]))
+        log.info('%s: using existing zfs dataset %s:%s', name, dataset.selected_node, dataset.full_name)
+    elif storage_class_mode == storage_class.MODE_LOCAL:
+        volume_mode = spec.get('volumeMode', 'Filesystem')
+        try:
+            properties = get_zfs_properties(storage_class, meta.annotations,
+                volume=volume_mode == 'Block')
+        except zfs.ZfsPropertyError as e:
+            raise kopf.PermanentError(str(e))
+        origin, origin_node = await get_data_source(namespace, spec)
+        # Clones have to live next to their origin.
+        selected_node = meta.annotations.get(SELECTED_NODE_ANNOTATION, origin_node)
+        if origin and selected_node != origin_node:
+            raise kopf.PermanentError(f'Can not clone {origin_node}:{origin} to node {selected_node}')
 
         storage = None
         try:
             storage = spec['resources']['requests']['storage']
         except KeyError as e:
             log.error(e)
+        size = datasets.size_in_bytes(storage) if storage else 0
+
+        if not selected_node and capacity.CACHE.reports:
+            # Nobody selected a node, e.g. with Immediate binding, use the one with the most room.
+            parents = {}
+            for node_name in capacity.CACHE.reports:
+                try:
+                    parents[node_name] = placement.place(node_name, storage_class_name, size)
+                except placement.NoCandidateError:
+                    continue
+            selected_node = capacity.CACHE.pick({k:v for k,v in parents.items() if v},
+                size, CONFIG.capacity_max_age, CONFIG.capacity_overcommit)
+            if selected_node is None:
+                raise kopf.TemporaryError(f'No node has room for {storage}', delay=60)
+        if not selected_node:
+            # E.g. Immediate binding before any node reported its capacity.
+            raise kopf.TemporaryError('No node selected and no capacity reports to pick one from', delay=60)
+        if origin:
+            # Clones live in the same pool as their origin.
+            parent_dataset = os.path.dirname(origin.split('@', 1)[0])
+            fits = capacity.CACHE.fits(selected_node, parent_dataset, size,
+                CONFIG.capacity_max_age, CONFIG.capacity_overcommit)
+        else:
+            try:
+                parent_dataset = placement.place(selected_node, storage_class_name, size)
+            except placement.NoCandidateError as e:
+                # A config problem, another node would not help and
+                # rescheduling might pick the same node over and over.
+                kopf.warn(body, reason='NoParentDataset', message=str(e))
+                raise kopf.TemporaryError(str(e), delay=300)
+            fits = parent_dataset is not None
+        if fits is False:
+            message = f'{storage} do not fit into any parent dataset on node {selected_node}'
+            if origin or SELECTED_NODE_ANNOTATION not in meta.annotations:
+                raise kopf.TemporaryError(message, delay=60)
+            # Have the scheduler select another node.
+            log.info('%s: %s, rescheduling', name, message)
+            kopf.warn(body, reason='Rescheduling', message=message)
+            patch.metadata.annotations[SELECTED_NODE_ANNOTATION] = None
+            return
+
+        dataset_name = pv_name
+        mount_point = None
+        if volume_mode != 'Block':
+            mount_point = os.path.join(CONFIG.dataset_mount_dir, pv_name)
 
         dataset = datasets.Dataset(
             name=dataset_name,
@@ -223,11 +559,24 @@ async def create_dataset(name, namespace, body, meta, spec, patch, logger, **_):
             mount_point=mount_point,
             selected_node=selected_node,
             size=storage,
+            origin=origin,
+            properties=properties,
+            volume_mode=volume_mode,
+            sparse=storage_class.parameters.get('sparse', 'false').lower() == 'true',
+            storage_class=storage_class.name,
         )
         message = f'zfs dataset {selected_node}:{dataset.full_name}'
+        if origin:
+            message = f'{message} from {origin}'
         log.info('%s: creating %s', name, message)
-        # TODO: proper error handling with exceptions
-        obj = await dataset.create(namespace)
+        # Account for the dataset right away so that concurrent claims see it.
+        capacity.CACHE.commit(selected_node, parent_dataset, size)
+        try:
+            with metrics.STAGE_DURATION.labels('create', 'dataset').time():
+                obj = await dataset.create()
+        except datasets.DatasetError as e:
+            capacity.CACHE.commit(selected_node, parent_dataset, -size, datasets=-1)
+            raise kopf.TemporaryError(f'Failed to create {message}: {e}', delay=60)
         kopf.info(body, reason='Created', message=f'created {message}')
         log.debug('obj: %s', obj)
 
@@ -240,31 +589,41 @@ async def create_dataset(name, namespace, body, meta, spec, patch, logger, **_):
     else:
         raise kopf.HandlerFatalError(f'Unsupported storage class mode: {storage_class_mode}')
 
+    await create_persistent_volume(name, namespace, spec, storage_class, dataset)
+    kopf.info(body, reason='Bound', message=f'bound persistent volume {pv_name}')
+
 
-    template = get_template('pvc.yaml')
-    text = template.format(
+async def create_persistent_volume(name, namespace, spec, storage_class, dataset):
+    """Create the persistent volume for dataset that fullfills the given claim,
+    unless it exists already.
+    """
+    data = builders.PV_BUILDER.build(
         provisioner_name=storage_class.provisioner,
-        pv_name=pv_name,
+        pv_name=dataset.name,
         access_mode=spec['accessModes'][0],
         storage=spec['resources']['requests']['storage'],
         pvc_name=name,
         pvc_namespace=namespace,
-        local_path=mount_point,
-        selected_node_name=selected_node,
-        storage_class_name=storage_class_name,
-        volume_mode=spec['volumeMode'],
+        local_path=dataset.device if dataset.is_block else dataset.mount_point,
+        selected_node_name=dataset.selected_node,
+        storage_class_name=storage_class.name,
+        volume_mode=dataset.volume_mode,
         reclaim_policy=storage_class.reclaimPolicy,
     )
-    data = yaml.safe_load(text)
+    # Store the dataset on the volume too, so it can be found after the claim is gone.
+    data['metadata']['annotations'][CONFIG.dataset_annotation] = json.dumps(dataclasses.asdict(dataset))
 
-    message = f'persistent volume {pv_name}'
-    log.info('%s: creating %s', name, message)
-    async with kubernetes_asyncio.client.ApiClient() as api:
-        v1 = kubernetes_asyncio.client.CoreV1Api(api)
-        obj = await v1.create_persistent_volume(
-            body=data,
-        )
-    kopf.info(body, reason='Bound', message=f'bound {message}')
+    log.info('%s: creating persistent volume %s', name, dataset.name)
+    v1 = kubernetes_asyncio.client.CoreV1Api(kube.get_api_client())
+    try:
+        with metrics.STAGE_DURATION.labels('create', 'pv').time(), \
+                metrics.count_api_errors(dataset.selected_node, storage_class.name, 'create'), \
+                trace.span('pv'):
+            await v1.create_persistent_volume(body=data)
+    except kubernetes_asyncio.client.rest.ApiException as e:
+        if e.status != 409:
+            raise
+        log.info('%s: persistent volume %s exists already', name, dataset.name)
 
 
 def filter_delete_dataset(body, meta, spec, status, **_):
@@ -280,23 +639,14 @@ def filter_delete_dataset(body, meta, spec, status, **_):
     if CONFIG.dataset_phase_annotations['delete'] in meta.annotations:
         return False
 
-    handle_it = False
-    try:
-        # Only care about PVCs that have a storage class that we are responsible for.
-        storage_class_name = spec['storageClassName']
-        storage_class = CONFIG.storage_classes[storage_class_name]
-        handle_it = True
-
-        # Check storage class specific settings.
-        if storage_class.reclaimPolicy == storage_class.RECLAIM_POLICY_DELETE:
-            handle_it = True
-    except KeyError:
-        handle_it = False
-    return handle_it
+    # Only care about PVCs that have a storage class that we are responsible for.
+    # The reclaim policy is checked by the handler.
+    return get_storage_class(spec) is not None
 
 
 @kopf.on.delete('', 'v1', 'persistentvolumeclaims',
     when=filter_delete_dataset)
+@trace.traced('delete', since='deletionTimestamp')
 async def delete_dataset(name, namespace, body, meta, spec, **_):
     """Schedule a pod that deletes the zfs dataset.
     """
@@ -308,17 +658,20 @@ async def delete_dataset(name, namespace, body, meta, spec, **_):
         # TODO: do I really have to care about storage class mode when
         #       taking the dataset from a annotation or is everything already
         #       correct for any mode?
+        dataset_dict = json.loads(meta.annotations[CONFIG.dataset_annotation])
+        dataset = datasets.Dataset(**dataset_dict)
+        dataset.storage_class = storage_class_name
+        log.debug('delete_dataset: %s', dataset)
 
         if storage_class.reclaimPolicy == storage_class.RECLAIM_POLICY_DELETE:
             # Only delete datasets if reclaimPolicy says so.
-            dataset_dict = json.loads(meta.annotations[CONFIG.dataset_annotation])
-            dataset = datasets.Dataset(**dataset_dict)
-            log.debug('delete_dataset: %s', dataset)
-
             message = f'zfs dataset {dataset.selected_node}:{dataset.full_name}'
             log.info('%s: deleting %s', name, message)
-            # TODO: proper error handling with exceptions
-            obj = await dataset.delete(namespace)
+            try:
+                with metrics.STAGE_DURATION.labels('delete', 'dataset').time():
+                    obj = await dataset.delete()
+            except datasets.DatasetError as e:
+                raise kopf.TemporaryError(f'Failed to delete {message}: {e}', delay=60)
             kopf.info(body, reason='Deleted', message='deleted {message}')
             log.debug('obj: %s', obj)
 
@@ -326,8 +679,10 @@ async def delete_dataset(name, namespace, body, meta, spec, **_):
         pv_name = spec['volumeName']
         message = f'persistent volume {pv_name}'
         log.info('%s: deleting %s', name, message)
-        async with kubernetes_asyncio.client.ApiClient() as api:
-            v1 = kubernetes_asyncio.client.CoreV1Api(api)
+        v1 = kubernetes_asyncio.client.CoreV1Api(kube.get_api_client())
+        with metrics.STAGE_DURATION.labels('delete', 'pv').time(), \
+                metrics.count_api_errors(dataset.selected_node, storage_class_name, 'delete'), \
+                trace.span('pv'):
             obj = await v1.delete_persistent_volume(pv_name)
         kopf.info(body, reason='Unbound', message='unbound {message}')
 
@@ -338,6 +693,229 @@ async def delete_dataset(name, namespace, body, meta, spec, **_):
         raise kopf.HandlerFatalError(f'Unsupported storage class mode: {storage_class_mode}')
 
 
+def filter_resize_dataset(meta, spec, status, **_):
+    """Filter function for resume and update handlers that filters out
+    the bound PVCs which request more storage than they have.
+    """
+    if status.get('phase', None) != 'Bound':
+        return False
+    if CONFIG.dataset_annotation not in meta.annotations:
+        return False
+
+    # Only care about storage classes that allow expansion.
+    storage_class = get_storage_class(spec)
+    if storage_class is None or not storage_class.allowVolumeExpansion:
+        return False
+
+    requested = spec.get('resources', {}).get('requests', {}).get('storage')
+    capacity = status.get('capacity', {}).get('storage')
+    if not requested or not capacity:
+        return False
+    return datasets.size_in_bytes(requested) > datasets.size_in_bytes(capacity)
+
+
+@kopf.on.update('', 'v1', 'persistentvolumeclaims',
+    when=filter_resize_dataset)
+async def resize_dataset(name, namespace, body, meta, spec, patch, **_):
+    """Grow the refquota of the zfs dataset in place.
+    Update the capacity of the persistent volume and the claim.
+    """
+    storage_class_name = spec['storageClassName']
+    storage = spec['resources']['requests']['storage']
+    dataset = datasets.Dataset(**json.loads(meta.annotations[CONFIG.dataset_annotation]))
+    old_size = datasets.size_in_bytes(dataset.size) if dataset.size else 0
+    dataset.size = storage
+    dataset.storage_class = storage_class_name
+
+    message = f'zfs dataset {dataset.selected_node}:{dataset.full_name}'
+    log.info('%s: resizing %s to %s', name, message, storage)
+    try:
+        with metrics.STAGE_DURATION.labels('resize', 'dataset').time():
+            await dataset.resize()
+    except datasets.DatasetError as e:
+        raise kopf.TemporaryError(f'Failed to resize {message}: {e}', delay=60)
+    kopf.info(body, reason='Resized', message=f'resized {message} to {storage}')
+    # Account for the growth until the node reports again.
+    capacity.CACHE.commit(dataset.selected_node, dataset.parent,
+        datasets.size_in_bytes(storage) - old_size, datasets=0)
+
+    # Keep the stored dataset in sync.
+    patch.metadata.annotations[CONFIG.dataset_annotation] = json.dumps(dataclasses.asdict(dataset))
+
+    # The volume is a local path, there is no file system to grow,
+    # so the new capacity is available right away.
+    pv_name = spec['volumeName']
+    v1 = kubernetes_asyncio.client.CoreV1Api(kube.get_api_client())
+    with metrics.STAGE_DURATION.labels('resize', 'pv').time(), \
+            metrics.count_api_errors(dataset.selected_node, storage_class_name, 'resize'):
+        await v1.patch_persistent_volume(pv_name,
+            {'spec': {'capacity': {'storage': storage}}})
+        await v1.patch_namespaced_persistent_volume_claim_status(name, namespace,
+            {'status': {'capacity': {'storage': storage}}})
+
+
+SNAPSHOT_GROUP = 'snapshot.storage.k8s.io'
+SNAPSHOT_VERSION = 'v1'
+# The api client defaults to json patches for custom objects.
+MERGE_PATCH = 'application/merge-patch+json'
+
+
+def filter_snapshot_driver(body, **_):
+    return body.get('driver', None) == CONFIG.provisioner_name
+
+
+@kopf.on.event(SNAPSHOT_GROUP, SNAPSHOT_VERSION, 'volumesnapshotclasses')
+def cache_snapshot_class(event, name, body, **_):
+    """Keep CONFIG.snapshot_classes in sync with the volume
+    snapshot classes that use our driver.
+    """
+    if event['type'] != 'DELETED' and filter_snapshot_driver(body):
+        if name not in CONFIG.snapshot_classes:
+            log.info('Watching for volume snapshots with class: %s', name)
+        CONFIG.snapshot_classes[name] = body.get('deletionPolicy', 'Delete')
+    elif CONFIG.snapshot_classes.pop(name, None) is not None:
+        log.info('No longer watching for volume snapshots with class: %s', name)
+
+
+def filter_create_snapshot(meta, spec, status, **_):
+    """Filter function for volume snapshots that we have to take.
+    """
+    # Only care about snapshots we did not take yet.
+    if CONFIG.snapshot_annotation in meta.annotations:
+        return False
+    # Pre-provisioned snapshots are bound already.
+    if status.get('boundVolumeSnapshotContentName'):
+        return False
+    return (spec.get('volumeSnapshotClassName') in CONFIG.snapshot_classes
+        and 'persistentVolumeClaimName' in spec.get('source', {}))
+
+
+@kopf.on.resume(SNAPSHOT_GROUP, SNAPSHOT_VERSION, 'volumesnapshots',
+    when=filter_create_snapshot)
+@kopf.on.create(SNAPSHOT_GROUP, SNAPSHOT_VERSION, 'volumesnapshots',
+    when=filter_create_snapshot)
+@kopf.on.update(SNAPSHOT_GROUP, SNAPSHOT_VERSION, 'volumesnapshots',
+    when=filter_create_snapshot)
+async def create_snapshot(name, namespace, body, meta, spec, patch, **_):
+    """Snapshot the dataset of the source PVC.
+    Create and bind the volume snapshot content for it.
+
+    The external snapshot-controller only handles CSI volumes,
+    so we take care of binding ourselves.
+    """
+    class_name = spec['volumeSnapshotClassName']
+    pvc_name = spec['source']['persistentVolumeClaimName']
+    v1 = kubernetes_asyncio.client.CoreV1Api(kube.get_api_client())
+    pvc = await v1.read_namespaced_persistent_volume_claim(pvc_name, namespace)
+    annotation = (pvc.metadata.annotations or {}).get(CONFIG.dataset_annotation)
+    if not annotation:
+        raise kopf.TemporaryError(f'PVC {pvc_name} has no dataset yet', delay=30)
+    dataset = datasets.Dataset(**json.loads(annotation))
+    dataset.storage_class = pvc.spec.storage_class_name
+
+    snapshot_name = f'snapshot-{meta.uid}'
+    snapshot = {
+        'snapshot': f'{dataset.full_name}@{snapshot_name}',
+        'selected_node': dataset.selected_node,
+        'deletion_policy': CONFIG.snapshot_classes[class_name],
+    }
+    message = f'zfs snapshot {dataset.selected_node}:{snapshot["snapshot"]}'
+    log.info('%s: creating %s', name, message)
+    try:
+        with metrics.STAGE_DURATION.labels('create', 'snapshot').time():
+            await datasets.snapshot(dataset, snapshot_name)
+    except datasets.DatasetError as e:
+        raise kopf.TemporaryError(f'Failed to create {message}: {e}', delay=60)
+    kopf.info(body, reason='Created', message=f'created {message}')
+
+    content_name = f'snapcontent-{meta.uid}'
+    content = {
+        'apiVersion': f'{SNAPSHOT_GROUP}/{SNAPSHOT_VERSION}',
+        'kind': 'VolumeSnapshotContent',
+        'metadata': {
+            'name': content_name,
+            'annotations': {CONFIG.snapshot_annotation: json.dumps(snapshot)},
+        },
+        'spec': {
+            'deletionPolicy': snapshot['deletion_policy'],
+            'driver': CONFIG.provisioner_name,
+            'source': {'snapshotHandle': snapshot['snapshot']},
+            'volumeSnapshotClassName': class_name,
+            'volumeSnapshotRef': {
+                'apiVersion': f'{SNAPSHOT_GROUP}/{SNAPSHOT_VERSION}',
+                'kind': 'VolumeSnapshot',
+                'name': name,
+                'namespace': namespace,
+                'uid': meta.uid,
+            },
+        },
+    }
+    now = datetime.datetime.now(datetime.timezone.utc)
+    restore_size = (pvc.status.capacity or {}).get('storage', dataset.size)
+    api = kubernetes_asyncio.client.CustomObjectsApi(kube.get_api_client())
+    try:
+        await api.create_cluster_custom_object(SNAPSHOT_GROUP, SNAPSHOT_VERSION,
+            'volumesnapshotcontents', content)
+    except kubernetes_asyncio.client.rest.ApiException as e:
+        # Created by a previous attempt.
+        if e.status != 409:
+            raise
+    await api.patch_cluster_custom_object_status(SNAPSHOT_GROUP, SNAPSHOT_VERSION,
+        'volumesnapshotcontents', content_name, {'status': {
+            'snapshotHandle': snapshot['snapshot'],
+            'readyToUse': True,
+            'creationTime': int(now.timestamp() * 1e9),
+        }}, _content_type=MERGE_PATCH)
+    await api.patch_namespaced_custom_object_status(SNAPSHOT_GROUP, SNAPSHOT_VERSION,
+        namespace, 'volumesnapshots', name, {'status': {
+            'boundVolumeSnapshotContentName': content_name,
+            'readyToUse': True,
+            'creationTime': now.isoformat(),
+            'restoreSize': restore_size,
+        }}, _content_type=MERGE_PATCH)
+    kopf.info(body, reason='Bound', message=f'bound volume snapshot content {content_name}')
+
+    # Store snapshot for later use in deletion handler.
+    patch.metadata.annotations[CONFIG.snapshot_annotation] = json.dumps(snapshot)
+
+
+def filter_delete_snapshot(meta, **_):
+    return CONFIG.snapshot_annotation in meta.annotations
+
+
+@kopf.on.delete(SNAPSHOT_GROUP, SNAPSHOT_VERSION, 'volumesnapshots',
+    when=filter_delete_snapshot)
+async def delete_snapshot(name, namespace, body, meta, status, **_):
+    """Destroy the zfs snapshot and the volume snapshot content
+    if the deletionPolicy says so.
+
+    Snapshots that still have clones are destroyed by zfs
+    together with their last clone.
+    """
+    snapshot = json.loads(meta.annotations[CONFIG.snapshot_annotation])
+    if snapshot['deletion_policy'] != 'Delete':
+        return
+
+    message = f'zfs snapshot {snapshot["selected_node"]}:{snapshot["snapshot"]}'
+    log.info('%s: deleting %s', name, message)
+    try:
+        with metrics.STAGE_DURATION.labels('delete', 'snapshot').time():
+            await datasets.delete_snapshot(snapshot['snapshot'], snapshot['selected_node'])
+    except datasets.DatasetError as e:
+        raise kopf.TemporaryError(f'Failed to delete {message}: {e}', delay=60)
+    kopf.info(body, reason='Deleted', message=f'deleted {message}')
+
+    content_name = status.get('boundVolumeSnapshotContentName')
+    if content_name:
+        api = kubernetes_asyncio.client.CustomObjectsApi(kube.get_api_client())
+        try:
+            await api.delete_cluster_custom_object(SNAPSHOT_GROUP, SNAPSHOT_VERSION,
+                'volumesnapshotcontents', content_name)
+        except kubernetes_asyncio.client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+
+
 @click.command()
 @click.option('--verbose', '-v', 'log_level', flag_value='info', help='set log level to info', envvar='TENANTCTL_LOG_LEVEL')
 @click.option('--debug', '-d', 'log_level', flag_value='debug', help='set log level to debug', envvar='TENANTCTL_LOG_LEVEL')
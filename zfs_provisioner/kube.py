@@ -0,0 +1,182 @@
+import asyncio
+import dataclasses
+import logging
+import os
+import ssl
+import time
+
+import aiohttp
+import kubernetes_asyncio
+
+log = logging.getLogger('zfs-provisioner')
+
+from . import Error
+
+
+@dataclasses.dataclass
+class ApiStats:
+    """Counters for the requests made through the shared api client.
+    """
+    requests: int = 0
+    errors: int = 0
+    new_connections: int = 0
+    reused_connections: int = 0
+    # Sum of the latency of all finished requests in seconds.
+    latency: float = 0.0
+    # Requests delayed by the rate limit and the seconds they waited.
+    throttled: int = 0
+    throttle_wait: float = 0.0
+
+    @property
+    def average_latency(self):
+        finished = self.requests - self.errors
+        return self.latency / finished if finished else 0.0
+
+
+STATS = ApiStats()
+
+
+class TokenBucket:
+    """Allow on average `rate` acquisitions per second with bursts of up to `burst`.
+    A rate of 0 disables the limit.
+    """
+    def __init__(self, rate: float = 0, burst: int = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        """Take a token, wait for it if none is available.
+        Return the seconds waited.
+        """
+        if not self.rate:
+            return 0.0
+        self._refill()
+        # Take the token right away, possibly going negative, so that
+        # concurrent waiters queue up behind each other.
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        delay = -self.tokens / self.rate
+        await asyncio.sleep(delay)
+        return delay
+
+
+RATE_LIMIT = TokenBucket()
+
+_api_client = None
+
+
+def get_api_client() -> kubernetes_asyncio.client.ApiClient:
+    """Return the process wide, pooled api client.
+    """
+    if _api_client is None:
+        raise Error('The kubernetes api client has not been opened yet.')
+    return _api_client
+
+
+async def _on_request_start(session, context, params):
+    # Awaited by aiohttp before the request is sent, so waiting here throttles it.
+    delay = await RATE_LIMIT.acquire()
+    if delay:
+        STATS.throttled += 1
+        STATS.throttle_wait += delay
+    context.start = asyncio.get_running_loop().time()
+    STATS.requests += 1
+
+
+async def _on_request_end(session, context, params):
+    STATS.latency += asyncio.get_running_loop().time() - context.start
+
+
+async def _on_request_exception(session, context, params):
+    STATS.errors += 1
+
+
+async def _on_connection_create_end(session, context, params):
+    STATS.new_connections += 1
+
+
+async def _on_connection_reuseconn(session, context, params):
+    STATS.reused_connections += 1
+
+
+def _get_trace_config():
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(_on_request_start)
+    trace_config.on_request_end.append(_on_request_end)
+    trace_config.on_request_exception.append(_on_request_exception)
+    trace_config.on_connection_create_end.append(_on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(_on_connection_reuseconn)
+    return trace_config
+
+
+def _get_ssl_context(configuration):
+    # Mirrors what kubernetes_asyncio.client.rest does.
+    ssl_context = ssl.create_default_context(cafile=configuration.ssl_ca_cert)
+    if configuration.cert_file:
+        ssl_context.load_cert_chain(configuration.cert_file, keyfile=configuration.key_file)
+    if not configuration.verify_ssl:
+        ssl_context.check_hostname = False
+        ssl_context.verify_mode = ssl.CERT_NONE
+    return ssl_context
+
+
+async def load_config():
+    """Load the kubernetes_asyncio config, in cluster or from KUBECONFIG.
+    """
+    try:
+        # Try incluster config first.
+        kubernetes_asyncio.config.load_incluster_config()
+    except kubernetes_asyncio.config.ConfigException:
+        # Fall back to regular config, KUBECONFIG is read here as
+        # kubernetes_asyncio only reads it once on import.
+        await kubernetes_asyncio.config.load_kube_config(config_file=os.environ.get('KUBECONFIG'))
+
+
+async def open_api_client(connection_limit=20, keepalive_timeout=60, qps=0, burst=1):
+    """Create the process wide api client.
+    Requests are limited to qps per second with bursts of up to burst.
+    Kopf uses a client of its own that is not limited.
+
+    Must be called after the kubernetes_asyncio config has been loaded.
+    """
+    global _api_client, RATE_LIMIT
+    RATE_LIMIT = TokenBucket(qps, burst)
+    configuration = kubernetes_asyncio.client.Configuration.get_default_copy()
+    configuration.connection_pool_maxsize = connection_limit
+    api = kubernetes_asyncio.client.ApiClient(configuration)
+
+    # Replace the session created by the rest client with one that
+    # keeps connections alive and reports to our counters.
+    connector = aiohttp.TCPConnector(
+        limit=connection_limit,
+        keepalive_timeout=keepalive_timeout,
+        ssl=_get_ssl_context(configuration),
+    )
+    await api.rest_client.pool_manager.close()
+    api.rest_client.pool_manager = aiohttp.ClientSession(
+        connector=connector,
+        trust_env=True,
+        trace_configs=[_get_trace_config()],
+        read_bufsize=2**21,
+    )
+    _api_client = api
+    log.debug('kube: opened api client with connection_limit: %s, keepalive_timeout: %s, qps: %s, burst: %s',
+        connection_limit, keepalive_timeout, qps, burst)
+    return api
+
+
+async def close_api_client():
+    global _api_client
+    if _api_client is not None:
+        await _api_client.close()
+        _api_client = None
+        log.info('kube: api stats: %s, average latency: %.3fs',
+            STATS, STATS.average_latency)
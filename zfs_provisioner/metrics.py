@@ -0,0 +1,137 @@
+import contextlib
+import logging
+
+import kubernetes_asyncio
+import prometheus_client
+
+from prometheus_client.core import CounterMetricFamily
+
+log = logging.getLogger('zfs-provisioner')
+
+from . import kube
+
+
+STAGE_DURATION = prometheus_client.Histogram(
+    'zfs_provisioner_stage_duration_seconds',
+    'Duration of the stages of provisioning and deleting volumes.',
+    ['action', 'stage'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300),
+)
+
+ZFS_COMMAND_DURATION = prometheus_client.Histogram(
+    'zfs_provisioner_zfs_command_duration_seconds',
+    'Duration of zfs subprocesses.',
+    ['command'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+IN_FLIGHT = prometheus_client.Gauge(
+    'zfs_provisioner_operations_in_flight',
+    'Number of operations currently in progress.',
+    ['action'],
+)
+
+API_ERRORS = prometheus_client.Counter(
+    'zfs_provisioner_api_errors_total',
+    'Number of failed kubernetes api calls.',
+    ['node', 'storage_class', 'action'],
+)
+
+SCHEDULER_QUEUE_DEPTH = prometheus_client.Gauge(
+    'zfs_provisioner_scheduler_queue_depth',
+    'Number of dataset operations waiting for a free slot.',
+    ['action'],
+)
+
+SCHEDULER_WAIT = prometheus_client.Histogram(
+    'zfs_provisioner_scheduler_wait_seconds',
+    'Seconds dataset operations waited for a free slot.',
+    ['action'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+
+CONFIG_RELOADS = prometheus_client.Counter(
+    'zfs_provisioner_config_reloads_total',
+    'Number of config and template (re)loads by result.',
+    ['file', 'result'],
+)
+
+CONFIG_RELOAD_DURATION = prometheus_client.Histogram(
+    'zfs_provisioner_config_reload_duration_seconds',
+    'Seconds from the first change of a config or template file until it was reloaded.',
+    ['file'],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+RECONCILE_ACTIONS = prometheus_client.Counter(
+    'zfs_provisioner_reconcile_actions_total',
+    'Number of actions taken by the startup reconciliation by action and result.',
+    ['action', 'result'],
+)
+
+SWEPT = prometheus_client.Counter(
+    'zfs_provisioner_swept_total',
+    'Number of left over pods and datasets deleted by the sweeper by kind and result.',
+    ['kind', 'result'],
+)
+
+ORPHANED_DATASETS = prometheus_client.Gauge(
+    'zfs_provisioner_orphaned_datasets',
+    'Number of datasets no persistent volume or claim uses, as of the last sweep.',
+)
+
+SHARD_MEMBERS = prometheus_client.Gauge(
+    'zfs_provisioner_shard_members',
+    'Number of controller replicas that split the claims between them.',
+)
+
+SHARD_MOVES = prometheus_client.Counter(
+    'zfs_provisioner_shard_moves_total',
+    'Number of claims and volume snapshots this replica labelled with their owner by reason.',
+    ['kind', 'reason'],
+)
+
+
+class ApiStatsCollector:
+    """Expose the counters of the shared kubernetes api client.
+    """
+    def collect(self):
+        stats = kube.STATS
+        for name, value, documentation in (
+            ('requests', stats.requests, 'Number of kubernetes api requests.'),
+            ('request_errors', stats.errors, 'Number of kubernetes api requests that failed.'),
+            ('new_connections', stats.new_connections, 'Number of new connections to the api server.'),
+            ('reused_connections', stats.reused_connections, 'Number of reused connections to the api server.'),
+            ('request_latency_seconds', stats.latency, 'Total latency of kubernetes api requests.'),
+            ('throttled_requests', stats.throttled, 'Number of kubernetes api requests delayed by the rate limit.'),
+            ('throttle_wait_seconds', stats.throttle_wait, 'Total seconds kubernetes api requests were delayed by the rate limit.'),
+        ):
+            yield CounterMetricFamily(f'zfs_provisioner_api_{name}', documentation, value=value)
+
+
+prometheus_client.REGISTRY.register(ApiStatsCollector())
+
+
+@contextlib.contextmanager
+def count_api_errors(node, storage_class, action):
+    """Count kubernetes api errors raised in the body by node, storage class and action.
+    """
+    try:
+        yield
+    except kubernetes_asyncio.client.rest.ApiException:
+        API_ERRORS.labels(node or '', storage_class or '', action).inc()
+        raise
+
+
+def observe_pod_timings(action, timings):
+    for phase, seconds in timings.items():
+        if seconds is not None:
+            STAGE_DURATION.labels(action, f'pod_{phase}').observe(seconds)
+
+
+def serve(port):
+    """Serve /metrics on the given port from a background thread.
+    """
+    if port:
+        log.info('Serving metrics on port %s', port)
+        prometheus_client.start_http_server(port)
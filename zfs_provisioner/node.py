@@ -0,0 +1,396 @@
+import logging
+import os
+
+log = logging.getLogger('zfs-provisioner')
+
+from . import aiozfs
+from . import zfs
+
+
+# Seconds after which the dataset inventory of a parent is reloaded.
+INVENTORY_MAX_AGE = 60
+
+# User property marking datasets whose volume has been deleted but
+# which are kept until their last snapshot is gone.
+DESTROYED_PROPERTY = 'zfs-provisioner:destroyed'
+
+# Prefix of the snapshots taken to clone a dataset.
+CLONE_SNAPSHOT_PREFIX = 'clone-'
+
+# Volume sizes are rounded up to a multiple of this, the
+# largest volblocksize, as zfs requires.
+VOLSIZE_ALIGNMENT = 128 * 1024
+
+
+async def _clone(dataset, mountpoint, origin, quota=None, refquota=None, properties=None):
+    """Create dataset as a clone of origin which is either
+    a snapshot or a dataset that is snapshotted first.
+    """
+    snapshot = origin
+    if '@' not in origin:
+        snapshot = f'{origin}@{CLONE_SNAPSHOT_PREFIX}{os.path.basename(dataset)}'
+        try:
+            await aiozfs.snapshot(snapshot)
+        except zfs.ZfsCommandError as e:
+            # Left over from a previous attempt.
+            if e.reason != 'exists':
+                raise
+    await aiozfs.clone(snapshot, dataset, mountpoint=mountpoint, quota=quota, refquota=refquota,
+        **(properties or {}))
+    if snapshot != origin:
+        # Nothing but the clone needs the snapshot, let zfs destroy
+        # it together with the clone.
+        await aiozfs.destroy(snapshot, '-d')
+
+
+def _volsize(volsize):
+    return -(-int(volsize) // VOLSIZE_ALIGNMENT) * VOLSIZE_ALIGNMENT
+
+
+async def _create_volume(dataset, volsize, sparse=False, origin=None, properties=None):
+    volsize = _volsize(volsize)
+    if origin:
+        # The block size of clones is that of their origin.
+        properties = {k:v for k,v in (properties or {}).items() if k != 'volblocksize'}
+        await _clone(dataset, None, origin, properties=properties)
+        # Clones start with the size of their origin, only ever grow them.
+        if volsize > int((await aiozfs.get_properties(dataset, 'volsize'))['volsize']):
+            await aiozfs.set_properties(dataset, volsize=volsize)
+        return
+    args = ['-V', str(volsize)]
+    if sparse:
+        args.append('-s')
+    await aiozfs.create(dataset, *args, **(properties or {}))
+
+
+async def create_dataset(dataset, mountpoint=None, quota=None, refquota=None, origin=None,
+        properties=None, volsize=None, sparse=False):
+    """Create the given dataset and mount it to mountpoint
+    while optionally setting a quota and/or refquota.
+
+    If origin, a dataset or a snapshot, is given the
+    dataset is created as a clone of it.
+
+    properties are additional zfs properties from
+    zfs.TUNABLE_PROPERTIES to set on the dataset.
+
+    If volsize is given a volume (zvol) of that size, optionally
+    sparse, is created instead of a filesystem. It has no mountpoint
+    and is available as a block device under /dev/zvol.
+
+    Ensure that the parent dataset, determined from dataset,
+    exists and ensure it has safe permissions.
+    """
+    properties = properties or {}
+    zfs.check_properties(properties, volume=bool(volsize))
+
+    # Ensure we have parent dataset whith mountpoint set to legacy.
+    parent = os.path.split(dataset)[0]
+    await aiozfs.ensure(parent, mountpoint='legacy')
+
+    if volsize:
+        await _create_volume(dataset, volsize, sparse=sparse, origin=origin, properties=properties)
+        return
+
+    # Ensure the mountpoints parent folder exists and has safe permissions.
+    _prepare_mountpoint_dirs([{'mountpoint': mountpoint}])
+
+    # Create our dataset and ensure it is writable by the pod.
+    if origin:
+        await _clone(dataset, mountpoint, origin, quota=quota, refquota=refquota, properties=properties)
+    else:
+        await aiozfs.create(dataset, mountpoint=mountpoint, quota=quota, refquota=refquota, **properties)
+    os.chmod(mountpoint, 0o777)
+
+
+async def _get_snapshots(root):
+    try:
+        return await aiozfs.snapshots(root)
+    except zfs.ZfsCommandError as e:
+        if e.reason != 'not_found':
+            raise
+        return {}
+
+
+def _snapshots_of(dataset, snapshots):
+    return [name for name in snapshots if name.split('@', 1)[0] == dataset]
+
+
+async def _destroy(dataset, snapshots=None):
+    """Destroy dataset unless it still has snapshots, e.g. backing
+    volume snapshots or clones. Such datasets are only unmounted and
+    marked as destroyed, `_release` destroys them later on.
+    """
+    if snapshots is None:
+        snapshots = await _get_snapshots(dataset)
+    if _snapshots_of(dataset, snapshots):
+        log.info('node: keeping dataset %s until its snapshots are destroyed', dataset)
+        properties = {DESTROYED_PROPERTY: 'yes'}
+        if (await aiozfs.get_properties(dataset, 'type'))['type'] != 'volume':
+            await aiozfs.unmount(dataset)
+            properties['mountpoint'] = 'none'
+        await aiozfs.set_properties(dataset, **properties)
+        return
+    try:
+        origin = (await aiozfs.get_properties(dataset, 'origin'))['origin']
+    except zfs.ZfsCommandError as e:
+        if e.reason != 'not_found':
+            raise
+        # Already gone, like destroy_datasets reports it.
+        return
+    await aiozfs.destroy(dataset)
+    await _release(origin)
+
+
+async def _release(snapshot):
+    """Destroy the dataset of snapshot, a former origin, if it
+    has been marked as destroyed and has no snapshots left.
+    """
+    if not snapshot or snapshot == '-':
+        return
+    dataset = snapshot.split('@', 1)[0]
+    try:
+        destroyed = (await aiozfs.get_properties(dataset, DESTROYED_PROPERTY))[DESTROYED_PROPERTY]
+    except zfs.ZfsCommandError as e:
+        if e.reason == 'not_found':
+            return
+        raise
+    if destroyed == 'yes':
+        await _destroy(dataset)
+
+
+async def destroy_dataset(dataset, mountpoint=None):
+    """Destroy the given dataset and delete it's former mountpoint.
+    """
+    # Destroy the dataset.
+    await _destroy(dataset)
+
+    # Delete the mountpint, volumes have none.
+    if mountpoint:
+        try:
+            os.rmdir(mountpoint)
+        except FileNotFoundError:
+            pass
+
+
+async def resize_dataset(dataset, quota=None, refquota=None, volsize=None):
+    """Change the quota and/or refquota of the given dataset
+    or the volsize of the given volume.
+    """
+    if volsize is not None:
+        volsize = _volsize(volsize)
+    properties = {k:v for k,v in (('quota', quota), ('refquota', refquota), ('volsize', volsize))
+        if v is not None}
+    if properties:
+        await aiozfs.set_properties(dataset, **properties)
+
+
+async def create_snapshot(dataset):
+    """Create the snapshot dataset, e.g. pool/pvc-x@snapshot-y.
+    """
+    try:
+        await aiozfs.snapshot(dataset)
+    except zfs.ZfsCommandError as e:
+        # Already created by a previous attempt.
+        if e.reason != 'exists':
+            raise
+
+
+async def destroy_snapshot(dataset):
+    """Destroy the snapshot dataset.
+
+    Snapshots that still have clones are marked for deferred
+    destruction, zfs destroys them together with their last clone.
+    """
+    info = (await _get_snapshots(dataset.split('@', 1)[0])).get(dataset)
+    if info is None:
+        # Already gone.
+        return
+    if info['clones']:
+        await aiozfs.destroy(dataset, '-d')
+        return
+    await aiozfs.destroy(dataset)
+    await _release(dataset)
+
+
+def _live_children(children):
+    return sorted(name for name, properties in children.items()
+        if properties[DESTROYED_PROPERTY] != 'yes')
+
+
+async def list_datasets(parents):
+    """Return a dict that maps each of the given parent datasets to the
+    names of the datasets below it, without the ones kept for their snapshots.
+    Parents that do not exist (yet) are left out.
+    """
+    result = {}
+    for parent in parents:
+        try:
+            result[parent] = _live_children(await aiozfs.children(parent, DESTROYED_PROPERTY))
+        except zfs.ZfsCommandError as e:
+            if e.reason != 'not_found':
+                raise
+    return result
+
+
+async def _call(func, *args, **kwargs):
+    """Call and await func and return None on success or the error message.
+    """
+    try:
+        await func(*args, **kwargs)
+        return None
+    except (zfs.ZfsCommandError, zfs.ZfsPropertyError, OSError) as e:
+        return str(e)
+
+
+async def create_datasets(items):
+    """Create many datasets at once, in parallel.
+
+    `items` is a list of dicts with the same keys as the arguments
+    of `create_dataset`.
+    Return a dict that maps each dataset name to None on success
+    or to an error message.
+    """
+    for parent in {os.path.split(item['dataset'])[0] for item in items}:
+        # Answer existence checks for the parent and all its children
+        # with a single `zfs list`.
+        await aiozfs.load_inventory(parent, max_age=INVENTORY_MAX_AGE)
+        await aiozfs.ensure(parent, mountpoint='legacy')
+    _prepare_mountpoint_dirs(items)
+
+    items, results = _check_items(items)
+    single = _get_single_items(items)
+    results.update(await aiozfs.create_many({item['dataset']: _get_create_properties(item)
+        for item in items if item not in single}))
+    for item in items:
+        if item not in single and results[item['dataset']] is None:
+            os.chmod(item['mountpoint'], 0o777)
+
+    for item in single:
+        # Clones and volumes are rare, create them one by one.
+        results[item['dataset']] = await _call(create_dataset, **item)
+    return results
+
+
+def _check_items(items):
+    """Split off the items with properties that may not be set.
+    Return the remaining items and the results of the others.
+    """
+    valid = []
+    results = {}
+    for item in items:
+        try:
+            zfs.check_properties(item.get('properties') or {}, volume=bool(item.get('volsize')))
+            valid.append(item)
+        except zfs.ZfsPropertyError as e:
+            results[item['dataset']] = str(e)
+    return valid, results
+
+
+def _get_single_items(items):
+    """Return the items that can not be created by create_many.
+    """
+    return [item for item in items if item.get('origin') or item.get('volsize')]
+
+
+def _get_create_properties(item):
+    return {
+        'mountpoint': item['mountpoint'],
+        'quota': item.get('quota'),
+        'refquota': item.get('refquota'),
+        **(item.get('properties') or {}),
+    }
+
+
+def _split_destroy_items(items, snapshots):
+    """Split items into those that can be destroyed at once and those
+    that still have snapshots. Also return the origins of the former.
+    """
+    keep = [item for item in items if _snapshots_of(item['dataset'], snapshots)]
+    destroy = [item for item in items if item not in keep]
+    origins = set()
+    for item in destroy:
+        properties = zfs.INVENTORY.get(item['dataset'], 'origin')
+        if properties is not None:
+            origins.add(properties['origin'])
+    return destroy, keep, origins
+
+
+async def destroy_datasets(items):
+    """Destroy many datasets at once, unmounting them in parallel.
+
+    `items` is a list of dicts with the same keys as the arguments
+    of `destroy_dataset`.
+    Return a dict that maps each dataset name to None on success
+    or to an error message.
+    """
+    snapshots = {}
+    for parent in {os.path.split(item['dataset'])[0] for item in items}:
+        await aiozfs.load_inventory(parent, max_age=INVENTORY_MAX_AGE)
+        if zfs.INVENTORY.exists(parent):
+            snapshots.update(await _get_snapshots(parent))
+    destroy, keep, origins = _split_destroy_items(items, snapshots)
+    results = await aiozfs.destroy_many([item['dataset'] for item in destroy])
+    for item in keep:
+        results[item['dataset']] = await _call(_destroy, item['dataset'], snapshots)
+    for origin in origins:
+        error = await _call(_release, origin)
+        if error:
+            log.warning('node: failed to release origin %s: %s', origin, error)
+    _remove_mountpoints(items, results)
+    return results
+
+
+def _prepare_mountpoint_dirs(items):
+    for mountpoint_dir in {os.path.split(item['mountpoint'])[0] for item in items if item.get('mountpoint')}:
+        os.makedirs(mountpoint_dir, mode=0o700, exist_ok=True)
+        os.chmod(mountpoint_dir, 0o700)
+
+
+def _remove_mountpoints(items, results):
+    for item in items:
+        if results[item['dataset']] is None and item.get('mountpoint'):
+            try:
+                os.rmdir(item['mountpoint'])
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                results[item['dataset']] = str(e)
+
+
+# Batch actions whose items are run one by one, the keys of
+# their items other than `action` are passed as arguments.
+ITEM_ACTIONS = {
+    'resize': resize_dataset,
+    'snapshot': create_snapshot,
+    'destroy_snapshot': destroy_snapshot,
+}
+
+
+def _item_args(item):
+    return {k:v for k,v in item.items() if k != 'action'}
+
+
+async def run_batch(items):
+    """Create and destroy many datasets at once.
+
+    `items` is a list of dicts like for `create_datasets` and
+    `destroy_datasets` with an additional `action` key that
+    is either `create` or `destroy` or one of ITEM_ACTIONS.
+    Return a list with None on success or an error message
+    for each item, in the order of items.
+    """
+    results = {}
+    for action, func in (('create', create_datasets), ('destroy', destroy_datasets)):
+        action_items = [_item_args(item) for item in items if item['action'] == action]
+        if action_items:
+            results[action] = await func(action_items)
+    errors = []
+    for item in items:
+        if item['action'] in results:
+            errors.append(results[item['action']][item['dataset']])
+        elif item['action'] in ITEM_ACTIONS:
+            errors.append(await _call(ITEM_ACTIONS[item['action']], **_item_args(item)))
+        else:
+            errors.append(f'Unknown action: {item["action"]}')
+    return errors
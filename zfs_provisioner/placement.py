@@ -0,0 +1,235 @@
+import collections
+import dataclasses
+import fnmatch
+import itertools
+import logging
+import re
+
+from typing import Dict, FrozenSet, List, Optional
+
+log = logging.getLogger('zfs-provisioner')
+
+from . import Error
+from . import capacity
+from .handlers import CONFIG
+
+
+# Ways to pick one of several candidate parent datasets on a node,
+# set with the `placement` key of the config.
+POLICIES = ('most-free-space', 'fewest-datasets', 'round-robin')
+DEFAULT_POLICY = 'most-free-space'
+
+# Operators of the matchExpressions of label selectors.
+SELECTOR_OPERATORS = ('In', 'NotIn', 'Exists', 'DoesNotExist')
+
+# Maps node names to the counter used for round-robin placement.
+_turns = collections.defaultdict(itertools.count)
+
+# Maps node names to their labels, kept up to date from a node watch.
+NODE_LABELS: Dict[str, Dict[str, str]] = {}
+
+
+class ConfigError(Error):
+    """The dataset config is not valid.
+    """
+    pass
+
+
+class NoCandidateError(Error):
+    """No parent dataset on a node is configured for a storage class.
+    """
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class Candidate:
+    dataset: str
+    # Storage classes the parent dataset is reserved for, all if empty.
+    storage_classes: FrozenSet[str] = frozenset()
+
+
+def _parse_candidates(entries, where):
+    if not isinstance(entries, list):
+        entries = [entries]
+    if not entries:
+        raise ConfigError(f'{where}: no parent datasets given')
+    candidates = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            dataset = entry.get('dataset')
+            storage_classes = entry.get('storage_classes', [])
+        else:
+            dataset, storage_classes = entry, []
+        if not isinstance(dataset, str) or not dataset or dataset.startswith('/'):
+            raise ConfigError(f'{where}: invalid parent dataset: {dataset!r}')
+        if not isinstance(storage_classes, list) or \
+                not all(isinstance(name, str) for name in storage_classes):
+            raise ConfigError(f'{where}: storage_classes must be a list of names')
+        candidates.append(Candidate(dataset, frozenset(storage_classes)))
+    return tuple(candidates)
+
+
+def _compile_selector(selector, where):
+    """Return a function that tells whether a dict of labels matches the
+    given kubernetes label selector with matchLabels and matchExpressions.
+    """
+    if not isinstance(selector, dict) or not selector:
+        raise ConfigError(f'{where}: selector must be a non empty object')
+    match_labels = selector.get('matchLabels', {})
+    expressions = selector.get('matchExpressions', [])
+    if not isinstance(match_labels, dict) or not isinstance(expressions, list):
+        raise ConfigError(f'{where}: invalid selector: {selector}')
+    checks = [lambda labels, k=k, v=v: labels.get(k) == v for k,v in match_labels.items()]
+    for expression in expressions:
+        try:
+            key, operator = expression['key'], expression['operator']
+            values = frozenset(expression.get('values', []))
+        except (KeyError, TypeError):
+            raise ConfigError(f'{where}: invalid match expression: {expression}') from None
+        if operator not in SELECTOR_OPERATORS:
+            raise ConfigError(f'{where}: unknown operator: {operator}')
+        if operator == 'In':
+            checks.append(lambda labels, k=key, v=values: labels.get(k) in v)
+        elif operator == 'NotIn':
+            checks.append(lambda labels, k=key, v=values: labels.get(k) not in v)
+        elif operator == 'Exists':
+            checks.append(lambda labels, k=key: k in labels)
+        else:
+            checks.append(lambda labels, k=key: k not in labels)
+    return lambda labels: all(check(labels) for check in checks)
+
+
+class Resolver:
+    """Resolves node names to their candidate parent datasets.
+
+    Built and validated once per config, see from_config. Nodes are
+    matched by exact name first, then by the glob patterns in
+    `node_dataset_map` and then by the label selectors in
+    `node_selector_dataset_map`, both in config order, and
+    finally fall back to `__default__`.
+    """
+    def __init__(self, policy=DEFAULT_POLICY, exact=None, patterns=(), selectors=(), default=None):
+        self.policy = policy
+        self.exact: Dict[str, tuple] = exact or {}
+        self.patterns: List[tuple] = list(patterns)
+        self.selectors: List[tuple] = list(selectors)
+        self.default: Optional[tuple] = default
+        # Maps node names to their resolved candidates.
+        self._resolved: Dict[str, tuple] = {}
+
+    @classmethod
+    def from_config(cls, config) -> 'Resolver':
+        """Return a Resolver for the given dataset config,
+        raise ConfigError if it is not valid.
+        """
+        if not isinstance(config, dict):
+            raise ConfigError('The config must be an object')
+        policy = config.get('placement', DEFAULT_POLICY)
+        if policy not in POLICIES:
+            raise ConfigError(f'Unknown placement policy: {policy}, expected one of: {", ".join(POLICIES)}')
+
+        node_dataset_map = config.get('node_dataset_map', {})
+        if not isinstance(node_dataset_map, dict):
+            raise ConfigError('node_dataset_map must be an object')
+        exact, patterns, default = {}, [], None
+        for node_name, entries in node_dataset_map.items():
+            candidates = _parse_candidates(entries, f'node_dataset_map: {node_name}')
+            if node_name == '__default__':
+                default = candidates
+            elif any(c in node_name for c in '*?['):
+                patterns.append((re.compile(fnmatch.translate(node_name)), candidates))
+            else:
+                exact[node_name] = candidates
+
+        selector_map = config.get('node_selector_dataset_map', [])
+        if not isinstance(selector_map, list):
+            raise ConfigError('node_selector_dataset_map must be a list')
+        selectors = []
+        for index, entry in enumerate(selector_map):
+            where = f'node_selector_dataset_map[{index}]'
+            if not isinstance(entry, dict):
+                raise ConfigError(f'{where}: must be an object')
+            selectors.append((_compile_selector(entry.get('selector'), where),
+                _parse_candidates(entry.get('datasets'), where)))
+        return cls(policy, exact, patterns, selectors, default)
+
+    def forget(self, node_name):
+        """Resolve the given node again, e.g. after its labels changed.
+        """
+        self._resolved.pop(node_name, None)
+
+    def resolve(self, node_name) -> tuple:
+        """Return the candidates for the given node.
+        """
+        try:
+            return self._resolved[node_name]
+        except KeyError:
+            pass
+        candidates = self.exact.get(node_name)
+        if candidates is None:
+            candidates = next((c for pattern, c in self.patterns if pattern.match(node_name)), None)
+        if candidates is None and node_name in NODE_LABELS:
+            labels = NODE_LABELS[node_name]
+            candidates = next((c for matches, c in self.selectors if matches(labels)), None)
+        if candidates is None:
+            candidates = self.default
+        if candidates is None:
+            # Not cached as the parent dataset may still be configured.
+            return (Candidate(CONFIG.parent_dataset),)
+        if node_name in NODE_LABELS or not self.selectors:
+            # Nodes whose labels are not known yet are resolved again.
+            self._resolved[node_name] = candidates
+        return candidates
+
+
+RESOLVER = Resolver()
+
+
+def update_node_labels(node_name, labels):
+    """Remember the labels of the given node, None if it is gone.
+    """
+    if labels is None:
+        NODE_LABELS.pop(node_name, None)
+    else:
+        labels = dict(labels)
+        if NODE_LABELS.get(node_name) == labels:
+            return
+        NODE_LABELS[node_name] = labels
+    RESOLVER.forget(node_name)
+
+
+def get_candidates(node_name, storage_class_name) -> List[str]:
+    """Return the parent datasets on the given node that datasets of
+    the given storage class may be created below, in config order.
+    """
+    return [c.dataset for c in RESOLVER.resolve(node_name)
+        if not c.storage_classes or storage_class_name in c.storage_classes]
+
+
+def place(node_name, storage_class_name, size) -> Optional[str]:
+    """Return the parent dataset on the given node to create a dataset
+    of size bytes below, or None if it fits into none of the candidates.
+    Raise NoCandidateError if there are no candidates at all.
+
+    Candidates without a capacity report are assumed to fit and
+    are only picked if none of the candidates has one.
+    """
+    candidates = get_candidates(node_name, storage_class_name)
+    if not candidates:
+        raise NoCandidateError(f'No parent dataset on node {node_name} '
+            f'is configured for storage class {storage_class_name}')
+    reports = {dataset:capacity.CACHE.get(node_name, dataset, CONFIG.capacity_max_age)
+        for dataset in candidates}
+    fitting = [dataset for dataset in candidates
+        if reports[dataset] is None or reports[dataset].fits(size, CONFIG.capacity_overcommit)]
+    if len(fitting) <= 1:
+        return fitting[0] if fitting else None
+
+    if RESOLVER.policy == 'round-robin':
+        return fitting[next(_turns[node_name]) % len(fitting)]
+    reported = [dataset for dataset in fitting if reports[dataset] is not None]
+    if not reported:
+        return fitting[0]
+    if RESOLVER.policy == 'fewest-datasets':
+        return min(reported, key=lambda dataset: reports[dataset].datasets)
+    return max(reported, key=lambda dataset: reports[dataset].room(CONFIG.capacity_overcommit))
@@ -0,0 +1,325 @@
+from __future__ import annotations
+
+import asyncio
+import dataclasses
+import datetime
+import json
+import logging
+
+from typing import Dict, List, Optional, Set, Tuple
+
+import kopf
+import kubernetes_asyncio
+
+log = logging.getLogger('zfs-provisioner')
+
+from . import Error
+from . import agent
+from . import datasets
+from . import handlers
+from . import kube
+from . import metrics
+from . import placement
+from . import shard
+from .handlers import CONFIG
+
+
+# Set on claims to have kopf run their handlers again.
+RECONCILE_ANNOTATION = 'zfs-provisioner/reconcile'
+
+# Set by kopf on the objects it has handled. Claims without it
+# are passed to the on.create handlers by kopf itself.
+LAST_HANDLED_ANNOTATION = 'kopf.zalando.org/last-handled-configuration'
+
+PROVISIONED_BY_ANNOTATION = 'pv.kubernetes.io/provisioned-by'
+
+# Number of objects to fetch per list request.
+PAGE_SIZE = 500
+
+# Seconds to wait before reconciling again after a failure,
+# doubled after every failure up to MAX_RETRY_DELAY.
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 300
+
+
+class ReconcileError(Error):
+    """Some of the actions of a reconciliation failed.
+    """
+    pass
+
+
+@dataclasses.dataclass
+class Plan:
+    """What has to be done to bring the claims, persistent volumes
+    and datasets in line with each other.
+    """
+    # (namespace, name) of claims whose create or resize handler has to run again.
+    claims: List[Tuple[str, str]] = dataclasses.field(default_factory=list)
+    # Pending claims whose stored dataset is gone, it is created again.
+    lost: List[Tuple[str, str]] = dataclasses.field(default_factory=list)
+    # Bound claims whose dataset is gone, only reported.
+    missing: List[Tuple[str, str]] = dataclasses.field(default_factory=list)
+    # Released persistent volumes to delete together with their dataset.
+    released: List[Tuple[str, datasets.Dataset]] = dataclasses.field(default_factory=list)
+
+    def __len__(self):
+        return len(self.claims) + len(self.lost) + len(self.released)
+
+
+async def list_all(func, **kwargs) -> List[Dict]:
+    """Return all objects of the given list call as dicts, fetched in pages.
+    """
+    api = kube.get_api_client()
+    items, token = [], None
+    while True:
+        response = await func(limit=PAGE_SIZE, _continue=token, **kwargs)
+        items.extend(api.sanitize_for_serialization(response.items))
+        token = response.metadata._continue
+        if not token:
+            return items
+
+
+def get_stored_dataset(obj) -> Optional[datasets.Dataset]:
+    stored = (obj['metadata'].get('annotations') or {}).get(CONFIG.dataset_annotation)
+    return datasets.Dataset(**json.loads(stored)) if stored else None
+
+
+def _get_pv_node(pv) -> Optional[str]:
+    try:
+        return pv['spec']['nodeAffinity']['required']['nodeSelectorTerms'][0]['matchExpressions'][0]['values'][0]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def _is_ours(pv):
+    annotations = pv['metadata'].get('annotations') or {}
+    return annotations.get(PROVISIONED_BY_ANNOTATION) == CONFIG.provisioner_name
+
+
+def is_released(pv):
+    return (_is_ours(pv)
+        and (pv.get('status') or {}).get('phase') == 'Released'
+        and pv['spec'].get('persistentVolumeReclaimPolicy') == handlers.StorageClass.RECLAIM_POLICY_DELETE)
+
+
+def get_parents(pvcs, pvs) -> Dict[str, Set[str]]:
+    """Return a dict that maps node names to the parent datasets
+    the given claims and persistent volumes have datasets in.
+    """
+    parents: Dict[str, Set[str]] = {}
+    for pvc in pvcs:
+        dataset = get_stored_dataset(pvc)
+        if dataset is not None:
+            parents.setdefault(dataset.selected_node, set()).add(dataset.parent)
+    for pv in filter(is_released, pvs):
+        dataset = get_stored_dataset(pv)
+        if dataset is not None:
+            parents.setdefault(dataset.selected_node, set()).add(dataset.parent)
+            continue
+        node_name = _get_pv_node(pv)
+        if node_name:
+            # Volumes without a stored dataset are looked up below all candidates.
+            parents.setdefault(node_name, set()).update(
+                candidate.dataset for candidate in placement.RESOLVER.resolve(node_name))
+    return parents
+
+
+async def read_inventory(node_name, parents) -> Optional[Dict[str, Set[str]]]:
+    """Return a dict that maps the given parent datasets on the given
+    node to the names of the datasets below them, or None if the
+    agent on that node can not tell.
+    """
+    try:
+        response = await agent.call(node_name, 'list',
+            CONFIG.agent_port, CONFIG.agent_token, CONFIG.agent_timeout,
+            parents=sorted(parents))
+    except agent.AgentError as e:
+        log.warning('reconcile: no datasets of node %s: %s', node_name, e)
+        return None
+    return {parent:set(names) for parent, names in response['result'].items()}
+
+
+def _exists(inventories, dataset) -> Optional[bool]:
+    """Return whether dataset exists or None if that is not known.
+    """
+    inventory = inventories.get(dataset.selected_node)
+    if inventory is None or dataset.parent not in inventory:
+        return None
+    return dataset.full_name in inventory[dataset.parent]
+
+
+def find_pv_dataset(pv, inventories) -> Optional[datasets.Dataset]:
+    """Return the dataset of a persistent volume without a stored dataset.
+    """
+    pv_name = pv['metadata']['name']
+    node_name = _get_pv_node(pv)
+    volume_mode = pv['spec'].get('volumeMode', 'Filesystem')
+    for parent, names in (inventories.get(node_name) or {}).items():
+        if f'{parent}/{pv_name}' in names:
+            return datasets.Dataset(
+                name=pv_name,
+                parent=parent,
+                mount_point=None if volume_mode == 'Block' else pv['spec']['local']['path'],
+                selected_node=node_name,
+                volume_mode=volume_mode,
+                storage_class=pv['spec'].get('storageClassName'),
+            )
+    return None
+
+
+def diff(pvcs, pvs, inventories) -> Plan:
+    """Compare the given claims, persistent volumes and dataset
+    inventories of nodes and return the Plan to reconcile them.
+    """
+    plan = Plan()
+    pv_names = {pv['metadata']['name'] for pv in pvs}
+    for pvc in pvcs:
+        body = kopf.Body(pvc)
+        key = (body.meta.namespace, body.meta.name)
+        if LAST_HANDLED_ANNOTATION not in body.meta.annotations:
+            continue
+        dataset = get_stored_dataset(pvc)
+        exists = None if dataset is None else _exists(inventories, dataset)
+        if handlers.filter_create_dataset(body=body, meta=body.meta, spec=body.spec, status=body.status):
+            if exists is False:
+                plan.lost.append(key)
+            elif dataset is None or dataset.name not in pv_names:
+                plan.claims.append(key)
+        elif handlers.filter_resize_dataset(meta=body.meta, spec=body.spec, status=body.status):
+            plan.claims.append(key)
+        elif exists is False and body.status.get('phase') == 'Bound':
+            plan.missing.append(key)
+
+    for pv in filter(is_released, pvs):
+        pv_name = pv['metadata']['name']
+        dataset = get_stored_dataset(pv) or find_pv_dataset(pv, inventories)
+        if dataset is None:
+            log.warning('reconcile: not deleting released persistent volume %s, its dataset is unknown', pv_name)
+            continue
+        if not shard.SHARDS.owns_node(dataset.selected_node):
+            continue
+        plan.released.append((pv_name, dataset))
+    return plan
+
+
+async def _rerun(v1, namespace, name, forget_dataset=False):
+    """Have kopf run the handlers of the given claim again.
+    """
+    annotations = {RECONCILE_ANNOTATION: datetime.datetime.now(datetime.timezone.utc).isoformat()}
+    if forget_dataset:
+        annotations[CONFIG.dataset_annotation] = None
+    await v1.patch_namespaced_persistent_volume_claim(name, namespace,
+        {'metadata': {'annotations': annotations}})
+
+
+async def _delete_released(v1, pv_name, dataset):
+    log.info('reconcile: deleting zfs dataset %s:%s of released persistent volume %s',
+        dataset.selected_node, dataset.full_name, pv_name)
+    await dataset.delete()
+    try:
+        await v1.delete_persistent_volume(pv_name)
+    except kubernetes_asyncio.client.rest.ApiException as e:
+        if e.status != 404:
+            raise
+
+
+async def apply(v1, plan):
+    """Carry out the given plan, return the number of failed actions.
+    """
+    actions = []
+    for namespace, name in plan.claims:
+        actions.append(('rerun', _rerun(v1, namespace, name)))
+    for namespace, name in plan.lost:
+        log.warning('reconcile: dataset of pending claim %s/%s is gone, creating it again', namespace, name)
+        actions.append(('recreate', _rerun(v1, namespace, name, forget_dataset=True)))
+    for pv_name, dataset in plan.released:
+        actions.append(('delete', _delete_released(v1, pv_name, dataset)))
+    for namespace, name in plan.missing:
+        log.error('reconcile: dataset of bound claim %s/%s is gone', namespace, name)
+
+    results = await asyncio.gather(*[coro for action, coro in actions], return_exceptions=True)
+    failed = 0
+    for (action, coro), result in zip(actions, results):
+        if isinstance(result, Exception):
+            log.warning('reconcile: %s failed: %s', action, result)
+            failed += 1
+            metrics.RECONCILE_ACTIONS.labels(action, 'failure').inc()
+        else:
+            metrics.RECONCILE_ACTIONS.labels(action, 'success').inc()
+    return failed
+
+
+async def load_classes():
+    """Fill CONFIG.storage_classes and CONFIG.snapshot_classes
+    without waiting for kopf to watch them.
+    """
+    api = kube.get_api_client()
+    storage = kubernetes_asyncio.client.StorageV1Api(api)
+    for obj in await list_all(storage.list_storage_class):
+        if handlers.filter_provisioner(obj):
+            CONFIG.storage_classes[obj['metadata']['name']] = handlers.StorageClass.from_dicts(obj['metadata'], obj)
+    custom = kubernetes_asyncio.client.CustomObjectsApi(api)
+    try:
+        response = await custom.list_cluster_custom_object(handlers.SNAPSHOT_GROUP,
+            handlers.SNAPSHOT_VERSION, 'volumesnapshotclasses')
+    except kubernetes_asyncio.client.rest.ApiException as e:
+        # Volume snapshots are not installed.
+        if e.status != 404:
+            raise
+        return
+    for obj in response['items']:
+        if handlers.filter_snapshot_driver(obj):
+            CONFIG.snapshot_classes[obj['metadata']['name']] = obj.get('deletionPolicy', 'Delete')
+
+
+async def run():
+    """Reconcile all claims, persistent volumes and datasets at once.
+
+    Takes a single list of storage classes, persistent volumes and claims
+    and, with the node agents, of the datasets on the nodes involved.
+    Only the claims that need work get their handlers run again, so that
+    a restart costs as much as there is to do, not as many objects as
+    there are.
+
+    Raise ReconcileError if some of the actions failed.
+    """
+    v1 = kubernetes_asyncio.client.CoreV1Api(kube.get_api_client())
+    with metrics.STAGE_DURATION.labels('reconcile', 'list').time():
+        await load_classes()
+        pvs = await list_all(v1.list_persistent_volume)
+        pvcs = await list_all(v1.list_persistent_volume_claim_for_all_namespaces,
+            label_selector=shard.join_selectors(CONFIG.pvc_label_selector, shard.SHARDS.selector()))
+        pvcs = [pvc for pvc in pvcs if handlers.get_storage_class(pvc.get('spec') or {}) is not None]
+
+    inventories = {}
+    if CONFIG.use_agent:
+        parents = get_parents(pvcs, pvs)
+        with metrics.STAGE_DURATION.labels('reconcile', 'inventory').time():
+            results = await asyncio.gather(*[read_inventory(node_name, node_parents)
+                for node_name, node_parents in parents.items()])
+        inventories = dict(zip(parents, results))
+
+    plan = diff(pvcs, pvs, inventories)
+    log.info('reconcile: %s claims, %s persistent volumes, %s nodes: '
+        '%s claims to handle, %s datasets to create again, %s released volumes to delete, %s datasets missing',
+        len(pvcs), len(pvs), len(inventories), len(plan.claims), len(plan.lost), len(plan.released), len(plan.missing))
+    with metrics.STAGE_DURATION.labels('reconcile', 'apply').time():
+        failed = await apply(v1, plan)
+    if failed:
+        raise ReconcileError(f'{failed} of {len(plan)} actions failed')
+    return plan
+
+
+async def run_until_done():
+    """Run until it succeeds, e.g. after the api server or an agent
+    failed at startup, waiting longer after every failure.
+    Nothing else resumes the claims that need work.
+    """
+    delay = RETRY_DELAY
+    while True:
+        try:
+            return await run()
+        except Exception as e:
+            log.warning('reconcile: failed, trying again in %ss: %s', delay, e)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, MAX_RETRY_DELAY)
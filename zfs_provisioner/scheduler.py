@@ -0,0 +1,130 @@
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import heapq
+import itertools
+import logging
+import time
+
+from typing import Dict, List
+
+log = logging.getLogger('zfs-provisioner')
+
+from . import metrics
+
+
+# Maps the values of the scheduler priority to the actions of items.
+PRIORITY_ACTIONS = {
+    'delete': 'destroy',
+    'create': 'create',
+    'none': None,
+}
+
+
+@dataclasses.dataclass(order=True)
+class _Waiter:
+    priority: int
+    sequence: int
+    node_name: str = dataclasses.field(compare=False)
+    action: str = dataclasses.field(compare=False)
+    future: asyncio.Future = dataclasses.field(compare=False)
+    queued: float = dataclasses.field(compare=False)
+
+
+class Scheduler:
+    """Limit how many dataset operations run at once, per node and overall.
+
+    Waiting operations are started in order of priority, see
+    `PRIORITY_ACTIONS`, then in the order they were queued.
+    """
+    def __init__(self, max_concurrent=50, max_concurrent_per_node=4, priority='delete'):
+        self.max_concurrent = max_concurrent
+        self.max_concurrent_per_node = max_concurrent_per_node
+        self.priority = priority
+        self.queue: List[_Waiter] = []
+        self.running = 0
+        self.running_per_node: Dict[str, int] = collections.Counter()
+        self._sequence = itertools.count()
+
+    def get_priority(self, actions):
+        """Return the priority for an operation consisting of actions, lower runs first.
+        """
+        return 0 if PRIORITY_ACTIONS.get(self.priority) in actions else 1
+
+    def _can_run(self, node_name):
+        return (self.running < self.max_concurrent
+            and self.running_per_node[node_name] < self.max_concurrent_per_node)
+
+    def _start(self, node_name):
+        self.running += 1
+        self.running_per_node[node_name] += 1
+
+    def _dispatch(self):
+        # Start waiters in order, skipping those whose node is busy.
+        blocked = []
+        while self.queue and self.running < self.max_concurrent:
+            waiter = heapq.heappop(self.queue)
+            if waiter.future.done():
+                continue
+            if not self._can_run(waiter.node_name):
+                blocked.append(waiter)
+                continue
+            self._start(waiter.node_name)
+            waiter.future.set_result(None)
+        for waiter in blocked:
+            heapq.heappush(self.queue, waiter)
+
+    def _release(self, node_name):
+        self.running -= 1
+        self.running_per_node[node_name] -= 1
+        if not self.running_per_node[node_name]:
+            del self.running_per_node[node_name]
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, node_name, actions):
+        """Wait until an operation with the given actions may run on node_name.
+        """
+        actions = set(actions)
+        action = next(iter(actions)) if len(actions) == 1 else 'mixed'
+        waiter = _Waiter(
+            priority=self.get_priority(actions),
+            sequence=next(self._sequence),
+            node_name=node_name,
+            action=action,
+            future=asyncio.get_running_loop().create_future(),
+            queued=time.monotonic(),
+        )
+        heapq.heappush(self.queue, waiter)
+        self._dispatch()
+        if not waiter.future.done():
+            metrics.SCHEDULER_QUEUE_DEPTH.labels(action).inc()
+            try:
+                await waiter.future
+            except asyncio.CancelledError:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    # Got a slot just before being cancelled.
+                    self._release(node_name)
+                raise
+            finally:
+                metrics.SCHEDULER_QUEUE_DEPTH.labels(action).dec()
+            log.debug('scheduler: %s on node %s waited %.3fs',
+                action, node_name, time.monotonic() - waiter.queued)
+        metrics.SCHEDULER_WAIT.labels(action).observe(time.monotonic() - waiter.queued)
+        try:
+            yield
+        finally:
+            self._release(node_name)
+
+
+SCHEDULER = Scheduler()
+
+
+def configure(max_concurrent=None, max_concurrent_per_node=None, priority=None):
+    if max_concurrent is not None:
+        SCHEDULER.max_concurrent = max_concurrent
+    if max_concurrent_per_node is not None:
+        SCHEDULER.max_concurrent_per_node = max_concurrent_per_node
+    if priority is not None:
+        SCHEDULER.priority = priority
@@ -0,0 +1,379 @@
+import asyncio
+import datetime
+import hashlib
+import logging
+
+from typing import Dict, List, Optional
+
+import kopf
+import kubernetes_asyncio
+
+log = logging.getLogger('zfs-provisioner')
+
+from . import handlers
+from . import kube
+from . import metrics
+from . import placement
+from . import reconcile
+from .handlers import CONFIG
+
+
+# Set on claims and volume snapshots to the member that owns them.
+# Each member only has the api server send it the objects it owns.
+SHARD_LABEL = 'zfs-provisioner/shard'
+
+# Set on the leases of the members to their identity.
+MEMBER_LABEL = 'zfs-provisioner/shard-member'
+LEASE_PREFIX = 'zfs-provisioner-shard-'
+
+# Prefix of the annotations kopf keeps the progress of handlers in.
+KOPF_ANNOTATION_PREFIX = 'kopf.zalando.org/'
+
+# Seconds to wait before watching for new objects again after an error.
+WATCH_RETRY_DELAY = 5
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _parse_time(value):
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def join_selectors(*selectors) -> Optional[str]:
+    return ','.join(filter(None, selectors)) or None
+
+
+def rendezvous(key, members) -> Optional[str]:
+    """Return the member that owns key: the one with the highest hash of
+    member and key. A member that joins or leaves only moves the keys it
+    takes over or had, all others stay where they are.
+    """
+    return max(members, key=lambda member: hashlib.sha256(f'{member}/{key}'.encode()).digest(),
+        default=None)
+
+
+def node_key(node_name) -> str:
+    """Return the value of the node's CONFIG.shard_node_label, its name without.
+    """
+    if CONFIG.shard_node_label:
+        return (placement.NODE_LABELS.get(node_name) or {}).get(CONFIG.shard_node_label, node_name)
+    return node_name
+
+
+def claim_key(pvc) -> str:
+    """Return the key of a claim: that of its node once one is selected,
+    its namespace and name before.
+    """
+    dataset = reconcile.get_stored_dataset(pvc)
+    node_name = dataset.selected_node if dataset else None
+    if not node_name:
+        node_name = (pvc['metadata'].get('annotations') or {}).get(handlers.SELECTED_NODE_ANNOTATION)
+    if node_name:
+        return node_key(node_name)
+    return f'{pvc["metadata"]["namespace"]}/{pvc["metadata"]["name"]}'
+
+
+def is_claim_ready(pvc) -> bool:
+    """Whether a claim of ours can be assigned, claims that wait for
+    their first consumer are assigned once the scheduler selected a node.
+    """
+    storage_class = handlers.get_storage_class(pvc.get('spec') or {})
+    if storage_class is None:
+        return False
+    if storage_class.volumeBindingMode == 'WaitForFirstConsumer':
+        annotations = pvc['metadata'].get('annotations') or {}
+        return (handlers.SELECTED_NODE_ANNOTATION in annotations
+            or CONFIG.dataset_annotation in annotations)
+    return True
+
+
+def is_settled(obj) -> bool:
+    """Whether nothing is going on with the given claim or volume snapshot,
+    so that it can be handed over to another member.
+    """
+    body = kopf.Body(obj)
+    if body.meta.get('deletionTimestamp'):
+        return False
+    for key in body.meta.annotations:
+        if key.startswith(KOPF_ANNOTATION_PREFIX) and key != reconcile.LAST_HANDLED_ANNOTATION:
+            return False
+    if obj.get('kind') == 'VolumeSnapshot':
+        return not handlers.filter_create_snapshot(meta=body.meta, spec=body.spec, status=body.status)
+    if any(annotation in body.meta.annotations for annotation in CONFIG.dataset_phase_annotations.values()):
+        return False
+    return not (handlers.filter_create_dataset(body=body, meta=body.meta, spec=body.spec, status=body.status)
+        or handlers.filter_resize_dataset(meta=body.meta, spec=body.spec, status=body.status))
+
+
+class Shards:
+    """Split the claims and volume snapshots between the controller replicas.
+
+    Every replica, a member, renews a lease of its own in CONFIG.namespace.
+    The members whose lease has not expired own the keys of claims, their
+    node or its CONFIG.shard_node_label, by rendezvous hashing. Each object
+    gets the SHARD_LABEL of its owner and kopf only watches the objects with
+    our own label, so every object is handled by exactly one member.
+
+    When the members change, objects of members that are gone are taken
+    over by their new owner and settled objects are handed over to theirs.
+    Objects that are being worked on stay where they are until they settle.
+    """
+    def __init__(self):
+        self.identity: Optional[str] = None
+        self.members: List[str] = []
+
+    @property
+    def enabled(self):
+        return self.identity is not None
+
+    def selector(self) -> Optional[str]:
+        """Return the label selector of the objects we own.
+        """
+        return f'{SHARD_LABEL}={self.identity}' if self.enabled else None
+
+    def owner(self, key) -> Optional[str]:
+        return rendezvous(key, self.members)
+
+    def owns_node(self, node_name) -> bool:
+        return not self.enabled or self.owner(node_key(node_name)) == self.identity
+
+    def owns(self, obj) -> bool:
+        if not self.enabled:
+            return True
+        return (obj['metadata'].get('labels') or {}).get(SHARD_LABEL) == self.identity
+
+    @property
+    def lease_name(self):
+        return f'{LEASE_PREFIX}{self.identity}'
+
+    async def renew(self, coordination):
+        now = _now().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        body = {
+            'metadata': {'name': self.lease_name, 'labels': {MEMBER_LABEL: self.identity}},
+            'spec': {
+                'holderIdentity': self.identity,
+                'leaseDurationSeconds': int(CONFIG.shard_lease_duration),
+                'renewTime': now,
+            },
+        }
+        try:
+            await coordination.patch_namespaced_lease(self.lease_name, CONFIG.namespace, body)
+        except kubernetes_asyncio.client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+            body['spec']['acquireTime'] = now
+            await coordination.create_namespaced_lease(CONFIG.namespace, body)
+
+    async def refresh(self, coordination) -> bool:
+        """Read the members from their leases, return whether they changed.
+        """
+        leases = await reconcile.list_all(coordination.list_namespaced_lease,
+            namespace=CONFIG.namespace, label_selector=MEMBER_LABEL)
+        now = _now()
+        members, expired = {self.identity}, []
+        for lease in leases:
+            spec = lease.get('spec') or {}
+            renewed = spec.get('renewTime')
+            duration = spec.get('leaseDurationSeconds') or CONFIG.shard_lease_duration
+            if renewed and (now - _parse_time(renewed)).total_seconds() < duration:
+                members.add(spec.get('holderIdentity') or lease['metadata']['labels'][MEMBER_LABEL])
+            else:
+                expired.append(lease['metadata']['name'])
+        members = sorted(members)
+
+        # Clean up after members that did not leave on their own.
+        if expired and members[0] == self.identity:
+            for name in expired:
+                log.info('shard: deleting expired lease %s', name)
+                try:
+                    await coordination.delete_namespaced_lease(name, CONFIG.namespace)
+                except kubernetes_asyncio.client.rest.ApiException as e:
+                    if e.status != 404:
+                        raise
+
+        changed = members != self.members
+        if changed:
+            log.info('shard: members: %s', ', '.join(members))
+        self.members = members
+        metrics.SHARD_MEMBERS.set(len(members))
+        return changed
+
+    async def _label(self, kind, obj, owner, reason):
+        """Label obj with its owner unless it changed in the meantime.
+        """
+        meta = obj['metadata']
+        body = {'metadata': {
+            'resourceVersion': meta['resourceVersion'],
+            'labels': {SHARD_LABEL: owner},
+        }}
+        api = kube.get_api_client()
+        try:
+            if kind == 'VolumeSnapshot':
+                await kubernetes_asyncio.client.CustomObjectsApi(api).patch_namespaced_custom_object(
+                    handlers.SNAPSHOT_GROUP, handlers.SNAPSHOT_VERSION, meta['namespace'],
+                    'volumesnapshots', meta['name'], body, _content_type=handlers.MERGE_PATCH)
+            else:
+                await kubernetes_asyncio.client.CoreV1Api(api).patch_namespaced_persistent_volume_claim(
+                    meta['name'], meta['namespace'], body)
+        except kubernetes_asyncio.client.rest.ApiException as e:
+            if e.status not in (404, 409):
+                raise
+            log.debug('shard: not labelling %s %s/%s: %s', kind, meta['namespace'], meta['name'], e.reason)
+            return
+        log.info('shard: %s %s/%s: %s to %s', reason, kind, meta['namespace'], meta['name'], owner)
+        metrics.SHARD_MOVES.labels(kind, reason).inc()
+
+    async def place(self, kind, obj, key):
+        """Label obj with the owner of key if it has none, if its owner is
+        gone or, once it is settled, if we own it but should not.
+        """
+        label = (obj['metadata'].get('labels') or {}).get(SHARD_LABEL)
+        owner = self.owner(key)
+        if label == owner:
+            return
+        if label is None or label not in self.members:
+            # The owner labels, so that new objects are only patched once.
+            if owner == self.identity:
+                await self._label(kind, obj, owner, 'assign' if label is None else 'adopt')
+        elif label == self.identity and is_settled(dict(obj, kind=kind)):
+            await self._label(kind, obj, owner, 'hand over')
+
+    async def _read_claim(self, namespace, name) -> Optional[Dict]:
+        v1 = kubernetes_asyncio.client.CoreV1Api(kube.get_api_client())
+        try:
+            pvc = await v1.read_namespaced_persistent_volume_claim(name, namespace)
+        except kubernetes_asyncio.client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+            return None
+        return v1.api_client.sanitize_for_serialization(pvc)
+
+    async def place_claim(self, pvc):
+        if is_claim_ready(pvc):
+            await self.place('PersistentVolumeClaim', pvc, claim_key(pvc))
+
+    async def place_snapshot(self, snapshot, claims=None):
+        """Place a volume snapshot with the claim it is taken of.
+        """
+        spec = snapshot.get('spec') or {}
+        if spec.get('volumeSnapshotClassName') not in CONFIG.snapshot_classes:
+            return
+        pvc_name = (spec.get('source') or {}).get('persistentVolumeClaimName')
+        if not pvc_name:
+            return
+        namespace = snapshot['metadata']['namespace']
+        if claims is not None:
+            pvc = claims.get((namespace, pvc_name))
+        else:
+            pvc = await self._read_claim(namespace, pvc_name)
+        key = claim_key(pvc) if pvc else f'{namespace}/{pvc_name}'
+        await self.place('VolumeSnapshot', snapshot, key)
+
+    async def _list_snapshots(self) -> List[Dict]:
+        custom = kubernetes_asyncio.client.CustomObjectsApi(kube.get_api_client())
+        items, token = [], None
+        while True:
+            try:
+                response = await custom.list_cluster_custom_object(handlers.SNAPSHOT_GROUP,
+                    handlers.SNAPSHOT_VERSION, 'volumesnapshots',
+                    limit=reconcile.PAGE_SIZE, _continue=token)
+            except kubernetes_asyncio.client.rest.ApiException as e:
+                # Volume snapshots are not installed.
+                if e.status != 404:
+                    raise
+                return items
+            items.extend(response['items'])
+            token = response['metadata'].get('continue')
+            if not token:
+                return items
+
+    async def rebalance(self):
+        """Place all claims and volume snapshots after the members changed.
+        """
+        v1 = kubernetes_asyncio.client.CoreV1Api(kube.get_api_client())
+        with metrics.STAGE_DURATION.labels('shard', 'rebalance').time():
+            pvcs = await reconcile.list_all(v1.list_persistent_volume_claim_for_all_namespaces,
+                label_selector=CONFIG.pvc_label_selector)
+            claims = {}
+            for pvc in pvcs:
+                claims[(pvc['metadata']['namespace'], pvc['metadata']['name'])] = pvc
+                await self.place_claim(pvc)
+            if CONFIG.snapshot_classes:
+                for snapshot in await self._list_snapshots():
+                    await self.place_snapshot(snapshot, claims)
+
+    async def _watch_new(self, func, place, *args, **kwargs):
+        """Place the objects without SHARD_LABEL as they show up.
+        """
+        label_selector = join_selectors(kwargs.pop('label_selector', None), f'!{SHARD_LABEL}')
+        while True:
+            watch = kubernetes_asyncio.watch.Watch()
+            try:
+                async for event in watch.stream(func, *args, label_selector=label_selector, **kwargs):
+                    if event['type'] in ('ADDED', 'MODIFIED'):
+                        await place(event['raw_object'])
+            except asyncio.CancelledError:
+                raise
+            except kubernetes_asyncio.client.rest.ApiException as e:
+                if e.status == 404:
+                    log.info('shard: not watching for new objects: %s', e.reason)
+                    return
+                log.warning('shard: watching for new objects failed: %s', e)
+                await asyncio.sleep(WATCH_RETRY_DELAY)
+            except Exception as e:
+                log.warning('shard: watching for new objects failed: %s', e)
+                await asyncio.sleep(WATCH_RETRY_DELAY)
+            finally:
+                await watch.close()
+
+    async def join(self, identity):
+        """Become a member and place what needs to be placed right away.
+        """
+        self.identity = identity
+        coordination = kubernetes_asyncio.client.CoordinationV1Api(kube.get_api_client())
+        await self.renew(coordination)
+        await self.refresh(coordination)
+        await self.rebalance()
+
+    async def leave(self):
+        """Delete our lease so that the others take over without waiting for it to expire.
+        """
+        if not self.enabled:
+            return
+        coordination = kubernetes_asyncio.client.CoordinationV1Api(kube.get_api_client())
+        try:
+            await coordination.delete_namespaced_lease(self.lease_name, CONFIG.namespace)
+        except kubernetes_asyncio.client.rest.ApiException as e:
+            log.warning('shard: failed to delete lease %s: %s', self.lease_name, e)
+
+    async def run(self):
+        """Renew our lease and follow the members until cancelled.
+        """
+        api = kube.get_api_client()
+        coordination = kubernetes_asyncio.client.CoordinationV1Api(api)
+        v1 = kubernetes_asyncio.client.CoreV1Api(api)
+        custom = kubernetes_asyncio.client.CustomObjectsApi(api)
+        watches = [
+            asyncio.create_task(self._watch_new(v1.list_persistent_volume_claim_for_all_namespaces,
+                self.place_claim, label_selector=CONFIG.pvc_label_selector)),
+            asyncio.create_task(self._watch_new(custom.list_cluster_custom_object,
+                self.place_snapshot, handlers.SNAPSHOT_GROUP, handlers.SNAPSHOT_VERSION, 'volumesnapshots')),
+        ]
+        log.info('shard: %s renewing its lease every %ss', self.identity, CONFIG.shard_lease_duration / 3)
+        try:
+            while True:
+                await asyncio.sleep(CONFIG.shard_lease_duration / 3)
+                try:
+                    await self.renew(coordination)
+                    if await self.refresh(coordination):
+                        await self.rebalance()
+                except Exception:
+                    log.exception('shard: failed to follow the members')
+        finally:
+            for task in watches:
+                task.cancel()
+
+
+SHARDS = Shards()
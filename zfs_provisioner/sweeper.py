@@ -0,0 +1,180 @@
+import asyncio
+import datetime
+import logging
+import os
+import time
+
+from typing import Dict, Optional, Tuple
+
+import kubernetes_asyncio
+
+log = logging.getLogger('zfs-provisioner')
+
+from . import datasets
+from . import kube
+from . import metrics
+from . import placement
+from . import reconcile
+from . import shard
+from .handlers import CONFIG
+
+
+# Number of log lines kept of failed pods before they are deleted.
+FAILED_POD_LOG_LINES = 20
+
+
+def _parse_time(value):
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def _finished_at(pod) -> datetime.datetime:
+    """Return when the given pod finished, when it was created if that is not known.
+    """
+    for container_status in (pod.get('status') or {}).get('containerStatuses') or []:
+        finished = ((container_status.get('state') or {}).get('terminated') or {}).get('finishedAt')
+        if finished:
+            return _parse_time(finished)
+    return _parse_time(pod['metadata']['creationTimestamp'])
+
+
+class Sweeper:
+    """Remove what is left over in the background: failed dataset pods
+    once they are older than CONFIG.failed_pod_ttl, and datasets below
+    the parent datasets that no persistent volume or claim uses.
+
+    Deletions are limited to CONFIG.sweep_rate per second. With
+    CONFIG.sweep_dry_run they are only logged. With sharding, each
+    replica only sweeps the nodes it owns.
+    """
+    def __init__(self):
+        # Maps (node name, dataset) of orphans to when they were first seen.
+        self.orphans: Dict[Tuple[str, str], float] = {}
+        self.rate_limit = kube.TokenBucket()
+
+    async def _delete(self, kind, name, delete):
+        if CONFIG.sweep_dry_run:
+            log.info('sweeper: would delete %s %s', kind, name)
+            metrics.SWEPT.labels(kind, 'dry_run').inc()
+            return
+        await self.rate_limit.acquire()
+        try:
+            await delete()
+        except (kubernetes_asyncio.client.rest.ApiException, datasets.DatasetError) as e:
+            log.warning('sweeper: failed to delete %s %s: %s', kind, name, e)
+            metrics.SWEPT.labels(kind, 'failed').inc()
+            return
+        log.info('sweeper: deleted %s %s', kind, name)
+        metrics.SWEPT.labels(kind, 'deleted').inc()
+
+    async def _log_failed_pod(self, v1, pod):
+        name = pod['metadata']['name']
+        message = datasets.get_termination_message(pod.get('status'))
+        try:
+            logs = await v1.read_namespaced_pod_log(name, CONFIG.namespace,
+                tail_lines=FAILED_POD_LOG_LINES)
+        except kubernetes_asyncio.client.rest.ApiException as e:
+            logs = f'no logs: {e.reason}'
+        log.warning('sweeper: failed pod %s on node %s: %s\n%s', name,
+            pod['spec'].get('nodeName'), message or 'no termination message', logs)
+
+    async def sweep_pods(self, v1):
+        """Delete failed dataset pods older than CONFIG.failed_pod_ttl,
+        after logging why they failed.
+        """
+        pods = await reconcile.list_all(v1.list_namespaced_pod, namespace=CONFIG.namespace,
+            label_selector=datasets.ACTION_ANNOTATION, field_selector='status.phase=Failed')
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for pod in pods:
+            age = (now - _finished_at(pod)).total_seconds()
+            if age < CONFIG.failed_pod_ttl:
+                continue
+            if not shard.SHARDS.owns_node(pod['spec'].get('nodeName')):
+                continue
+            name, uid = pod['metadata']['name'], pod['metadata']['uid']
+            await self._log_failed_pod(v1, pod)
+            await self._delete('pod', name, lambda: datasets.delete_pod(v1, name, CONFIG.namespace, uid))
+
+    async def find_orphans(self, v1) -> Optional[Dict[Tuple[str, str], str]]:
+        """Return a dict that maps (node name, dataset) of the datasets
+        below the parent datasets that neither a persistent volume nor
+        a claim uses to their parent dataset, or None without node agents.
+        """
+        if not CONFIG.use_agent:
+            return None
+        pvs = await reconcile.list_all(v1.list_persistent_volume)
+        pvcs = await reconcile.list_all(v1.list_persistent_volume_claim_for_all_namespaces,
+            label_selector=CONFIG.pvc_label_selector)
+        # Datasets are named after their persistent volume.
+        used = {pv['metadata']['name'] for pv in pvs}
+        for obj in pvs + pvcs:
+            dataset = reconcile.get_stored_dataset(obj)
+            if dataset is not None:
+                used.add(dataset.name)
+
+        nodes = await reconcile.list_all(v1.list_node)
+        node_names = [obj['metadata']['name'] for obj in nodes
+            if shard.SHARDS.owns_node(obj['metadata']['name'])]
+        inventories = await asyncio.gather(*[reconcile.read_inventory(node_name,
+            {candidate.dataset for candidate in placement.RESOLVER.resolve(node_name)})
+            for node_name in node_names])
+        orphans = {}
+        for node_name, inventory in zip(node_names, inventories):
+            for parent, names in (inventory or {}).items():
+                for dataset in names:
+                    name = dataset.rsplit('/', 1)[-1]
+                    # Only touch datasets that look like ours.
+                    if name.startswith('pvc-') and name not in used:
+                        orphans[(node_name, dataset)] = parent
+        return orphans
+
+    async def sweep_datasets(self, v1):
+        """Reclaim datasets that have been orphans for at least
+        CONFIG.orphan_grace_period according to CONFIG.orphan_reclaim_policy.
+
+        The grace period keeps datasets whose persistent volume
+        is about to be created from being taken for orphans.
+        """
+        orphans = await self.find_orphans(v1)
+        if orphans is None:
+            log.debug('sweeper: not looking for orphaned datasets without node agents')
+            return
+        now = time.monotonic()
+        self.orphans = {key:self.orphans.get(key, now) for key in orphans}
+        metrics.ORPHANED_DATASETS.set(len(orphans))
+        for (node_name, full_name), first_seen in self.orphans.items():
+            if now - first_seen < CONFIG.orphan_grace_period:
+                continue
+            if CONFIG.orphan_reclaim_policy != 'Delete':
+                log.warning('sweeper: keeping orphaned dataset %s:%s', node_name, full_name)
+                continue
+            name = full_name.rsplit('/', 1)[-1]
+            dataset = datasets.Dataset(
+                name=name,
+                parent=orphans[(node_name, full_name)],
+                # Volumes have none, a missing mount point is ignored.
+                mount_point=os.path.join(CONFIG.dataset_mount_dir, name),
+                selected_node=node_name,
+            )
+            await self._delete('dataset', f'{node_name}:{full_name}', dataset.delete)
+
+    async def sweep(self, v1):
+        with metrics.STAGE_DURATION.labels('sweep', 'pods').time():
+            await self.sweep_pods(v1)
+        with metrics.STAGE_DURATION.labels('sweep', 'datasets').time():
+            await self.sweep_datasets(v1)
+
+    async def run(self, interval):
+        """Sweep every interval seconds until cancelled.
+        """
+        self.rate_limit = kube.TokenBucket(CONFIG.sweep_rate)
+        v1 = kubernetes_asyncio.client.CoreV1Api(kube.get_api_client())
+        log.info('sweeper: sweeping every %ss%s', interval, ', dry run' if CONFIG.sweep_dry_run else '')
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.sweep(v1)
+            except Exception:
+                log.exception('sweeper: sweep failed')
+
+
+SWEEPER = Sweeper()
@@ -0,0 +1,443 @@
+import contextlib
+import contextvars
+import dataclasses
+import datetime
+import functools
+import json
+import logging
+import math
+import os
+import secrets
+import sys
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+log = logging.getLogger('zfs-provisioner')
+
+
+# Carries the trace contexts into dataset pods, as comma separated
+# W3C traceparent values, one for every claim a pod works for.
+TRACE_ENV = 'ZFS_PROVISIONER_TRACE'
+# Carries the trace contexts to the node agents.
+TRACE_HEADER = 'X-Zfs-Provisioner-Trace'
+# Prefix of the spans that dataset pods write to their log.
+LOG_PREFIX = 'zfs-provisioner-span: '
+
+
+@dataclasses.dataclass(frozen=True)
+class Context:
+    trace_id: str
+    span_id: str
+
+    def format(self) -> str:
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+    @classmethod
+    def parse(cls, value) -> Optional['Context']:
+        try:
+            version, trace_id, span_id, flags = value.strip().split('-')
+            int(trace_id, 16), int(span_id, 16)
+        except (AttributeError, ValueError):
+            return None
+        return cls(trace_id, span_id)
+
+
+@dataclasses.dataclass
+class Span:
+    """A timed stage of the handling of a claim, times are unix timestamps.
+    """
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    name: str
+    start: float
+    end: Optional[float] = None
+    attributes: Dict = dataclasses.field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def context(self) -> Context:
+        return Context(self.trace_id, self.span_id)
+
+    @property
+    def duration(self) -> Optional[float]:
+        return None if self.end is None else self.end - self.start
+
+    def to_dict(self) -> Dict:
+        return dict(dataclasses.asdict(self), duration=self.duration)
+
+    @classmethod
+    def from_dict(cls, data) -> 'Span':
+        field_names = {f.name for f in dataclasses.fields(cls)}
+        return cls(**{k:v for k,v in data.items() if k in field_names})
+
+
+class JsonLinesExporter:
+    """Append spans as json lines to a file, - for stdout.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = sys.stdout if path == '-' else open(path, 'a', buffering=1)
+
+    def export(self, span):
+        self.file.write(json.dumps(span.to_dict()) + '\n')
+
+
+class LogExporter:
+    """Write spans to stderr for the controller to pick up from the log of dataset pods.
+    """
+    def export(self, span):
+        sys.stderr.write(LOG_PREFIX + json.dumps(span.to_dict()) + '\n')
+        sys.stderr.flush()
+
+
+class OpenTelemetryExporter:
+    """Hand spans to an OTLP exporter configured from the
+    OTEL_EXPORTER_OTLP_* environment variables.
+
+    Needs the opentelemetry-sdk and opentelemetry-exporter-otlp-proto-http packages.
+    """
+    def __init__(self):
+        from opentelemetry import trace as otel_trace
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import ReadableSpan
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        self.otel_trace = otel_trace
+        self.readable_span = ReadableSpan
+        self.resource = Resource.create({'service.name': 'zfs-provisioner'})
+        self.processor = BatchSpanProcessor(OTLPSpanExporter())
+
+    def _context(self, trace_id, span_id):
+        return self.otel_trace.SpanContext(int(trace_id, 16), int(span_id, 16), is_remote=False,
+            trace_flags=self.otel_trace.TraceFlags(self.otel_trace.TraceFlags.SAMPLED))
+
+    def export(self, span):
+        status = self.otel_trace.Status(self.otel_trace.StatusCode.ERROR, span.error) if span.error \
+            else self.otel_trace.Status(self.otel_trace.StatusCode.OK)
+        self.processor.on_end(self.readable_span(
+            name=span.name,
+            context=self._context(span.trace_id, span.span_id),
+            parent=self._context(span.trace_id, span.parent_id) if span.parent_id else None,
+            resource=self.resource,
+            attributes={k:v for k,v in span.attributes.items() if isinstance(v, (str, bool, int, float))},
+            status=status,
+            start_time=int(span.start * 1e9),
+            end_time=int(span.end * 1e9),
+        ))
+
+
+EXPORTERS: List = []
+
+# The spans, or contexts of spans in other processes, new spans are children of.
+# A dataset pod or agent that works for several claims continues all their traces.
+_current: contextvars.ContextVar[Tuple] = contextvars.ContextVar('zfs_provisioner_trace', default=())
+# Collects the spans of agent requests to return them with the response.
+_collected: contextvars.ContextVar[Optional[List]] = contextvars.ContextVar(
+    'zfs_provisioner_trace_collected', default=None)
+
+
+def configure(path=None, otel=False):
+    """Export spans as json lines to path and/or to OpenTelemetry.
+    Without either, no spans are recorded.
+    """
+    EXPORTERS.clear()
+    if path:
+        log.info('trace: writing spans to %s', path)
+        EXPORTERS.append(JsonLinesExporter(path))
+    if otel:
+        try:
+            EXPORTERS.append(OpenTelemetryExporter())
+            log.info('trace: exporting spans to OpenTelemetry')
+        except ImportError as e:
+            log.warning('trace: OpenTelemetry is not available: %s', e)
+
+
+def enabled() -> bool:
+    return bool(EXPORTERS) or _collected.get() is not None
+
+
+def current() -> Tuple:
+    return _current.get()
+
+
+def format_contexts(parents=None) -> str:
+    """Return the contexts of the given or current spans for TRACE_ENV and TRACE_HEADER.
+    """
+    parents = current() if parents is None else parents
+    return ','.join(parent.context.format() if isinstance(parent, Span) else parent.format()
+        for parent in parents)
+
+
+def parse_contexts(value) -> Tuple[Context, ...]:
+    return tuple(filter(None, (Context.parse(part) for part in (value or '').split(','))))
+
+
+def _new_id(size):
+    return secrets.token_hex(size)
+
+
+def export(span):
+    collected = _collected.get()
+    if collected is not None:
+        collected.append(span.to_dict())
+        return
+    for exporter in EXPORTERS:
+        try:
+            exporter.export(span)
+        except Exception as e:
+            log.warning('trace: failed to export span %s: %s', span.name, e)
+
+
+def import_spans(spans):
+    """Export the given span dicts recorded by a node agent or dataset pod.
+    """
+    for data in spans:
+        try:
+            export(Span.from_dict(data))
+        except TypeError as e:
+            log.warning('trace: ignoring invalid span: %s', e)
+
+
+def import_log(text):
+    """Export the spans in the log of a dataset pod.
+    """
+    import_spans(json.loads(line.split(LOG_PREFIX, 1)[1])
+        for line in text.splitlines() if LOG_PREFIX in line)
+
+
+def _children(name, parents, start, attributes) -> List[Span]:
+    return [Span(
+        trace_id=parent.trace_id,
+        span_id=_new_id(8),
+        parent_id=parent.span_id,
+        name=name,
+        start=start,
+        attributes=dict(attributes),
+    ) for parent in parents]
+
+
+@contextlib.contextmanager
+def _activate(spans):
+    token = _current.set(tuple(spans))
+    try:
+        yield tuple(spans)
+    except BaseException as e:
+        for span in spans:
+            span.error = str(e) or type(e).__name__
+        raise
+    finally:
+        _current.reset(token)
+        end = time.time()
+        for span in spans:
+            span.end = end
+            export(span)
+
+
+@contextlib.contextmanager
+def start(name, **attributes):
+    """Start a new trace with a root span called name.
+    """
+    if not enabled():
+        yield ()
+        return
+    span = Span(trace_id=_new_id(16), span_id=_new_id(8), parent_id=None,
+        name=name, start=time.time(), attributes=attributes)
+    with _activate([span]) as spans:
+        yield spans
+
+
+@contextlib.contextmanager
+def span(name, parents=None, **attributes):
+    """Record a span called name in each of the given or current traces
+    and make them current. Nothing is recorded outside of traces.
+    """
+    parents = current() if parents is None else tuple(parents)
+    if not parents or not enabled():
+        # Do not leave the spans of whoever started the task current.
+        with _activate(()) as spans:
+            yield spans
+        return
+    with _activate(_children(name, parents, time.time(), attributes)) as spans:
+        yield spans
+
+
+def record(name, start, end, parents=None, **attributes):
+    """Record a span called name that took from start to end
+    in each of the given or current traces.
+    """
+    parents = current() if parents is None else parents
+    if not parents or not enabled() or start is None or end is None:
+        return
+    for child in _children(name, parents, start, attributes):
+        child.end = end
+        export(child)
+
+
+@contextlib.contextmanager
+def resume(value):
+    """Continue the traces of the TRACE_ENV or TRACE_HEADER value.
+    """
+    token = _current.set(parse_contexts(value))
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def collect(value):
+    """Continue the traces of the TRACE_HEADER value and
+    collect their spans in the yielded list instead of exporting them.
+    """
+    spans = []
+    token = _collected.set(spans)
+    try:
+        with resume(value):
+            yield spans
+    finally:
+        _collected.reset(token)
+
+
+def resume_from_env(ctx):
+    """Continue the traces passed to a dataset pod for as long as ctx lives,
+    its spans go to its log.
+    """
+    value = os.environ.get(TRACE_ENV)
+    if not value:
+        return
+    EXPORTERS[:] = [LogExporter()]
+    ctx.with_resource(resume(value))
+    ctx.with_resource(span('worker', command=ctx.invoked_subcommand))
+
+
+def traced(name, since=None):
+    """Decorator that runs a kopf handler in a new trace called name.
+
+    On the first attempt, the time from the given timestamp of the
+    object, e.g. its creationTimestamp, until the handler started
+    is recorded as the `waiting` span.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(**kwargs):
+            meta = kwargs.get('meta') or {}
+            with start(name, claim=f'{kwargs.get("namespace")}/{kwargs.get("name")}',
+                    retry=kwargs.get('retry', 0)) as spans:
+                timestamp = meta.get(since) if since else None
+                if spans and timestamp and not kwargs.get('retry'):
+                    record('waiting', _parse_time(timestamp), spans[0].start)
+                return await fn(**kwargs)
+        return wrapper
+    return decorator
+
+
+def _parse_time(value):
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+# Analysis of recorded spans, see the `trace` command.
+
+def read_spans(lines) -> List[Span]:
+    """Return the spans in the given json lines, also from
+    pod logs with lines prefixed by LOG_PREFIX.
+    """
+    spans = []
+    for line in lines:
+        if LOG_PREFIX in line:
+            line = line.split(LOG_PREFIX, 1)[1]
+        line = line.strip()
+        if not line.startswith('{'):
+            continue
+        try:
+            data = json.loads(line)
+            if data.get('end') is not None:
+                spans.append(Span.from_dict(data))
+        except (ValueError, TypeError, AttributeError):
+            continue
+    return spans
+
+
+def percentile(values, percent):
+    """Nearest rank percentile of the given values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(values)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def _path(span, spans_by_id):
+    names = [span.name]
+    parent = spans_by_id.get(span.parent_id)
+    while parent is not None:
+        names.append(parent.name)
+        parent = spans_by_id.get(parent.parent_id)
+    return '/'.join(reversed(names))
+
+
+def summarize(spans, name=None, slowest=5) -> Dict:
+    """Aggregate spans into latency percentiles per stage, the path of
+    span names from the root of their trace, and list the slowest traces.
+    """
+    spans_by_id = {span.span_id: span for span in spans}
+    roots = [span for span in spans if span.parent_id is None and (name is None or span.name == name)]
+    trace_ids = {root.trace_id for root in roots}
+
+    durations: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    traces: Dict[str, Dict[str, float]] = {}
+    for span in spans:
+        if span.trace_id not in trace_ids:
+            continue
+        path = _path(span, spans_by_id)
+        durations.setdefault(path, []).append(span.duration)
+        if span.error:
+            errors[path] = errors.get(path, 0) + 1
+        stages = traces.setdefault(span.trace_id, {})
+        stages[path] = stages.get(path, 0) + span.duration
+
+    stages = {}
+    for path, values in sorted(durations.items()):
+        stages[path] = {
+            'count': len(values),
+            'errors': errors.get(path, 0),
+            'mean': sum(values) / len(values),
+            'p50': percentile(values, 50),
+            'p90': percentile(values, 90),
+            'p99': percentile(values, 99),
+            'max': max(values),
+        }
+    roots.sort(key=lambda root: root.duration, reverse=True)
+    return {
+        'traces': len(roots),
+        'stages': stages,
+        'slowest': [dict(
+            trace_id=root.trace_id,
+            name=root.name,
+            duration=root.duration,
+            attributes=root.attributes,
+            error=root.error,
+            stages=traces.get(root.trace_id, {}),
+        ) for root in roots[:slowest]],
+    }
+
+
+def format_summary(summary) -> str:
+    """Return the summary as text tables.
+    """
+    lines = [f'{summary["traces"]} traces', '']
+    width = max([len(path) for path in summary['stages']] + [5])
+    header = f'{"stage":<{width}} {"count":>6} {"errors":>6} {"mean":>8} {"p50":>8} {"p90":>8} {"p99":>8} {"max":>8}'
+    lines.extend([header, '-' * len(header)])
+    for path, stage in summary['stages'].items():
+        lines.append(f'{path:<{width}} {stage["count"]:>6} {stage["errors"]:>6}'
+            + ''.join(f' {stage[key]:>8.3f}' for key in ('mean', 'p50', 'p90', 'p99', 'max')))
+    for root in summary['slowest']:
+        lines.extend(['', f'{root["name"]} {root["attributes"].get("claim", "")} '
+            f'{root["duration"]:.3f}s trace {root["trace_id"]}' + (f': {root["error"]}' if root['error'] else '')])
+        for path, seconds in sorted(root['stages'].items()):
+            lines.append(f'  {path:<{width}} {seconds:>8.3f}')
+    return '\n'.join(lines)
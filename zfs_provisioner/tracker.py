@@ -0,0 +1,167 @@
+import asyncio
+import dataclasses
+import datetime
+import logging
+import time
+
+from typing import Dict, Optional
+
+log = logging.getLogger('zfs-provisioner')
+
+from . import Error
+
+
+FINISHED_PHASES = ('Succeeded', 'Failed')
+
+
+class PodGoneError(Error):
+    """The pod that was waited for has been deleted before it finished.
+    """
+    pass
+
+
+def _parse_time(value):
+    if not value:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def _seconds(start, end):
+    if start is None or end is None:
+        return None
+    return (end - start).total_seconds()
+
+
+@dataclasses.dataclass
+class PodResult:
+    uid: str
+    name: str
+    namespace: str
+    phase: str
+    status: Dict
+    # Seconds the pod spent in each phase:
+    # scheduled: from creation until it was bound to a node
+    # running: from being scheduled until the container started, e.g. image pull
+    # finished: from container start until it terminated
+    timings: Dict[str, Optional[float]] = dataclasses.field(default_factory=dict)
+    # When the pod was created, scheduled, started and finished.
+    times: Dict[str, Optional[datetime.datetime]] = dataclasses.field(default_factory=dict)
+
+    @property
+    def succeeded(self):
+        return self.phase == 'Succeeded'
+
+    @classmethod
+    def from_pod(cls, pod: Dict) -> 'PodResult':
+        metadata = pod['metadata']
+        status = dict(pod.get('status') or {})
+        created = _parse_time(metadata.get('creationTimestamp'))
+        scheduled = None
+        for condition in status.get('conditions') or []:
+            if condition.get('type') == 'PodScheduled' and condition.get('status') == 'True':
+                scheduled = _parse_time(condition.get('lastTransitionTime'))
+        started = finished = None
+        for container_status in status.get('containerStatuses') or []:
+            terminated = (container_status.get('state') or {}).get('terminated') or {}
+            started = _parse_time(terminated.get('startedAt'))
+            finished = _parse_time(terminated.get('finishedAt'))
+        return cls(
+            uid=metadata['uid'],
+            name=metadata['name'],
+            namespace=metadata.get('namespace'),
+            phase=status.get('phase'),
+            status=status,
+            timings={
+                'scheduled': _seconds(created, scheduled),
+                'running': _seconds(scheduled, started),
+                'finished': _seconds(started, finished),
+            },
+            times={
+                'created': created,
+                'scheduled': scheduled,
+                'started': started,
+                'finished': finished,
+            },
+        )
+
+
+class PodTracker:
+    """Track the completion of pods by their UID.
+
+    Pods are fed in from watch events and from periodic lists, so
+    that pods that finished while nobody was waiting for them, e.g.
+    during a controller restart or a dropped watch event, are not missed.
+    """
+    def __init__(self, label: str):
+        self.label = label
+        # Maps pod UIDs to futures of handlers waiting for them.
+        self.waiters: Dict[str, asyncio.Future] = {}
+        # Maps pod UIDs to results nobody has waited for yet.
+        self.finished: Dict[str, PodResult] = {}
+        self.last_update = time.monotonic()
+
+    def update(self, pod: Dict, deleted=False):
+        """Feed the current state of a pod into the tracker.
+        """
+        self.last_update = time.monotonic()
+        uid = pod['metadata']['uid']
+        if deleted:
+            self.finished.pop(uid, None)
+            future = self.waiters.pop(uid, None)
+            if future and not future.done():
+                future.set_exception(PodGoneError(f'Pod {pod["metadata"]["name"]} has been deleted'))
+            return
+
+        phase = (pod.get('status') or {}).get('phase')
+        if phase not in FINISHED_PHASES:
+            return
+        result = PodResult.from_pod(pod)
+        future = self.waiters.pop(uid, None)
+        if future is None:
+            self.finished[uid] = result
+        elif not future.done():
+            future.set_result(result)
+
+    async def wait(self, uid, timeout=None) -> PodResult:
+        """Wait for the pod with the given UID to finish.
+        Raise asyncio.TimeoutError if it does not finish in time.
+        """
+        result = self.finished.pop(uid, None)
+        if result is not None:
+            return result
+        future = self.waiters.get(uid)
+        if future is None:
+            future = self.waiters[uid] = asyncio.get_running_loop().create_future()
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            if not future.done():
+                future.cancel()
+            self.waiters.pop(uid, None)
+
+    async def resync(self, v1, namespace=None):
+        """List all labelled pods and feed them into the tracker.
+        """
+        if namespace:
+            response = await v1.list_namespaced_pod(namespace, label_selector=self.label)
+        else:
+            response = await v1.list_pod_for_all_namespaces(label_selector=self.label)
+        for item in response.items:
+            pod = v1.api_client.sanitize_for_serialization(item)
+            self.update(pod)
+        log.debug('tracker: resynced %s pods, %s finished, %s waiting',
+            len(response.items), len(self.finished), len(self.waiters))
+
+    async def poll(self, v1, interval, namespace=None):
+        """Resync whenever handlers are waiting but no updates
+        have been seen for interval seconds.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            if self.waiters and time.monotonic() - self.last_update >= interval:
+                try:
+                    await self.resync(v1, namespace)
+                except Exception as e:
+                    log.warning('tracker: resync failed: %s', e)
@@ -1,98 +1,807 @@
+import contextlib
+import errno
+import json
 import logging
+import os
+import re
 import subprocess
+import tempfile
+import threading
+import time
+
+from typing import Dict, List, Optional
 
 log = logging.getLogger('zfs-provisioner')
 
 from . import Error
+from . import metrics
+from . import trace
+
+
+# Maps messages zfs prints to stderr to the reason of ZfsCommandErrors.
+ERROR_REASONS = (
+    ('dataset already exists', 'exists'),
+    ('dataset does not exist', 'not_found'),
+    ('could not find any snapshots', 'not_found'),
+    ('is busy', 'busy'),
+    ('permission denied', 'permission_denied'),
+    ('out of space', 'no_space'),
+    ('not currently mounted', 'not_mounted'),
+    # Volumes can not be mounted.
+    ('not applicable to datasets of this type', 'not_mounted'),
+)
+
+
+def parse_error(stderr):
+    """Return the reason for the given zfs error output or None if it is not known.
+    """
+    if isinstance(stderr, bytes):
+        stderr = stderr.decode('utf-8', 'replace')
+    stderr = (stderr or '').lower()
+    for message, reason in ERROR_REASONS:
+        if message in stderr:
+            return reason
+    return None
 
 
 class ZfsCommandError(Error):
     """Error that happened while running a `zfs` command.
+
+    `reason` is one of the reasons in ERROR_REASONS, `timeout`
+    or None if the error output was not understood.
+    """
+    def __init__(self, message, cmd=None, returncode=None, stderr=None, reason=None):
+        super().__init__(message)
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stderr = stderr
+        self.reason = reason or parse_error(stderr)
+
+
+class ZfsPropertyError(Error):
+    """A zfs property that may not be set or has an invalid value.
     """
     pass
 
 
-def create(dataset, *args, **properties):
-    """Create the given dataset with the given properties.
+def _one_of(*values):
+    return lambda value: value in values
+
+
+def _size(value):
+    match = re.fullmatch(r'(\d+)([KMG]?)', value.upper())
+    if not match:
+        return None
+    return int(match.group(1)) * 1024 ** ' KMG'.index(match.group(2) or ' ')
+
+
+def _block_size(minimum, maximum, allow_zero=False):
+    def check(value):
+        size = _size(value)
+        if size == 0:
+            return allow_zero
+        return size is not None and minimum <= size <= maximum and not size & (size - 1)
+    return check
+
+
+_COMPRESSION = re.compile(r'on|off|lzjb|zle|lz4|gzip(-[1-9])?|zstd(-([1-9]|1[0-9]))?'
+    r'|zstd-fast(-([1-9]|[1-9]0|100|500|1000))?')
+
+# Properties that may be set on the datasets we create,
+# mapped to functions that check their values.
+TUNABLE_PROPERTIES = {
+    'atime': _one_of('on', 'off'),
+    'compression': lambda value: bool(_COMPRESSION.fullmatch(value)),
+    'copies': _one_of('1', '2', '3'),
+    'logbias': _one_of('latency', 'throughput'),
+    'primarycache': _one_of('all', 'none', 'metadata'),
+    'recordsize': _block_size(512, 16 * 1024 ** 2),
+    'redundant_metadata': _one_of('all', 'most'),
+    'relatime': _one_of('on', 'off'),
+    'secondarycache': _one_of('all', 'none', 'metadata'),
+    'snapdir': _one_of('hidden', 'visible'),
+    'special_small_blocks': _block_size(512, 16 * 1024 ** 2, allow_zero=True),
+    'sync': _one_of('standard', 'always', 'disabled'),
+    'volblocksize': _block_size(512, 128 * 1024),
+    'xattr': _one_of('on', 'off', 'sa', 'dir'),
+}
+
+
+# Tunable properties that only apply to filesystems or volumes.
+FILESYSTEM_PROPERTIES = {'atime', 'recordsize', 'relatime', 'snapdir', 'xattr'}
+VOLUME_PROPERTIES = {'volblocksize'}
+
+
+def applicable_properties(properties, volume=False):
+    """Return the properties that apply to a filesystem or, if volume, to a volume.
+    """
+    skip = FILESYSTEM_PROPERTIES if volume else VOLUME_PROPERTIES
+    return {k:v for k,v in properties.items() if k not in skip}
+
+
+def check_properties(properties, volume=False):
+    """Raise ZfsPropertyError unless all properties are in
+    TUNABLE_PROPERTIES, apply to the type of dataset and
+    have valid values.
     """
-    cmd = ['zfs', 'create']
-    cmd.extend(args)
     for k,v in properties.items():
-        if v is not None:
-            cmd.extend(['-o', f'{k}={v}'])
-    cmd.append(dataset)
-    log.debug('zfs.create: %s', cmd)
+        check = TUNABLE_PROPERTIES.get(k)
+        if check is None:
+            raise ZfsPropertyError(f'Setting the zfs property "{k}" is not allowed')
+        if k not in applicable_properties({k: v}, volume):
+            kind = 'volumes' if volume else 'filesystems'
+            raise ZfsPropertyError(f'The zfs property "{k}" does not apply to {kind}')
+        if not check(str(v)):
+            raise ZfsPropertyError(f'Invalid value for the zfs property "{k}": {v}')
 
-    try:
-        subprocess.check_call(cmd)
-    except subprocess.SubprocessError as e:
-        log.error(e)
-        raise ZfsCommandError(f'Failed to create dataset "{dataset}" running command: {cmd}') from e
 
+class Inventory:
+    """In memory index of the datasets below some root datasets.
 
-def ensure(dataset, *args, **properties):
-    """Ensure the given dataset exists
-    with the given properties.
+    Each root is loaded with a single recursive `zfs list` and kept
+    up to date incrementally by the functions in aiozfs.
+    Values that are not known are stored as None.
     """
-    cmd = ['zfs', 'list', '-Hp', dataset]
-    try:
-        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-    except subprocess.SubprocessError as e:
-        if e.output and b'dataset does not exist' in e.output:
-            return create(dataset, *args, **properties)
-        else:
-            raise ZfsCommandError(f'Failed to list dataset "{dataset}" running command: {cmd}') from e
-    else:
-        # Dataset exists, ensure properties are correct.
-        set_properties(dataset, **properties)
-
-
-def destroy(dataset, *args):
-    """Destroy the given dataset.
+    def __init__(self, properties=('type', 'mountpoint', 'quota', 'refquota', 'origin')):
+        self.properties: tuple = tuple(properties)
+        self._index = {k:i for i,k in enumerate(self.properties)}
+        # Maps root dataset names to the time they were loaded.
+        self.roots: Dict[str, float] = {}
+        # Maps dataset names to a list of values ordered like self.properties.
+        self.datasets: Dict[str, List[Optional[str]]] = {}
+
+    def update_rows(self, root, rows):
+        """Replace root and its descendants with rows of a name
+        followed by values ordered like self.properties.
+        """
+        self.removed(root)
+        for name, *values in rows:
+            self.datasets[name] = values
+        self.roots[root] = time.monotonic()
+
+    def is_fresh(self, root, max_age):
+        loaded = self.roots.get(root)
+        return loaded is not None and time.monotonic() - loaded <= max_age
+
+    def covers(self, dataset):
+        for root in self.roots:
+            if dataset == root or dataset.startswith(root + '/'):
+                return True
+        return False
+
+    def exists(self, dataset):
+        """Return whether dataset exists or None if that is not known.
+        """
+        if dataset in self.datasets:
+            return True
+        if self.covers(dataset):
+            return False
+        return None
+
+    def get(self, dataset, *keys):
+        """Return the given properties of dataset or None if they are not all known.
+        """
+        values = self.datasets.get(dataset)
+        if values is None:
+            return None
+        properties = {}
+        for key in keys:
+            index = self._index.get(key)
+            if index is None or values[index] is None:
+                return None
+            properties[key] = values[index]
+        return properties
+
+    def added(self, dataset, **properties):
+        if not self.covers(dataset):
+            return
+        self.datasets[dataset] = [None] * len(self.properties)
+        self.changed(dataset, **properties)
+
+    def changed(self, dataset, **properties):
+        values = self.datasets.get(dataset)
+        if values is None:
+            return
+        for k,v in properties.items():
+            index = self._index.get(k)
+            if index is not None and v is not None:
+                values[index] = str(v)
+
+    def removed(self, dataset):
+        prefix = dataset + '/'
+        for name in [n for n in self.datasets if n == dataset or n.startswith(prefix)]:
+            del self.datasets[name]
+
+
+INVENTORY = Inventory()
+
+
+def _error_details(cmd, error):
+    return {
+        'cmd': cmd,
+        'returncode': getattr(error, 'returncode', None),
+        'stderr': getattr(error, 'output', None),
+    }
+
+
+@contextlib.contextmanager
+def _timed(cmd):
+    with metrics.ZFS_COMMAND_DURATION.labels(cmd[1]).time(), trace.span(f'zfs_{cmd[1]}'):
+        yield
+
+
+def _parse_rows(output):
+    return [line.split('\t') for line in output.split('\n') if line]
+
+
+class Backend:
+    """Performs the zfs operations.
+
+    The functions in aiozfs keep INVENTORY up to date and
+    call the selected BACKEND to do the actual work.
     """
-    cmd = ['zfs', 'destroy']
+    name: str = None
+    # Whether run_program is supported.
+    channel_programs: bool = False
+
+    def list(self, root, properties) -> List[List[str]]:
+        """Return rows of a dataset name followed by the given properties
+        for root and all its descendants.
+        """
+        raise NotImplementedError()
+
+    def exists(self, dataset) -> bool:
+        raise NotImplementedError()
+
+    def create(self, dataset, args, properties):
+        raise NotImplementedError()
+
+    def destroy(self, dataset, args):
+        raise NotImplementedError()
+
+    def set_properties(self, dataset, properties):
+        raise NotImplementedError()
+
+    def get_properties(self, dataset, keys) -> Dict[str, str]:
+        raise NotImplementedError()
+
+    def unmount(self, dataset):
+        raise NotImplementedError()
+
+    def snapshot(self, snapshot):
+        raise NotImplementedError()
+
+    def clone(self, snapshot, dataset, properties):
+        raise NotImplementedError()
+
+    def list_snapshots(self, root) -> List[List[str]]:
+        """Return rows of a snapshot name, its comma separated clones and
+        whether it is marked for deferred destruction for all snapshots
+        of root and its descendants.
+        """
+        raise NotImplementedError()
+
+    def run_program(self, pool, program, args):
+        raise ZfsCommandError(f'The {self.name} backend does not support channel programs')
+
+
+# Builders of the `zfs` commands of the cli backend, shared with aiozfs.
+# Each returns the command and the message of the ZfsCommandError
+# raised if it fails.
+
+def _list_cmd(root, properties):
+    cmd = ['zfs', 'list', '-Hp', '-r', '-o', ','.join(('name',) + tuple(properties)), root]
+    return cmd, f'Failed to list dataset "{root}"'
+
+
+def _exists_cmd(dataset):
+    return ['zfs', 'list', '-Hp', dataset], f'Failed to list dataset "{dataset}"'
+
+
+def _create_cmd(dataset, args, properties):
+    cmd = ['zfs', 'create']
     cmd.extend(args)
+    for k,v in properties.items():
+        cmd.extend(['-o', f'{k}={v}'])
     cmd.append(dataset)
-    log.debug('zfs.destroy: %s', cmd)
+    return cmd, f'Failed to create dataset "{dataset}"'
 
-    try:
-        subprocess.check_call(cmd)
-    except subprocess.SubprocessError as e:
-        log.error(e)
-        raise ZfsCommandError(f'Failed to destroy dataset "{dataset}" running command: {cmd}') from e
 
+def _destroy_cmd(dataset, args):
+    cmd = ['zfs', 'destroy']
+    cmd.extend(args)
+    cmd.append(dataset)
+    return cmd, f'Failed to destroy dataset "{dataset}"'
 
-def set_properties(dataset, **properties):
-    """Set the given properties on the given dataset.
-    """
+
+def _set_cmd(dataset, properties):
     cmd = ['zfs', 'set']
     for k,v in properties.items():
         cmd.append(f'{k}={v}')
     cmd.append(dataset)
-    log.debug('zfs.set_properties: %s', cmd)
-    try:
-        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-    except subprocess.SubprocessError as e:
-        raise ZfsCommandError(f'Failed to set properties on dataset "{dataset}" running command: {cmd}') from e
+    return cmd, f'Failed to set properties on dataset "{dataset}"'
+
+
+def _get_cmd(dataset, keys):
+    cmd = ['zfs', 'get', '-Hp', ','.join(keys), dataset]
+    return cmd, f'Failed to get properties for dataset "{dataset}"'
+
+
+def _parse_properties(output):
+    return {parts[1]:parts[2] for parts in _parse_rows(output)}
+
+
+def _unmount_cmd(dataset):
+    return ['zfs', 'unmount', dataset], f'Failed to unmount dataset "{dataset}"'
+
+
+def _snapshot_cmd(snapshot):
+    return ['zfs', 'snapshot', snapshot], f'Failed to create snapshot "{snapshot}"'
+
+
+def _clone_cmd(snapshot, dataset, properties):
+    cmd = ['zfs', 'clone']
+    for k,v in properties.items():
+        cmd.extend(['-o', f'{k}={v}'])
+    cmd.extend([snapshot, dataset])
+    return cmd, f'Failed to clone "{snapshot}" to "{dataset}"'
+
 
+def _list_snapshots_cmd(root):
+    cmd = ['zfs', 'list', '-Hp', '-r', '-t', 'snapshot', '-o', 'name,clones,defer_destroy', root]
+    return cmd, f'Failed to list snapshots of "{root}"'
 
-def get_properties(dataset, *keys):
-    """Get the current properties of the given dataset.
+
+def _program_cmd(pool, path, args):
+    cmd = ['zfs', 'program', '-j', pool, path]
+    cmd.extend(args)
+    return cmd, f'Failed to run channel program on pool "{pool}"'
+
+
+@contextlib.contextmanager
+def _program_file(program):
+    """Yield the path of a temporary file containing program.
+    """
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.lua') as f:
+        f.write(program)
+        f.flush()
+        yield f.name
+
+
+class CliBackend(Backend):
+    """Runs the `zfs` command line tool.
+    """
+    name = 'cli'
+    channel_programs = True
+
+    def _run(self, cmd, message):
+        log.debug('zfs.%s: %s', cmd[1], cmd)
+        try:
+            with _timed(cmd):
+                output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except subprocess.SubprocessError as e:
+            raise ZfsCommandError(f'{message} running command: {cmd}',
+                **_error_details(cmd, e)) from e
+        return output.decode('utf-8')
+
+    def list(self, root, properties):
+        return _parse_rows(self._run(*_list_cmd(root, properties)))
+
+    def exists(self, dataset):
+        try:
+            self._run(*_exists_cmd(dataset))
+        except ZfsCommandError as e:
+            if e.reason == 'not_found':
+                return False
+            raise
+        return True
+
+    def create(self, dataset, args, properties):
+        self._run(*_create_cmd(dataset, args, properties))
+
+    def destroy(self, dataset, args):
+        self._run(*_destroy_cmd(dataset, args))
+
+    def set_properties(self, dataset, properties):
+        self._run(*_set_cmd(dataset, properties))
+
+    def get_properties(self, dataset, keys):
+        return _parse_properties(self._run(*_get_cmd(dataset, keys)))
+
+    def unmount(self, dataset):
+        try:
+            self._run(*_unmount_cmd(dataset))
+        except ZfsCommandError as e:
+            if e.reason != 'not_mounted':
+                raise
+
+    def snapshot(self, snapshot):
+        self._run(*_snapshot_cmd(snapshot))
+
+    def clone(self, snapshot, dataset, properties):
+        self._run(*_clone_cmd(snapshot, dataset, properties))
+
+    def list_snapshots(self, root):
+        return _parse_rows(self._run(*_list_snapshots_cmd(root)))
+
+    def run_program(self, pool, program, args):
+        with _program_file(program) as path:
+            output = self._run(*_program_cmd(pool, path, args))
+        return json.loads(output)['return']
+
+
+class LibzfsCoreBackend(CliBackend):
+    """Creates, clones, snapshots, destroys and checks datasets in
+    process through libzfs_core (pyzfs) instead of forking `zfs`.
+
+    libzfs_core has no equivalent for listing, getting and setting
+    properties or mounting, these still use the command line tool.
+    """
+    name = 'libzfs_core'
+
+    # Maps errnos of libzfs_core errors to the reason of ZfsCommandErrors.
+    ERRNO_REASONS = {
+        errno.EEXIST: 'exists',
+        errno.ENOENT: 'not_found',
+        errno.EBUSY: 'busy',
+        errno.EPERM: 'permission_denied',
+        errno.EACCES: 'permission_denied',
+        errno.ENOSPC: 'no_space',
+    }
+
+    def __init__(self):
+        import libzfs_core
+        self.lzc = libzfs_core
+
+    def _error(self, message, error):
+        code = getattr(error, 'errno', None)
+        return ZfsCommandError(f'{message}: {error}', returncode=code,
+            reason=self.ERRNO_REASONS.get(code))
+
+    @staticmethod
+    def _encode(properties):
+        encoded = {}
+        for k,v in properties.items():
+            # Numeric properties like quotas have to be passed as numbers.
+            value = str(v)
+            encoded[k.encode('utf-8')] = int(value) if value.isdigit() else value.encode('utf-8')
+        return encoded
+
+    def exists(self, dataset):
+        return self.lzc.lzc_exists(dataset.encode('utf-8'))
+
+    def create(self, dataset, args, properties):
+        args = list(args)
+        ds_type = 'zfs'
+        properties = dict(properties)
+        if '-V' in args and '-s' in args:
+            # lzc_create does not reserve space for volumes,
+            # so they are always sparse.
+            index = args.index('-V')
+            properties['volsize'] = args[index + 1]
+            del args[index:index + 2]
+            args.remove('-s')
+            ds_type = 'zvol'
+        if args:
+            # Options like -p are not supported by lzc_create and only
+            # the command line tool sizes the refreservation of volumes.
+            return super().create(dataset, args, properties)
+        log.debug('zfs.lzc_create: %s, %s', dataset, properties)
+        try:
+            with _timed(['zfs', 'create']):
+                self.lzc.lzc_create(dataset.encode('utf-8'), ds_type=ds_type,
+                    props=self._encode(properties))
+        except self.lzc.exceptions.ZFSError as e:
+            raise self._error(f'Failed to create dataset "{dataset}"', e) from e
+        if ds_type == 'zfs':
+            self._mount(dataset, properties)
+
+    def _mount(self, dataset, properties):
+        mountpoint = properties.get('mountpoint')
+        if mountpoint not in (None, 'legacy', 'none'):
+            # lzc_create and lzc_clone do not mount the new dataset.
+            self._run(['zfs', 'mount', dataset], f'Failed to mount dataset "{dataset}"')
+
+    def snapshot(self, snapshot):
+        log.debug('zfs.lzc_snapshot: %s', snapshot)
+        try:
+            with _timed(['zfs', 'snapshot']):
+                self.lzc.lzc_snapshot([snapshot.encode('utf-8')])
+        except self.lzc.exceptions.ZFSError as e:
+            raise self._error(f'Failed to create snapshot "{snapshot}"', e) from e
+
+    def clone(self, snapshot, dataset, properties):
+        log.debug('zfs.lzc_clone: %s, %s, %s', snapshot, dataset, properties)
+        try:
+            with _timed(['zfs', 'clone']):
+                self.lzc.lzc_clone(dataset.encode('utf-8'), snapshot.encode('utf-8'),
+                    props=self._encode(properties))
+        except self.lzc.exceptions.ZFSError as e:
+            raise self._error(f'Failed to clone "{snapshot}" to "{dataset}"', e) from e
+        self._mount(dataset, properties)
+
+    def destroy(self, dataset, args):
+        if '@' in dataset and set(args) <= {'-d'}:
+            log.debug('zfs.lzc_destroy_snaps: %s', dataset)
+            try:
+                with _timed(['zfs', 'destroy']):
+                    self.lzc.lzc_destroy_snaps([dataset.encode('utf-8')], defer='-d' in args)
+            except self.lzc.exceptions.ZFSError as e:
+                raise self._error(f'Failed to destroy snapshot "{dataset}"', e) from e
+            return
+        if args:
+            return super().destroy(dataset, args)
+        self.unmount(dataset)
+        log.debug('zfs.lzc_destroy: %s', dataset)
+        try:
+            with _timed(['zfs', 'destroy']):
+                self.lzc.lzc_destroy(dataset.encode('utf-8'))
+        except self.lzc.exceptions.ZFSError as e:
+            raise self._error(f'Failed to destroy dataset "{dataset}"', e) from e
+
+
+class MemoryBackend(Backend):
+    """Keeps datasets in memory, for testing and benchmarking
+    on machines without zfs.
+
+    Mountpoint directories are created like `zfs mount` would.
+    """
+    name = 'memory'
+
+    DEFAULTS = {
+        'type': 'filesystem',
+        'mountpoint': 'none',
+        'quota': '0',
+        'refquota': '0',
+        'origin': '-',
+        'defer_destroy': 'off',
+        'used': '0',
+    }
+
+    def __init__(self, size=2 ** 40):
+        self.lock = threading.RLock()
+        # Space in bytes reported as available for every dataset.
+        self.size = size
+        # Maps dataset and snapshot names to dicts of their properties.
+        self.datasets: Dict[str, Dict[str, str]] = {}
+
+    def _get(self, dataset, message):
+        try:
+            return self.datasets[dataset]
+        except KeyError:
+            raise ZfsCommandError(f'{message}: dataset does not exist', reason='not_found') from None
+
+    def _value(self, dataset, key):
+        if key == 'clones':
+            return ','.join(self._clones(dataset))
+        if key == 'available':
+            return str(self.size)
+        return self.datasets[dataset].get(key, self.DEFAULTS.get(key, '-'))
+
+    def _clones(self, snapshot):
+        return sorted(name for name, values in self.datasets.items() if values.get('origin') == snapshot)
+
+    def _descendants(self, root, snapshots=False):
+        names = []
+        for name in sorted(self.datasets):
+            dataset = name.split('@', 1)[0]
+            if (dataset == root or dataset.startswith(root + '/')) and ('@' in name) == snapshots:
+                names.append(name)
+        return names
+
+    def list(self, root, properties):
+        with self.lock:
+            self._get(root, f'Failed to list dataset "{root}"')
+            return [[name] + [self._value(name, k) for k in properties]
+                for name in self._descendants(root)]
+
+    def list_snapshots(self, root):
+        with self.lock:
+            self._get(root, f'Failed to list snapshots of "{root}"')
+            return [[name] + [self._value(name, k) or '-' for k in ('clones', 'defer_destroy')]
+                for name in self._descendants(root, snapshots=True)]
+
+    def exists(self, dataset):
+        return dataset in self.datasets
+
+    def _add(self, dataset, values, args, message):
+        if dataset in self.datasets:
+            raise ZfsCommandError(f'{message}: dataset already exists', reason='exists')
+        parent = os.path.split(dataset)[0]
+        # Pools, the top level datasets, always exist.
+        if '/' in parent and parent not in self.datasets:
+            if '-p' not in args:
+                raise ZfsCommandError(f'{message}: parent does not exist', reason='not_found')
+            self.create(parent, ['-p'], {})
+        self.datasets[dataset] = values
+        mountpoint = values.get('mountpoint')
+        if mountpoint and mountpoint.startswith('/'):
+            os.makedirs(mountpoint, exist_ok=True)
+
+    def create(self, dataset, args, properties):
+        args = list(args)
+        values = {k:str(v) for k,v in properties.items()}
+        if '-V' in args:
+            values['type'] = 'volume'
+            values['volsize'] = str(args[args.index('-V') + 1])
+        with self.lock:
+            self._add(dataset, values, args, f'Failed to create dataset "{dataset}"')
+
+    def snapshot(self, snapshot):
+        with self.lock:
+            if snapshot in self.datasets:
+                raise ZfsCommandError(f'Failed to create snapshot "{snapshot}": dataset already exists',
+                    reason='exists')
+            self._get(snapshot.split('@', 1)[0], f'Failed to create snapshot "{snapshot}"')
+            self.datasets[snapshot] = {'type': 'snapshot'}
+
+    def clone(self, snapshot, dataset, properties):
+        message = f'Failed to clone "{snapshot}" to "{dataset}"'
+        with self.lock:
+            origin = self._get(snapshot, message)
+            values = {k:v for k,v in self.datasets[snapshot.split('@', 1)[0]].items()
+                if k in ('type', 'volsize')}
+            values.update({k:str(v) for k,v in properties.items()})
+            values['origin'] = snapshot
+            self._add(dataset, values, [], message)
+
+    def _remove(self, name):
+        values = self.datasets.pop(name)
+        origin = values.get('origin')
+        # Snapshots marked for deferred destruction go away with their last clone.
+        if origin in self.datasets and self._value(origin, 'defer_destroy') == 'on' \
+                and not self._clones(origin):
+            del self.datasets[origin]
+
+    def destroy(self, dataset, args):
+        message = f'Failed to destroy dataset "{dataset}"'
+        with self.lock:
+            self._get(dataset, message)
+            if '@' in dataset:
+                if self._clones(dataset):
+                    if '-d' not in args:
+                        raise ZfsCommandError(f'{message}: snapshot has dependent clones', reason='busy')
+                    self.datasets[dataset]['defer_destroy'] = 'on'
+                else:
+                    self._remove(dataset)
+                return
+            children = self._descendants(dataset)[1:] + self._descendants(dataset, snapshots=True)
+            if children and '-r' not in args:
+                raise ZfsCommandError(f'{message}: filesystem has children', reason='busy')
+            for name in children:
+                if '@' in name and self._clones(name):
+                    raise ZfsCommandError(f'{message}: snapshot has dependent clones', reason='busy')
+            for name in children + [dataset]:
+                self._remove(name)
+
+    def set_properties(self, dataset, properties):
+        with self.lock:
+            self._get(dataset, f'Failed to set properties on dataset "{dataset}"').update(
+                {k:str(v) for k,v in properties.items()})
+
+    def get_properties(self, dataset, keys):
+        with self.lock:
+            self._get(dataset, f'Failed to get properties for dataset "{dataset}"')
+            return {k:self._value(dataset, k) for k in keys}
+
+    def unmount(self, dataset):
+        self._get(dataset, f'Failed to unmount dataset "{dataset}"')
+
+
+BACKENDS = {
+    'cli': CliBackend,
+    'libzfs_core': LibzfsCoreBackend,
+    'memory': MemoryBackend,
+}
+
+
+def get_backend(name):
+    """Return a new backend with the given name,
+    the cli backend if it is not available.
     """
-    cmd = ['zfs', 'get', '-Hp']
-    cmd.append(','.join(keys))
-    cmd.append(dataset)
-    log.debug('zfs.get_properties: %s', cmd)
     try:
-        output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-    except subprocess.SubprocessError as e:
-        raise ZfsCommandError(f'Failed to get properties for dataset "{dataset}" running command: {cmd}') from e
-
-    output = output.decode('utf-8')
-    properties = {}
-    for line in output.split('\n'):
-        line = line.strip()
-        if line:
-            parts = line.split('\t')
-            properties[parts[1]] = parts[2]
-    return properties
+        return BACKENDS[name or 'cli']()
+    except KeyError:
+        log.warning('zfs: unknown backend %s, using cli', name)
+    except ImportError as e:
+        log.warning('zfs: backend %s is not available, using cli: %s', name, e)
+    return CliBackend()
+
+
+def use_backend(name):
+    """Select the backend used by this module.
+    """
+    global BACKEND
+    BACKEND = get_backend(name)
+    log.debug('zfs: using backend %s', BACKEND.name)
+    return BACKEND
+
+
+BACKEND: Backend = get_backend(os.environ.get('ZFS_PROVISIONER_ZFS_BACKEND'))
+
+
+def _same_value(expected, actual):
+    expected = str(expected)
+    if expected == actual:
+        return True
+    # Sizes may be given with a suffix, zfs reports them in bytes.
+    size = _size(expected)
+    return size is not None and actual is not None and actual.isdigit() and size == int(actual)
+
+
+def _same_properties(expected, current):
+    return all(_same_value(v, current.get(k)) for k,v in expected.items())
+
+
+def _created_properties(args, properties):
+    """Return the properties of a dataset created with the given arguments and properties.
+    """
+    expected = dict(properties, type='filesystem')
+    if '-V' in args:
+        expected.update(type='volume', volsize=args[args.index('-V') + 1])
+    return expected
+
+
+# Properties listed to determine the capacity of a parent dataset.
+CAPACITY_PROPERTIES = ('available', 'used', 'refquota', 'volsize')
+
+
+def _parse_capacity(root, rows):
+    result = {'available': 0, 'used': 0, 'committed': 0, 'datasets': 0}
+    depth = root.count('/') + 1
+    for name, available, used, refquota, volsize in rows:
+        if name == root:
+            result['available'] = int(available)
+            result['used'] = int(used)
+        elif name.count('/') == depth:
+            result['committed'] += max(int(v) for v in (refquota, volsize, '0') if v.isdigit())
+            result['datasets'] += 1
+    return result
+
+
+def _parse_children(root, keys, rows):
+    depth = root.count('/') + 1
+    return {name:dict(zip(keys, values)) for name, *values in rows if name.count('/') == depth}
+
+
+def _parse_snapshots(rows):
+    result = {}
+    for name, clones, defer_destroy in rows:
+        result[name] = {
+            'clones': [c for c in clones.split(',') if c and c != '-'],
+            'defer_destroy': defer_destroy == 'on',
+        }
+    return result
+
+
+# Channel program that destroys all datasets given as arguments
+# in a single transaction group.
+DESTROY_PROGRAM = """
+args = ...
+results = {}
+for i, dataset in ipairs(args["argv"]) do
+    results[dataset] = zfs.sync.destroy(dataset)
+end
+return results
+"""
+
+
+def _group_by_pool(datasets):
+    pools = {}
+    for dataset in datasets:
+        pool = dataset.split('/', 1)[0]
+        pools.setdefault(pool, []).append(dataset)
+    return pools
+
+
+def _destroy_result(dataset, error):
+    """Return the result of destroying dataset for the given ZfsCommandError
+    or errno of a channel program. Datasets that are gone count as destroyed.
+    """
+    if isinstance(error, ZfsCommandError):
+        if error.reason != 'not_found':
+            return str(error)
+    elif error and error != errno.ENOENT:
+        return f'Failed to destroy dataset "{dataset}": {os.strerror(error)}'
+    INVENTORY.removed(dataset)
+    return None